@@ -7,19 +7,24 @@
 """
 
 import os
+import re
 import sys
 import json
 import time
 import shutil
+import stat
 import subprocess
 import datetime
+import asyncio
 import base64
 import hashlib
 import logging
+import sqlite3
 from pathlib import Path
 from typing import List, Dict, Tuple, Optional, Any
 from dataclasses import dataclass, asdict
 from enum import Enum
+from abc import ABC, abstractmethod
 import tempfile
 import threading
 import queue
@@ -30,6 +35,9 @@ import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import random
 import string
+import heapq
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
 
 # Настройка логирования
 logging.basicConfig(
@@ -55,10 +63,30 @@ class Config:
     OUTPUT_DIR = BASE_DIR / "output"
     TEMP_DIR = BASE_DIR / "temp"
     PUBLISH_DIR = BASE_DIR / "publish"
+    TASKS_DB = BASE_DIR / "tasks.db"
+    TASK_EVENTS_FILE = BASE_DIR / "events.jsonl"
+    REFERENCE_MANIFEST = BASE_DIR / "reference_manifest.json"
+    ENCODER_PROFILES_FILE = BASE_DIR / "encoder_profiles.json"
+    PROBE_CACHE_FILE = BASE_DIR / "probe_cache.db"
+    LOUDNESS_CACHE_FILE = BASE_DIR / "loudness_cache.json"
     
     # Настройки изображений
     IMAGE_WIDTH = 1920
     IMAGE_HEIGHT = 1080
+    REFERENCE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+    RESIZE_JPEG_QUALITY = 92
+    PROMPT_TOP_TERMS = 5  # сколько ключевых слов брать в промпт
+    
+    # Тайловый апскейл изображений
+    UPSCALE_TILE_SIZE = 256  # пикселей исходного изображения
+    UPSCALE_TILE_OVERLAP = 16  # перекрытие тайлов для плавной склейки
+    UPSCALE_SHARPEN = False  # дополнительное повышение резкости (unsharp mask)
+    UPSCALE_SHARPEN_AMOUNT = 0.6
+    
+    # Дедупликация изображений по перцептивному хэшу
+    DEDUP_ENABLED = True
+    DEDUP_METHOD = "phash"  # phash или dhash
+    DEDUP_THRESHOLD = 6  # максимальное расстояние Хэмминга (из 64 бит) для дубликата
     
     # Настройки видео
     SHORT_VIDEO_DURATION = (8, 10)  # секунд
@@ -67,14 +95,106 @@ class Config:
     FINAL_VIDEO_DURATION_MAX = 1560  # 24 часа в минутах
     FPS = 60
     FINAL_FPS = 60
+    STILL_IMAGE_MODE = True  # видео из картинки: кодировать короткий фрагмент один раз
+    STILL_UNIT_SECONDS = 2  # длина фрагмента (и интервал ключевых кадров)
+    
+    # Аудиоподложка для длинных видео
+    AUDIO_BED_ENABLED = True  # микшировать дорожки один раз и зацикливать
+    AUDIO_BED_MAX_SECONDS = 600  # максимальная длина подложки
+    AUDIO_BED_CROSSFADE = 2.0  # переход между концом и началом подложки
+    AUDIO_BED_DIR = TEMP_DIR / "audio_beds"
+    AUDIO_SAMPLE_RATE = 48000
+    
+    # Нормализация громкости (EBU R128)
+    LOUDNORM_ENABLED = True
+    LOUDNORM_TARGET_I = -14.0  # LUFS, целевая интегральная громкость
+    LOUDNORM_TARGET_TP = -1.0  # dBTP, истинный пик
+    LOUDNORM_TARGET_LRA = 11.0  # LU, диапазон громкости
+    
+    # Настройки мониторинга задач
+    TASKS_PAGE_SIZE = 20
+    TASK_PROGRESS_FLUSH_INTERVAL = 5.0  # секунд между записями прогресса в БД
+    TASK_EVENT_QUEUE_SIZE = 1000  # размер очереди одного подписчика
+    TASK_EVENTS_MAX_BYTES = 10 * 1024 * 1024  # размер events.jsonl до ротации
+    TASK_EVENTS_BACKUPS = 3  # сколько ротированных файлов (events.jsonl.1, ...) хранить
+    
+    # Конвейер рендера: одновременных стадий по классам ресурсов
+    PIPELINE_LIMITS = {
+        "api": 2,  # генерация изображений (внутри уже параллельна)
+        "cpu": 2,  # кодирование; ядра дополнительно делит FFMPEG_CORE_BUDGET
+        "io": 4  # копирование потоков, склейка, микширование звука
+    }
+    
+    # Параллельная генерация изображений
+    IMAGE_WORKERS = os.cpu_count() or 4  # процессы для локального рендера
+    API_MAX_CONCURRENCY = 8  # одновременные запросы к API генерации
+    
+    # Кэш изображений
+    IMAGE_CACHE_DIR = TEMP_DIR / "image_cache"
+    IMAGE_CACHE_MAX_BYTES = 2 * 1024 ** 3  # 2 ГБ
+    
+    # Хранилище промежуточных видео (результаты стадий VideoGenerator)
+    ARTIFACT_STORE_ENABLED = True
+    ARTIFACT_DIR = BASE_DIR / "artifacts"  # та же ФС, что и OUTPUT_DIR (жесткие ссылки)
+    ARTIFACT_MAX_BYTES = 50 * 1024 ** 3  # 50 ГБ
     
     # Настройки 4K
     UHD_WIDTH = 3840
     UHD_HEIGHT = 2160
+    FRAME_QUEUE_SIZE = 8  # кадров в очереди между декодером, обработкой и кодером
+    FRAME_DEDUP_CACHE = 4  # сколько последних уникальных апскейленных кадров хранить
+    
+    # Параллельное кодирование фрагментами
+    SEGMENT_SECONDS = 10  # примерная длина фрагмента
+    ENCODE_WORKERS = max(1, min(4, os.cpu_count() or 1))  # одновременных кодеров
+    
+    PROBE_WORKERS = 8  # одновременных ffprobe при пакетном чтении метаданных
+    
+    # Запуск FFmpeg
+    FFMPEG_CORE_BUDGET = os.cpu_count() or 4  # ядер на все одновременные FFmpeg
+    FFMPEG_STDERR_LINES = 200  # сколько последних строк stderr хранить
+    FFMPEG_HISTORY_SIZE = 200  # сколько записей о ресурсах хранить в памяти
+    
+    # Автоподбор параметров кодирования
+    ENCODER_TUNING = False  # подбирать preset/CRF по пробному фрагменту
+    TUNING_PRESETS = ["veryfast", "faster", "fast", "medium", "slow"]  # от быстрого к медленному
+    TUNING_CRFS = [26, 23, 20, 18]  # от меньшего качества к большему
+    TUNING_TARGET_SSIM = 0.985
+    TUNING_SAMPLE_SECONDS = 3
+    
+    # Проверка склеек
+    SEAM_WINDOW_FRAMES = 4  # кадров по каждую сторону стыка
+    SEAM_SAMPLE_WIDTH = 160  # ширина кадров при сравнении
+    SEAM_MAX_CHECKS = 12  # сколько стыков проверять в зацикленном видео
+    SEAM_VIDEO_THRESHOLD = 4.0  # средняя разница яркости (0-255)
+    SEAM_VIDEO_RATIO = 3.0  # во сколько раз скачок больше обычной разницы кадров
+    SEAM_AUDIO_RATIO = 8.0  # скачок сэмпла относительно среднего изменения
+    
+    # Точка зацикливания
+    LOOP_SEARCH_ENABLED = True  # искать лучшую пару кадров перед зацикливанием
+    LOOP_SAMPLE_WIDTH = 64  # ширина кадров при поиске
+    LOOP_SEARCH_FRACTION = 0.25  # доля ролика с каждого края для поиска
+    LOOP_MIN_SECONDS = 2.0  # минимальная длина зацикленного фрагмента
+    LOOP_MATCH_RATIO = 1.5  # стык незаметен, если разница не больше обычной в N раз
+    LOOP_CROSSFADE_SECONDS = 0.5  # 0 - без перехода
     
     # API ключи и эндпоинты (заполнить своими данными)
     GOOGLE_AI_STUDIO_API_KEY = "YOUR_API_KEY"
     STABILITY_AI_API_KEY = "YOUR_API_KEY"
+    GOOGLE_AI_STUDIO_URL = "https://generativelanguage.googleapis.com/v1beta"
+    GOOGLE_IMAGE_MODEL = "imagen-3.0-generate-002"
+    STABILITY_AI_URL = "https://api.stability.ai"
+    IMAGE_API_PROVIDER = None  # None (локальный рендер), "google" или "stability"
+    
+    # Клиент API: лимиты запросов (запросов в секунду, размер всплеска) и повторы
+    API_RATE_LIMITS = {
+        "google": (1.0, 5),
+        "stability": (2.0, 10)
+    }
+    API_TIMEOUT = 120  # секунд
+    API_MAX_RETRIES = 5
+    API_BACKOFF_BASE = 1.0  # секунд
+    API_BACKOFF_MAX = 60.0  # секунд
     
     # Промпты для ИИ
     IMAGE_GENERATION_PROMPT_TEMPLATE = "Создай изображение в стиле {style}. {positive}. Избегай: {negative}"
@@ -102,6 +222,7 @@ class ImageDescription:
     positive: str
     negative: str
     style: str = "цифровое искусство"
+    content_hash: str = ""
     
 @dataclass
 class GenerationTask:
@@ -114,6 +235,14 @@ class GenerationTask:
     updated_at: str
     details: Dict[str, Any]
     
+@dataclass
+class TaskEvent:
+    """Событие задачи для подписчиков мониторинга"""
+    type: str  # created, status, progress, step
+    task_id: str
+    timestamp: float
+    data: Dict[str, Any]
+    
 @dataclass 
 class AudioTrack:
     """Аудиодорожка"""
@@ -121,6 +250,71 @@ class AudioTrack:
     volume: int  # 0-100
     delay: float = 0.0  # задержка в секундах
 
+@dataclass
+class SeamCheck:
+    """Результат проверки одного стыка"""
+    time: float  # секунды
+    video_jump: float  # разница кадров на стыке (0-255)
+    video_ratio: float  # относительно обычной разницы соседних кадров
+    audio_ratio: Optional[float]  # None, если звука нет
+    passed: bool
+
+@dataclass
+class LoopPoint:
+    """Лучшая пара кадров для зацикливания: фрагмент [start_frame, end_frame)"""
+    start_frame: int
+    end_frame: int
+    fps: float
+    score: float  # RMS-разница кадров на стыке (0-255)
+    baseline: float  # медианная разница соседних кадров ролика
+    
+    @property
+    def start(self):
+        return self.start_frame / self.fps
+    
+    @property
+    def end(self):
+        return self.end_frame / self.fps
+
+@dataclass
+class PipelineStage:
+    """Стадия конвейера рендера"""
+    job_id: str
+    name: str
+    action: str  # generate_images, create_video_from_image, add_audio_tracks, ...
+    params: Dict[str, Any]  # "@имя", "@имя[i]", в шаблоне "@имя[*]" - результат другой стадии
+    depends: List[str]
+    resource: str  # класс ресурсов: api, cpu, io
+    status: str = "pending"  # pending, running, completed, failed, skipped; template, expanded
+    output: Any = None
+    error: str = ""
+    updated_at: str = ""
+    each: str = ""  # шаблон: экземпляр на каждый элемент результата этой стадии
+    template: str = ""  # экземпляр: шаблон, из которого создана стадия
+
+@dataclass
+class FFmpegResult:
+    """Результат запуска FFmpeg с расходом ресурсов"""
+    returncode: int
+    stderr: str  # последние FFMPEG_STDERR_LINES строк
+    stdout: bytes = b""
+    elapsed: float = 0.0  # секунды
+    cpu_user: float = 0.0
+    cpu_system: float = 0.0
+    max_rss_kb: int = 0
+    threads: int = 0
+    speed: float = 0.0  # последняя скорость из -progress (x реального времени)
+    fps: float = 0.0
+    cancelled: bool = False
+    timed_out: bool = False
+
+@dataclass
+class VideoSegment:
+    """Фрагмент временной шкалы для параллельного кодирования"""
+    index: int
+    start: float  # секунды исходного видео
+    frames: int
+
 # ============================================================================
 # УТИЛИТЫ И ХЕЛПЕРЫ
 # ============================================================================
@@ -192,17 +386,81 @@ class Utils:
         print(f"{Utils.color_text('⚠', 'yellow')} {text}")
     
     @staticmethod
-    def resize_image(image_path, width, height):
-        """Изменение размера изображения"""
+    def resize_image(image_path, width, height, output_path=None, quality=None):
+        """Изменение размера изображения
+        
+        Без output_path файл заменяется на месте. Запись атомарная: результат
+        пишется во временный файл и переименовывается.
+        """
+        output_path = Path(output_path or image_path)
+        tmp_path = output_path.with_name(f"{output_path.stem}.partial{output_path.suffix}")
         try:
-            img = Image.open(image_path)
-            img = img.resize((width, height), Image.Resampling.LANCZOS)
-            img.save(image_path)
+            with Image.open(image_path) as img:
+                # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8)
+                if img.format == 'JPEG' and img.width > width and img.height > height:
+                    img.draft('RGB', (width, height))
+                # reducing_gap: быстрое целочисленное уменьшение перед LANCZOS
+                resized = img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            
+            save_kwargs = {}
+            if output_path.suffix.lower() in ('.jpg', '.jpeg'):
+                if resized.mode not in ('RGB', 'L'):
+                    resized = resized.convert('RGB')
+                save_kwargs['quality'] = quality or Config.RESIZE_JPEG_QUALITY
+            
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            resized.save(tmp_path, format=Image.registered_extensions().get(output_path.suffix.lower()),
+                         **save_kwargs)
+            os.replace(tmp_path, output_path)
             return True
         except Exception as e:
-            logger.error(f"Ошибка изменения размера: {e}")
+            tmp_path.unlink(missing_ok=True)
+            logger.error(f"Ошибка изменения размера {image_path}: {e}")
             return False
     
+    @staticmethod
+    def batch_resize(source, output_dir, width=None, height=None, max_workers=None, quality=None):
+        """Пакетное изменение размера на всех ядрах
+        
+        source - директория или итерируемый набор путей. Результаты пишутся в
+        output_dir под теми же именами, исходные файлы не изменяются.
+        Возвращает список (исходный путь, новый путь или None при ошибке).
+        """
+        width = width or Config.IMAGE_WIDTH
+        height = height or Config.IMAGE_HEIGHT
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        
+        if isinstance(source, (str, Path)) and Path(source).is_dir():
+            paths = sorted(p for p in Path(source).iterdir()
+                           if p.suffix.lower() in Config.REFERENCE_EXTENSIONS)
+        else:
+            paths = [Path(p) for p in source]
+        if not paths:
+            return []
+        
+        outputs = [output_dir / p.name for p in paths]
+        workers = max(1, min(max_workers or Config.IMAGE_WORKERS, len(paths)))
+        args = (paths, [width] * len(paths), [height] * len(paths), outputs, [quality] * len(paths))
+        
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            # Крупные порции снижают накладные расходы на межпроцессный обмен
+            chunksize = max(1, len(paths) // (workers * 4))
+            results = list(executor.map(Utils.resize_image, *args, chunksize=chunksize))
+        
+        done = sum(results)
+        logger.info(f"Пакетное изменение размера: {done}/{len(paths)} -> {output_dir}")
+        return [(str(src), str(dst) if ok else None) for src, dst, ok in zip(paths, outputs, results)]
+    
+    @staticmethod
+    def file_hash(path, chunk_size=1024 * 1024):
+        """SHA-256 содержимого файла"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
     @staticmethod
     def check_ffmpeg():
         """Проверка наличия FFmpeg"""
@@ -272,35 +530,398 @@ class UserInterface:
 # МЕНЕДЖЕР ЗАДАЧ И МОНИТОРИНГ
 # ============================================================================
 
+class EventBus:
+    """Внутрипроцессная шина событий (pub/sub) для мониторинга задач"""
+    
+    def __init__(self):
+        self.subscribers = []
+        self.lock = threading.Lock()
+    
+    def subscribe(self, maxsize=None):
+        """Подписка на события; возвращает очередь для чтения из любого потока"""
+        q = queue.Queue(maxsize=maxsize or Config.TASK_EVENT_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers = self.subscribers + [q]
+        return q
+    
+    def unsubscribe(self, q):
+        """Отписка от событий"""
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not q]
+    
+    def has_subscribers(self):
+        """Есть ли подписчики"""
+        return bool(self.subscribers)
+    
+    def publish(self, event):
+        """Публикация события без блокировки издателя"""
+        # Список подписчиков заменяется целиком, поэтому читаем его без блокировки
+        for q in self.subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # Медленный подписчик теряет самые старые события, а не тормозит рендер
+                try:
+                    q.get_nowait()
+                    q.put_nowait(event)
+                except (queue.Empty, queue.Full):
+                    pass
+
+# Общая шина событий процесса
+task_events = EventBus()
+
+class EventFileSink:
+    """Запись событий шины в JSONL файл, который можно читать через tail -f
+    
+    События прогресса прореживаются: для задачи записывается не больше
+    одного за Config.TASK_PROGRESS_FLUSH_INTERVAL (последнее), а отложенный
+    прогресс дописывается перед следующим событием задачи. Файл больше
+    Config.TASK_EVENTS_MAX_BYTES ротируется (events.jsonl.1, ...).
+    """
+    
+    def __init__(self, bus=None, path=None):
+        self.bus = bus or task_events
+        self.path = Path(path or Config.TASK_EVENTS_FILE)
+        self.pending_progress = {}  # task_id -> последнее незаписанное событие прогресса
+        self.last_progress = {}  # task_id -> время записи прогресса (monotonic)
+        self.queue = None
+        self.thread = None
+        self.stop_event = threading.Event()
+    
+    def start(self):
+        """Запуск фонового потока записи"""
+        if self.thread:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.queue = self.bus.subscribe()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="event-file-sink", daemon=True)
+        self.thread.start()
+    
+    def run(self):
+        """Цикл записи событий"""
+        f = open(self.path, 'a', encoding='utf-8')
+        try:
+            while not (self.stop_event.is_set() and self.queue.empty()):
+                try:
+                    event = self.queue.get(timeout=0.5)
+                except queue.Empty:
+                    event = None
+                now = time.monotonic()
+                
+                if event and event.type == "progress":
+                    self.pending_progress[event.task_id] = event
+                elif event:
+                    pending = self.pending_progress.pop(event.task_id, None)
+                    if pending:
+                        f = self.write(f, pending)
+                    f = self.write(f, event)
+                
+                for task_id, pending in list(self.pending_progress.items()):
+                    if now - self.last_progress.get(task_id, 0.0) >= Config.TASK_PROGRESS_FLUSH_INTERVAL:
+                        del self.pending_progress[task_id]
+                        self.last_progress[task_id] = now
+                        f = self.write(f, pending)
+                
+                # Сбрасываем буфер пачкой, когда очередь опустела
+                if self.queue.empty():
+                    f.flush()
+            
+            for pending in self.pending_progress.values():
+                f = self.write(f, pending)
+            self.pending_progress.clear()
+        finally:
+            f.close()
+    
+    def write(self, f, event):
+        """Запись события; возвращает файл, открытый заново после ротации"""
+        f.write(json.dumps(asdict(event), ensure_ascii=False) + "\n")
+        if f.tell() < Config.TASK_EVENTS_MAX_BYTES:
+            return f
+        f.close()
+        self.rotate()
+        return open(self.path, 'a', encoding='utf-8')
+    
+    def rotate(self):
+        """events.jsonl -> events.jsonl.1 -> ... (старейший удаляется)"""
+        backups = Config.TASK_EVENTS_BACKUPS
+        for i in range(backups - 1, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{i}")
+            if older.exists():
+                os.replace(older, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if backups > 0:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink(missing_ok=True)
+    
+    def stop(self):
+        """Остановка записи с дозаписью оставшихся событий"""
+        if not self.thread:
+            return
+        self.stop_event.set()
+        self.thread.join(timeout=5)
+        self.bus.unsubscribe(self.queue)
+        self.thread = None
+    
+    @staticmethod
+    def follow(path=None, from_start=False, poll_interval=0.5):
+        """Чтение событий из JSONL файла в режиме tail -f (для внешних дашбордов)
+        
+        После ротации чтение продолжается с начала нового файла (tail -F).
+        """
+        path = Path(path or Config.TASK_EVENTS_FILE)
+        while not path.exists():
+            time.sleep(poll_interval)
+        
+        f = open(path, 'r', encoding='utf-8')
+        try:
+            if not from_start:
+                f.seek(0, os.SEEK_END)
+            buffer = ""
+            while True:
+                line = f.readline()
+                if not line:
+                    try:
+                        rotated = os.stat(path).st_ino != os.fstat(f.fileno()).st_ino
+                    except FileNotFoundError:
+                        rotated = False
+                    if rotated:
+                        f.close()
+                        f = open(path, 'r', encoding='utf-8')
+                        continue
+                    time.sleep(poll_interval)
+                    continue
+                buffer += line
+                if not buffer.endswith("\n"):
+                    continue
+                try:
+                    yield TaskEvent(**json.loads(buffer))
+                except (ValueError, TypeError) as e:
+                    logger.warning(f"Некорректное событие в {path}: {e}")
+                buffer = ""
+        finally:
+            f.close()
+
+class TaskStore:
+    """Хранилище задач в SQLite (WAL) с построчными обновлениями"""
+    
+    COLUMNS = ("id", "name", "status", "progress", "created_at", "updated_at", "details")
+    
+    def __init__(self, db_path=None):
+        self.db_path = Path(db_path or Config.TASKS_DB)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.create_schema()
+    
+    def create_schema(self):
+        """Создание таблиц и индексов"""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    details TEXT NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status, created_at)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks(created_at)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    
+    @staticmethod
+    def row_to_task(row):
+        """Преобразование строки таблицы в GenerationTask"""
+        data = dict(zip(TaskStore.COLUMNS, row))
+        data["details"] = json.loads(data["details"])
+        return GenerationTask(**data)
+    
+    def insert(self, task):
+        """Добавление или замена задачи целиком"""
+        data = asdict(task)
+        data["details"] = json.dumps(data["details"], ensure_ascii=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO tasks ({', '.join(self.COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                tuple(data[col] for col in self.COLUMNS)
+            )
+    
+    def get(self, task_id):
+        """Получение задачи по ID"""
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM tasks WHERE id = ?", (task_id,)
+            ).fetchone()
+        return self.row_to_task(row) if row else None
+    
+    def update_fields(self, task_id, details_set=None, **fields):
+        """Обновление отдельных полей одной задачи
+        
+        details_set - ключи details, меняемые в SQL (json_set) тем же
+        оператором UPDATE: без чтения и перезаписи details целиком, поэтому
+        одновременные изменения из других потоков и процессов не теряются.
+        """
+        if not fields and not details_set:
+            return False
+        if "details" in fields:
+            fields["details"] = json.dumps(fields["details"], ensure_ascii=False)
+        assignments = [f"{col} = ?" for col in fields]
+        values = list(fields.values())
+        if details_set:
+            paths = ", ".join("?, json(?)" for _ in details_set)
+            assignments.append(f"details = json_set(details, {paths})")
+            for key, value in details_set.items():
+                values.extend([f"$.{key}", json.dumps(value, ensure_ascii=False)])
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                f"UPDATE tasks SET {', '.join(assignments)} WHERE id = ?",
+                tuple(values) + (task_id,)
+            )
+        return cursor.rowcount > 0
+    
+    def append_step(self, task_id, step, updated_at):
+        """Добавление шага к задаче одним оператором UPDATE (json_insert в SQL)"""
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "UPDATE tasks SET details = json_set(details, '$.steps', "
+                "json_insert(COALESCE(json_extract(details, '$.steps'), json('[]')), '$[#]', json(?))), "
+                "updated_at = ? WHERE id = ?",
+                (json.dumps(step, ensure_ascii=False), updated_at, task_id)
+            )
+        return cursor.rowcount > 0
+    
+    def list(self, status=None, limit=None, offset=0):
+        """Список задач (новые первыми) с фильтром по статусу и постраничным выводом"""
+        query = f"SELECT {', '.join(self.COLUMNS)} FROM tasks"
+        params = []
+        if status:
+            query += " WHERE status = ?"
+            params.append(status)
+        query += " ORDER BY created_at DESC, id"
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            params.extend([limit, offset])
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [self.row_to_task(row) for row in rows]
+    
+    def count(self, status=None):
+        """Количество задач"""
+        with self.lock:
+            if status:
+                return self.conn.execute("SELECT COUNT(*) FROM tasks WHERE status = ?", (status,)).fetchone()[0]
+            return self.conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+    
+    def import_json(self, json_path):
+        """Однократный импорт задач из старого tasks.json"""
+        json_path = Path(json_path)
+        if not json_path.exists():
+            return 0
+        
+        key = f"imported:{json_path.resolve()}"
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = ?", (key,)).fetchone():
+                return 0
+        
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка импорта задач из {json_path}: {e}")
+            return 0
+        
+        rows = []
+        for task_id, task_data in data.items():
+            try:
+                task = GenerationTask(**task_data)
+            except TypeError as e:
+                logger.warning(f"Пропущена задача {task_id}: {e}")
+                continue
+            rows.append((
+                task.id, task.name, task.status, task.progress,
+                task.created_at, task.updated_at,
+                json.dumps(task.details, ensure_ascii=False)
+            ))
+        
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR IGNORE INTO tasks ({', '.join(self.COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, Utils.get_timestamp())
+            )
+        
+        logger.info(f"Импортировано задач из {json_path}: {len(rows)}")
+        return len(rows)
+    
+    def close(self):
+        """Закрытие соединения"""
+        with self.lock:
+            self.conn.close()
+
 class TaskManager:
     """Управление задачами и мониторинг"""
     
-    def __init__(self):
-        self.tasks = {}
+    def __init__(self, db_path=None, event_bus=None):
         self.task_file = Config.BASE_DIR / "tasks.json"
+        self.store = TaskStore(db_path)
+        self.event_bus = event_bus or task_events
+        # Отложенные обновления прогресса: task_id -> (progress, updated_at)
+        self.pending_progress = {}
+        self.last_flush = {}
+        self.pending_lock = threading.Lock()
         self.load_tasks()
     
     def load_tasks(self):
-        """Загрузка задач из файла"""
-        if self.task_file.exists():
-            try:
-                with open(self.task_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for task_id, task_data in data.items():
-                        self.tasks[task_id] = GenerationTask(**task_data)
-            except Exception as e:
-                logger.error(f"Ошибка загрузки задач: {e}")
-                self.tasks = {}
+        """Импорт задач из tasks.json (выполняется один раз)"""
+        self.store.import_json(self.task_file)
     
     def save_tasks(self):
-        """Сохранение задач в файл"""
+        """Сохранение задач (изменения уже записаны построчно в SQLite)"""
         try:
-            tasks_dict = {tid: asdict(task) for tid, task in self.tasks.items()}
-            with open(self.task_file, 'w', encoding='utf-8') as f:
-                json.dump(tasks_dict, f, ensure_ascii=False, indent=2)
+            self.flush_progress()
+            with self.store.lock:
+                self.store.conn.commit()
         except Exception as e:
             logger.error(f"Ошибка сохранения задач: {e}")
     
+    def get_task(self, task_id):
+        """Получение задачи по ID"""
+        self.flush_progress(task_id)
+        return self.store.get(task_id)
+    
+    def publish(self, event_type, task_id, **data):
+        """Публикация события задачи"""
+        if self.event_bus.has_subscribers():
+            self.event_bus.publish(TaskEvent(
+                type=event_type,
+                task_id=task_id,
+                timestamp=time.time(),
+                data=data
+            ))
+    
+    def take_pending_progress(self, task_id):
+        """Извлечение отложенного прогресса задачи"""
+        with self.pending_lock:
+            self.last_flush[task_id] = time.monotonic()
+            return self.pending_progress.pop(task_id, None)
+    
+    def flush_progress(self, task_id=None):
+        """Запись отложенного прогресса в БД"""
+        task_ids = [task_id] if task_id else list(self.pending_progress)
+        for tid in task_ids:
+            pending = self.take_pending_progress(tid)
+            if pending:
+                progress, updated_at = pending
+                self.store.update_fields(tid, progress=progress, updated_at=updated_at)
+    
     def create_task(self, name, task_type):
         """Создание новой задачи"""
         task_id = Utils.generate_id()
@@ -318,48 +939,71 @@ class TaskManager:
                 "total_steps": 10
             }
         )
-        self.tasks[task_id] = task
-        self.save_tasks()
+        self.store.insert(task)
+        self.publish("created", task_id, name=name, type=task_type)
         return task_id
     
     def update_task(self, task_id, status=None, progress=None, step=None):
         """Обновление задачи"""
-        if task_id in self.tasks:
-            task = self.tasks[task_id]
-            if status:
-                task.status = status
-            if progress is not None:
-                task.progress = progress
-            if step is not None:
-                task.details["current_step"] = step
-            
-            task.updated_at = Utils.get_timestamp()
-            self.save_tasks()
+        timestamp = Utils.get_timestamp()
+        
+        if progress is not None:
+            self.publish("progress", task_id, progress=progress)
+        
+        # Изменение только прогресса записываем в БД не чаще раза в интервал
+        if not status and step is None and progress is not None:
+            with self.pending_lock:
+                self.pending_progress[task_id] = (progress, timestamp)
+                elapsed = time.monotonic() - self.last_flush.get(task_id, 0.0)
+            if elapsed >= Config.TASK_PROGRESS_FLUSH_INTERVAL:
+                self.flush_progress(task_id)
+            return
+        
+        fields = {}
+        pending = self.take_pending_progress(task_id)
+        if pending:
+            fields["progress"] = pending[0]
+        if status:
+            self.publish("status", task_id, status=status)
+            fields["status"] = status
+        if progress is not None:
+            fields["progress"] = progress
+        details_set = {"current_step": step} if step is not None else None
+        
+        fields["updated_at"] = timestamp
+        self.store.update_fields(task_id, details_set=details_set, **fields)
     
     def add_step(self, task_id, step_name, result=None):
         """Добавление шага к задаче"""
-        if task_id in self.tasks:
-            step = {
-                "name": step_name,
-                "timestamp": Utils.get_timestamp(),
-                "result": result
-            }
-            self.tasks[task_id].details["steps"].append(step)
-            self.save_tasks()
+        timestamp = Utils.get_timestamp()
+        step = {
+            "name": step_name,
+            "timestamp": timestamp,
+            "result": result
+        }
+        self.flush_progress(task_id)
+        self.store.append_step(task_id, step, timestamp)
+        self.publish("step", task_id, name=step_name, result=result)
     
-    def show_tasks(self):
-        """Отображение списка задач"""
-        if not self.tasks:
+    def show_tasks(self, status=None, page=1, page_size=None):
+        """Отображение списка задач (постранично, с фильтром по статусу)"""
+        self.flush_progress()
+        page_size = page_size or Config.TASKS_PAGE_SIZE
+        total = self.store.count(status)
+        if not total:
             print("\nНет задач")
-            return
+            return 0
+        
+        pages = (total + page_size - 1) // page_size
+        page = max(1, min(page, pages))
         
-        Utils.print_header("СПИСОК ЗАДАЧ")
+        Utils.print_header(f"СПИСОК ЗАДАЧ (страница {page}/{pages}, всего {total})")
         
-        for task_id, task in self.tasks.items():
+        for task in self.store.list(status=status, limit=page_size, offset=(page - 1) * page_size):
             status_color = "green" if task.status == "completed" else "yellow" if task.status == "processing" else "red"
             status_text = Utils.color_text(task.status, status_color)
             
-            print(f"\nID: {task_id}")
+            print(f"\nID: {task.id}")
             print(f"Название: {task.name}")
             print(f"Статус: {status_text}")
             print(f"Прогресс: {task.progress:.1f}%")
@@ -370,248 +1014,2835 @@ class TaskManager:
                 print("\nШаги:")
                 for step in task.details["steps"][-5:]:  # Последние 5 шагов
                     print(f"  - {step['timestamp']}: {step['name']}")
+        
+        return pages
 
 # ============================================================================
-# ГЕНЕРАЦИЯ ИЗОБРАЖЕНИЙ
+# КЛИЕНТЫ API ГЕНЕРАЦИИ ИЗОБРАЖЕНИЙ
 # ============================================================================
 
-class ImageGenerator:
-    """Генерация изображений с помощью ИИ"""
+class ApiError(Exception):
+    """Ошибка запроса к API генерации"""
     
-    def __init__(self):
-        self.reference_images = []
-        self.load_reference_images()
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class TokenBucket:
+    """Ограничитель частоты запросов (token bucket) для asyncio"""
     
-    def load_reference_images(self):
-        """Загрузка референсных изображений"""
-        if Config.INPUT_IMAGES_DIR.exists():
-            for img_file in Config.INPUT_IMAGES_DIR.glob("*.jpg"):
-                desc_file = Config.INPUT_IMAGES_DIR / f"{img_file.stem}.json"
-                if desc_file.exists():
-                    try:
-                        with open(desc_file, 'r', encoding='utf-8') as f:
-                            data = json.load(f)
-                            desc = ImageDescription(
-                                image_path=str(img_file),
-                                positive=data.get('positive', ''),
-                                negative=data.get('negative', ''),
-                                style=data.get('style', 'цифровое искусство')
-                            )
-                            self.reference_images.append(desc)
-                    except Exception as e:
-                        logger.error(f"Ошибка загрузки описания {desc_file}: {e}")
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = None
     
-    def analyze_references(self):
-        """Анализ референсных изображений для создания промпта"""
-        if not self.reference_images:
-            return {
-                'positive': 'красивое, детализированное изображение',
-                'negative': 'размытость, артефакты',
-                'style': 'цифровое искусство'
-            }
-        
-        # Упрощенный анализ (в реальности здесь был бы ИИ-анализ)
-        positive_keywords = []
-        negative_keywords = []
-        styles = []
-        
-        for ref in self.reference_images:
-            positive_keywords.extend(ref.positive.split()[:3])
-            negative_keywords.extend(ref.negative.split()[:3])
-            styles.append(ref.style)
-        
-        # Самые частые элементы
-        from collections import Counter
-        most_common_positive = Counter(positive_keywords).most_common(3)
-        most_common_negative = Counter(negative_keywords).most_common(3)
-        most_common_style = Counter(styles).most_common(1)[0][0] if styles else "цифровое искусство"
-        
-        return {
-            'positive': ', '.join([kw[0] for kw in most_common_positive]),
-            'negative': ', '.join([kw[0] for kw in most_common_negative]),
-            'style': most_common_style
-        }
+    async def acquire(self):
+        """Ожидание свободного токена"""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ApiClient(ABC):
+    """Базовый asyncio-клиент API с пулом соединений, лимитом частоты,
+    повторами с джиттером и объединением одинаковых запросов
     
-    def generate_prompt(self, analysis):
-        """Создание промпта на основе анализа"""
-        prompt = Config.IMAGE_GENERATION_PROMPT_TEMPLATE.format(
-            style=analysis['style'],
-            positive=analysis['positive'],
-            negative=analysis['negative']
-        )
-        return prompt
+    Провайдер реализует fetch_image через request().
+    """
     
-    def generate_images(self, task_id, num_variants=4):
-        """Генерация вариантов изображений"""
-        task_manager = TaskManager()
-        output_dir = Config.TEMP_DIR / task_id / "generated_images"
-        output_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Обновление статуса задачи
-        task_manager.update_task(task_id, status="processing", progress=10)
+    PROVIDER = ""
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    
+    def __init__(self, api_key, base_url, rate_limit=None, max_concurrency=None):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        rate, burst = rate_limit or Config.API_RATE_LIMITS.get(self.PROVIDER, (1.0, 1))
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = max_concurrency or Config.API_MAX_CONCURRENCY
         
-        # Анализ референсов
-        analysis = self.analyze_references()
-        prompt = self.generate_prompt(analysis)
+        # Keep-alive соединения переиспользуются через пул requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.max_concurrency
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_concurrency,
+            thread_name_prefix=f"api-{self.PROVIDER}"
+        )
         
-        print(f"\nСгенерированный промпт: {Utils.color_text(prompt, 'cyan')}")
+        self.in_flight = {}
+        self.semaphore = None
+        self.loop = None
+        self.loop_thread = None
+        self.stats = {"requests": 0, "retries": 0, "coalesced": 0, "errors": 0}
+    
+    # --- Цикл событий в фоновом потоке для синхронных вызовов ---
+    
+    def start(self):
+        """Запуск собственного цикла событий в фоновом потоке"""
+        if self.loop:
+            return
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever,
+                                            name=f"api-loop-{self.PROVIDER}", daemon=True)
+        self.loop_thread.start()
+    
+    def run(self, coro):
+        """Синхронное выполнение корутины в цикле клиента"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+    
+    def close(self):
+        """Остановка цикла и закрытие соединений"""
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join(timeout=5)
+            self.loop.close()
+            self.loop = None
+        self.executor.shutdown(wait=False)
+        self.session.close()
+    
+    # --- Запросы ---
+    
+    def backoff_delay(self, attempt, response=None):
+        """Задержка перед повтором: экспонента с полным джиттером или Retry-After"""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.replace('.', '', 1).isdigit():
+                return min(float(retry_after), Config.API_BACKOFF_MAX)
+        ceiling = min(Config.API_BACKOFF_MAX, Config.API_BACKOFF_BASE * (2 ** attempt))
+        return random.uniform(0, ceiling)
+    
+    async def request(self, method, path, **kwargs):
+        """HTTP запрос с ограничением частоты и повторами на 429/5xx"""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
         
-        # В реальности здесь был бы вызов API ИИ
-        # Для демонстрации создаем тестовые изображения
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        kwargs.setdefault('timeout', Config.API_TIMEOUT)
+        loop = asyncio.get_running_loop()
         
-        generated_images = []
-        for i in range(num_variants):
-            # Обновление прогресса
-            progress = 10 + (i * 80 / num_variants)
-            task_manager.update_task(task_id, progress=progress)
+        for attempt in range(Config.API_MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            response = None
+            async with self.semaphore:
+                self.stats["requests"] += 1
+                try:
+                    response = await loop.run_in_executor(
+                        self.executor,
+                        lambda: self.session.request(method, url, **kwargs)
+                    )
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = ApiError(f"{self.PROVIDER}: {e}")
+                else:
+                    if response.status_code < 400:
+                        return response
+                    error = ApiError(
+                        f"{self.PROVIDER}: HTTP {response.status_code}: {response.text[:200]}",
+                        response.status_code
+                    )
+                    if response.status_code not in self.RETRY_STATUSES:
+                        self.stats["errors"] += 1
+                        raise error
             
-            # Создание тестового изображения
-            image_path = output_dir / f"variant_{i+1}.jpg"
-            self.create_test_image(image_path, prompt, i)
-            generated_images.append(str(image_path))
+            if attempt == Config.API_MAX_RETRIES:
+                break
             
-            print(f"Сгенерирован вариант {i+1}")
-            task_manager.add_step(task_id, f"Генерация варианта {i+1}", str(image_path))
+            delay = self.backoff_delay(attempt, response)
+            self.stats["retries"] += 1
+            logger.warning(f"{error}; повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
         
-        task_manager.update_task(task_id, status="completed", progress=100)
-        return generated_images
+        self.stats["errors"] += 1
+        raise error
     
-    def create_test_image(self, image_path, prompt, variant_num):
-        """Создание тестового изображения (заглушка для демо)"""
-        # В реальном проекте здесь вызов API для генерации
-        # Сейчас создаем просто цветной прямоугольник с текстом
-        
-        img = Image.new('RGB', (Config.IMAGE_WIDTH, Config.IMAGE_HEIGHT), 
-                       color=(variant_num*50, 100 + variant_num*30, 150))
-        draw = ImageDraw.Draw(img)
-        
-        # Простой текст для демонстрации
-        try:
-            font = ImageFont.load_default()
-        except:
-            font = None
-        
-        # Центрируем текст
-        text = f"Вариант {variant_num+1}\n{prompt[:50]}..."
-        text_width = draw.textlength(text, font=font) if font else 200
+    async def generate(self, prompt, width, height, seed=0):
+        """Генерация изображения; одинаковые параллельные запросы объединяются"""
+        key = hashlib.sha256(
+            f"{self.PROVIDER}|{prompt}|{width}x{height}|{seed}".encode('utf-8')
+        ).hexdigest()
         
-        draw.text(
-            ((Config.IMAGE_WIDTH - text_width) // 2, Config.IMAGE_HEIGHT // 2 - 50),
-            text,
-            fill=(255, 255, 255),
-            font=font
-        )
+        task = self.in_flight.get(key)
+        if task:
+            self.stats["coalesced"] += 1
+        else:
+            task = asyncio.ensure_future(self.fetch_image(prompt, width, height, seed))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
         
-        img.save(image_path)
+        return await asyncio.shield(task)
+    
+    @abstractmethod
+    async def fetch_image(self, prompt, width, height, seed):
+        """Запрос изображения у провайдера (байты изображения)"""
+    
+    def generate_to_file(self, image_path, prompt, variant_num, width, height):
+        """Синхронная генерация в файл (совместима с ImageGenerator.remote_generator)"""
+        data = self.run(self.generate(prompt, width, height, seed=variant_num))
+        with open(image_path, 'wb') as f:
+            f.write(data)
         return image_path
+
+class GoogleAIStudioClient(ApiClient):
+    """Клиент Google AI Studio (Imagen)"""
     
-    def upscale_image(self, image_path, scale_factor=2):
-        """Улучшение детализации изображения"""
-        task_id = Utils.generate_id()
-        output_path = Path(image_path).parent / f"upscaled_{Path(image_path).name}"
-        
-        # В реальности здесь был бы вызов API для апскейла (Real-ESRGAN и т.д.)
-        # Для демо просто увеличиваем размер
-        
-        try:
-            img = Image.open(image_path)
-            new_width = img.width * scale_factor
-            new_height = img.height * scale_factor
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            img.save(output_path)
-            
-            print(f"Изображение улучшено: {output_path}")
-            return str(output_path)
-        except Exception as e:
-            logger.error(f"Ошибка апскейла: {e}")
-            return None
+    PROVIDER = "google"
+    
+    def __init__(self, api_key=None, base_url=None, **kwargs):
+        super().__init__(api_key or Config.GOOGLE_AI_STUDIO_API_KEY,
+                         base_url or Config.GOOGLE_AI_STUDIO_URL, **kwargs)
+    
+    async def fetch_image(self, prompt, width, height, seed):
+        """Запрос изображения у Imagen"""
+        aspect_ratio = "16:9" if width > height else "9:16" if height > width else "1:1"
+        response = await self.request(
+            'POST',
+            f"models/{Config.GOOGLE_IMAGE_MODEL}:predict",
+            params={'key': self.api_key},
+            json={
+                "instances": [{"prompt": prompt}],
+                "parameters": {"sampleCount": 1, "aspectRatio": aspect_ratio, "seed": seed}
+            }
+        )
+        predictions = response.json().get("predictions") or []
+        if not predictions or "bytesBase64Encoded" not in predictions[0]:
+            raise ApiError(f"{self.PROVIDER}: пустой ответ")
+        return base64.b64decode(predictions[0]["bytesBase64Encoded"])
+
+class StabilityAIClient(ApiClient):
+    """Клиент Stability AI"""
+    
+    PROVIDER = "stability"
+    
+    def __init__(self, api_key=None, base_url=None, **kwargs):
+        super().__init__(api_key or Config.STABILITY_AI_API_KEY,
+                         base_url or Config.STABILITY_AI_URL, **kwargs)
+    
+    async def fetch_image(self, prompt, width, height, seed):
+        """Запрос изображения у Stable Image Core"""
+        aspect_ratio = "16:9" if width > height else "9:16" if height > width else "1:1"
+        response = await self.request(
+            'POST',
+            "v2beta/stable-image/generate/core",
+            headers={'Authorization': f"Bearer {self.api_key}", 'Accept': 'image/*'},
+            files={'none': ''},
+            data={
+                'prompt': prompt,
+                'aspect_ratio': aspect_ratio,
+                'seed': seed,
+                'output_format': 'jpeg'
+            }
+        )
+        return response.content
+
+API_CLIENTS = {
+    "google": GoogleAIStudioClient,
+    "stability": StabilityAIClient
+}
 
 # ============================================================================
-# ГЕНЕРАЦИЯ ВИДЕО
+# КЭШ ИЗОБРАЖЕНИЙ
 # ============================================================================
 
-class VideoGenerator:
-    """Генерация и обработка видео"""
+class ImageCache:
+    """Контентно-адресуемый кэш изображений с лимитом размера и LRU вытеснением"""
     
-    def __init__(self):
-        if not Utils.check_ffmpeg():
-            print(Utils.color_text("ВНИМАНИЕ: FFmpeg не установлен!", "red"))
-            print("Установите: sudo apt install ffmpeg")
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = Path(cache_dir or Config.IMAGE_CACHE_DIR)
+        self.max_bytes = max_bytes or Config.IMAGE_CACHE_MAX_BYTES
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.cache_dir / "index.db"), timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    ext TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_access ON entries(last_access)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+        self.hits = 0
+        self.misses = 0
     
-    def create_video_from_image(self, image_path, duration, output_path, prompt=""):
-        """Создание видео из изображения"""
-        try:
-            # Команда FFmpeg для создания видео из изображения
-            cmd = [
-                'ffmpeg', '-y',
-                '-loop', '1',
-                '-i', image_path,
-                '-c:v', 'libx264',
-                '-t', str(duration),
-                '-pix_fmt', 'yuv420p',
-                '-vf', f'fps={Config.FPS},scale={Config.IMAGE_WIDTH}:{Config.IMAGE_HEIGHT}',
-                str(output_path)
+    @staticmethod
+    def make_key(operation, **params):
+        """Ключ кэша: хэш операции и всех ее параметров"""
+        payload = json.dumps({"operation": operation, **params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def entry_path(self, key, ext):
+        """Путь к файлу записи"""
+        return self.cache_dir / key[:2] / f"{key}{ext}"
+    
+    def count(self, name):
+        """Учет попадания/промаха (в памяти и в индексе)"""
+        setattr(self, name, getattr(self, name) + 1)
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO stats (name, value) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                (name,)
+            )
+    
+    def get(self, key, dest_path):
+        """Копирование закэшированного изображения в dest_path; False при промахе"""
+        with self.lock:
+            row = self.conn.execute("SELECT ext FROM entries WHERE key = ?", (key,)).fetchone()
+            path = self.entry_path(key, row[0]) if row else None
+            if not path or not path.exists():
+                if row:
+                    with self.conn:
+                        self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.count("misses")
+                return False
+            
+            with self.conn:
+                self.conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.count("hits")
+        
+        shutil.copyfile(path, dest_path)
+        return True
+    
+    def put(self, key, src_path):
+        """Сохранение изображения в кэш"""
+        src_path = Path(src_path)
+        path = self.entry_path(key, src_path.suffix)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        
+        # Атомарная запись: копия во временный файл и переименование
+        tmp_path = path.with_name(f"{path.name}.{Utils.generate_id()}.tmp")
+        try:
+            shutil.copyfile(src_path, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            tmp_path.unlink(missing_ok=True)
+            logger.error(f"Ошибка записи в кэш изображений: {e}")
+            return False
+        
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, ext, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, src_path.suffix, path.stat().st_size, time.time())
+                )
+            self.evict()
+        return True
+    
+    def evict(self):
+        """Удаление давно не использованных записей сверх лимита размера"""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        removed = []
+        for key, ext, size in self.conn.execute(
+            "SELECT key, ext, size FROM entries ORDER BY last_access"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self.entry_path(key, ext).unlink(missing_ok=True)
+            removed.append((key,))
+            total -= size
+        
+        with self.conn:
+            self.conn.executemany("DELETE FROM entries WHERE key = ?", removed)
+        logger.info(f"Из кэша изображений вытеснено записей: {len(removed)}")
+    
+    def stats(self):
+        """Статистика кэша"""
+        with self.lock:
+            entries, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+            totals = dict(self.conn.execute("SELECT name, value FROM stats").fetchall())
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "total_hits": totals.get("hits", 0),
+            "total_misses": totals.get("misses", 0),
+            "entries": entries,
+            "size_bytes": size
+        }
+
+
+class ArtifactStore:
+    """Контентно-адресуемое хранилище результатов стадий обработки видео
+    
+    Ключ результата - хэш названия стадии, содержимого входных файлов,
+    точных параметров и версии FFmpeg. Результат выдается жесткой ссылкой
+    (без копирования); перед повторным рендером путь назначения
+    отвязывается, поэтому новый результат не пишется в файл хранилища.
+    Запись, размер которой не совпадает с индексом (файл изменили на
+    месте), отбрасывается. Сверх лимита размера давно не использованные
+    записи вытесняются.
+    """
+    
+    def __init__(self, store_dir=None, max_bytes=None, enabled=None):
+        self.store_dir = Path(store_dir or Config.ARTIFACT_DIR)
+        self.max_bytes = max_bytes or Config.ARTIFACT_MAX_BYTES
+        self.enabled = Config.ARTIFACT_STORE_ENABLED if enabled is None else enabled
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.store_dir / "index.db"), timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS artifacts (
+                    key TEXT PRIMARY KEY,
+                    stage TEXT NOT NULL,
+                    ext TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at TEXT NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_artifacts_access ON artifacts(last_access)")
+        self.version = None
+    
+    def ffmpeg_version(self):
+        """Первая строка ffmpeg -version (часть ключа: другая сборка - другой результат)"""
+        if self.version is None:
+            try:
+                result = ffmpeg_runner.run(['ffmpeg', '-version'], threads=1, outputs=[], capture_stdout=True)
+                lines = result.stdout.decode(errors='replace').splitlines()
+                self.version = lines[0].strip() if lines else ""
+            except FileNotFoundError:
+                self.version = ""
+        return self.version
+    
+    def make_key(self, stage, inputs, params):
+        """Ключ результата стадии"""
+        payload = json.dumps({
+            "stage": stage,
+            "inputs": [media_probe.content_hash(path) for path in inputs],
+            "params": params,
+            "ffmpeg": self.ffmpeg_version()
+        }, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def entry_path(self, key, ext):
+        """Путь к файлу записи"""
+        return self.store_dir / key[:2] / f"{key}{ext}"
+    
+    @staticmethod
+    def link(src_path, dest_path):
+        """Жесткая ссылка dest_path -> src_path через временное имя (копия, если ссылка невозможна)"""
+        dest_path = Path(dest_path)
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        if dest_path.exists() and os.path.samefile(src_path, dest_path):
+            return  # уже ссылка на тот же файл (rename в этом случае ничего не делает)
+        tmp_path = dest_path.with_name(f"{dest_path.name}.{Utils.generate_id()}.tmp")
+        try:
+            try:
+                os.link(src_path, tmp_path)
+            except OSError:
+                # Другая файловая система или ФС без жестких ссылок
+                shutil.copyfile(src_path, tmp_path)
+            os.replace(tmp_path, dest_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    
+    def materialize(self, key, dest_path):
+        """Выдача результата в dest_path; False, если его нет"""
+        with self.lock:
+            row = self.conn.execute("SELECT ext, size FROM artifacts WHERE key = ?", (key,)).fetchone()
+            path = self.entry_path(key, row[0]) if row else None
+            entry_stat = path.stat() if path and path.exists() else None
+            if not entry_stat or entry_stat.st_size != row[1]:
+                if row:
+                    if entry_stat:
+                        logger.warning(f"Артефакт {key[:12]} изменен на месте, запись отброшена")
+                        path.unlink(missing_ok=True)
+                    with self.conn:
+                        self.conn.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+                return False
+            with self.conn:
+                self.conn.execute("UPDATE artifacts SET last_access = ? WHERE key = ?", (time.time(), key))
+        
+        try:
+            if not entry_stat.st_mode & stat.S_IWUSR:
+                # Записи ранних версий хранилища были только для чтения
+                os.chmod(path, entry_stat.st_mode | stat.S_IWUSR)
+            self.link(path, dest_path)
+        except OSError as e:
+            logger.error(f"Ошибка выдачи артефакта {key[:12]}: {e}")
+            return False
+        return True
+    
+    def put(self, key, src_path, stage):
+        """Сохранение результата стадии (жесткой ссылкой на src_path)"""
+        src_path = Path(src_path)
+        path = self.entry_path(key, src_path.suffix)
+        try:
+            self.link(src_path, path)
+        except OSError as e:
+            logger.error(f"Ошибка записи в хранилище артефактов: {e}")
+            return False
+        
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO artifacts (key, stage, ext, size, created_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, stage, src_path.suffix, path.stat().st_size, Utils.get_timestamp(), time.time())
+                )
+            self.evict()
+        return True
+    
+    def evict(self):
+        """Удаление давно не использованных записей сверх лимита размера
+        
+        Выданные жесткие ссылки при этом остаются на месте.
+        """
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        removed = []
+        for key, ext, size in self.conn.execute(
+            "SELECT key, ext, size FROM artifacts ORDER BY last_access"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self.entry_path(key, ext).unlink(missing_ok=True)
+            removed.append((key,))
+            total -= size
+        
+        with self.conn:
+            self.conn.executemany("DELETE FROM artifacts WHERE key = ?", removed)
+        logger.info(f"Из хранилища артефактов вытеснено записей: {len(removed)}")
+    
+    def run(self, stage, output_path, inputs, params, render):
+        """Результат стадии из хранилища или render() с сохранением
+        
+        render() пишет результат в output_path и возвращает признак успеха.
+        """
+        if not self.enabled:
+            return render()
+        
+        try:
+            key = self.make_key(stage, inputs, params)
+        except Exception as e:
+            logger.error(f"Ошибка вычисления ключа артефакта ({stage}): {e}")
+            return render()
+        
+        if self.materialize(key, output_path):
+            print(f"Результат взят из хранилища: {output_path}")
+            logger.info(f"Артефакт {stage} {key[:12]}: попадание")
+            return True
+        
+        # Путь мог быть жесткой ссылкой на запись хранилища - отвязываем до записи
+        Path(output_path).unlink(missing_ok=True)
+        result = render()
+        if result and Path(output_path).exists():
+            self.put(key, output_path, stage)
+        return result
+    
+    def stats(self):
+        """Статистика хранилища по стадиям"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT stage, COUNT(*), COALESCE(SUM(size), 0) FROM artifacts GROUP BY stage"
+            ).fetchall()
+        return {stage: {"entries": entries, "size_bytes": size} for stage, entries, size in rows}
+
+# ============================================================================
+# ДЕДУПЛИКАЦИЯ ИЗОБРАЖЕНИЙ
+# ============================================================================
+
+class PerceptualHash:
+    """Пакетный векторизованный перцептивный хэш (pHash/dHash, 64 бита)"""
+    
+    HASH_SIZE = 8
+    PHASH_SIZE = 32
+    
+    DCT_MATRICES = {}
+    
+    # Количество единичных битов для каждого байта
+    POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+    
+    @staticmethod
+    def load_gray(path, size):
+        """Загрузка изображения в оттенках серого, уменьшенного до size"""
+        # Уменьшенное декодирование JPEG в 4 раза заметно быстрее полного
+        img = cv2.imread(str(path), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+        if img is None:
+            try:
+                img = np.asarray(Image.open(path).convert('L'))
+            except Exception as e:
+                logger.error(f"Не удалось прочитать изображение {path}: {e}")
+                return None
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    
+    @classmethod
+    def compute(cls, paths, method=None, max_workers=None):
+        """Хэши для списка файлов (None для нечитаемых)"""
+        method = method or Config.DEDUP_METHOD
+        if method == "phash":
+            size = (cls.PHASH_SIZE, cls.PHASH_SIZE)
+        else:
+            size = (cls.HASH_SIZE + 1, cls.HASH_SIZE)
+        
+        paths = [str(p) for p in paths]
+        if not paths:
+            return []
+        
+        # cv2 отпускает GIL при декодировании, поэтому хватает потоков
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or Config.IMAGE_WORKERS) as executor:
+            images = list(executor.map(lambda p: cls.load_gray(p, size), paths))
+        
+        valid = [i for i, img in enumerate(images) if img is not None]
+        result = [None] * len(paths)
+        if not valid:
+            return result
+        
+        batch = np.stack([images[i] for i in valid]).astype(np.float32)
+        bits = cls.phash_bits(batch) if method == "phash" else cls.dhash_bits(batch)
+        packed = np.packbits(bits.reshape(len(valid), -1), axis=1)
+        for i, row in zip(valid, packed):
+            result[i] = int.from_bytes(row.tobytes(), 'big')
+        return result
+    
+    @classmethod
+    def dct_matrix(cls, size):
+        """Матрица DCT-II (считается один раз для каждого размера)"""
+        if size not in cls.DCT_MATRICES:
+            k = np.arange(size)[:, None]
+            n = np.arange(size)[None, :]
+            matrix = np.sqrt(2.0 / size) * np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+            matrix[0] /= np.sqrt(2.0)
+            cls.DCT_MATRICES[size] = matrix.astype(np.float32)
+        return cls.DCT_MATRICES[size]
+    
+    @classmethod
+    def phash_bits(cls, batch):
+        """pHash: знак низкочастотных коэффициентов DCT относительно медианы"""
+        matrix = cls.dct_matrix(batch.shape[1])
+        # Двумерное DCT всего пакета двумя матричными умножениями
+        dct = matrix @ batch @ matrix.T
+        low = dct[:, :cls.HASH_SIZE, :cls.HASH_SIZE].reshape(len(batch), -1)
+        # DC-коэффициент не участвует в вычислении медианы
+        median = np.median(low[:, 1:], axis=1, keepdims=True)
+        return low > median
+    
+    @staticmethod
+    def dhash_bits(batch):
+        """dHash: знак горизонтального градиента"""
+        return batch[:, :, 1:] > batch[:, :, :-1]
+    
+    @classmethod
+    def distances(cls, hashes, value):
+        """Расстояния Хэмминга от value до массива хэшей uint64"""
+        xor = np.bitwise_xor(hashes, np.uint64(value))
+        return cls.POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+class HashIndex:
+    """Индекс перцептивных хэшей с быстрым поиском по расстоянию Хэмминга
+    
+    Хэш делится на 4 полосы по 16 бит. При пороге меньше 4 у близких хэшей
+    хотя бы одна полоса совпадает точно, поэтому кандидаты берутся из
+    корзин полос; при большем пороге выполняется векторизованный перебор.
+    """
+    
+    BANDS = 4
+    
+    def __init__(self):
+        self.keys = []
+        self.buffer = np.zeros(1024, dtype=np.uint64)
+        self.buckets = [{} for _ in range(self.BANDS)]
+    
+    @property
+    def hashes(self):
+        """Массив добавленных хэшей"""
+        return self.buffer[:len(self.keys)]
+    
+    @classmethod
+    def bands(cls, value):
+        """16-битные полосы хэша"""
+        return [(value >> (16 * b)) & 0xFFFF for b in range(cls.BANDS)]
+    
+    def add(self, key, value):
+        """Добавление хэша"""
+        idx = len(self.keys)
+        if idx == len(self.buffer):
+            # Удвоение буфера вместо копирования на каждое добавление
+            self.buffer = np.concatenate([self.buffer, np.zeros_like(self.buffer)])
+        self.buffer[idx] = np.uint64(value)
+        self.keys.append(key)
+        for band, bucket in zip(self.bands(value), self.buckets):
+            bucket.setdefault(band, []).append(idx)
+    
+    def find(self, value, threshold=None):
+        """Ключи хэшей на расстоянии не больше threshold: [(key, distance)]"""
+        threshold = Config.DEDUP_THRESHOLD if threshold is None else threshold
+        if not self.keys:
+            return []
+        
+        if threshold < self.BANDS:
+            candidates = set()
+            for band, bucket in zip(self.bands(value), self.buckets):
+                candidates.update(bucket.get(band, ()))
+            if not candidates:
+                return []
+            indices = np.fromiter(candidates, dtype=np.int64)
+        else:
+            indices = np.arange(len(self.keys))
+        
+        distances = PerceptualHash.distances(self.hashes[indices], value)
+        matches = indices[distances <= threshold]
+        return [(self.keys[i], int(d)) for i, d in zip(matches, distances[distances <= threshold])]
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    @classmethod
+    def deduplicate(cls, items, threshold=None):
+        """Разделение [(key, hash)] на уникальные и дубликаты {дубликат: оригинал}"""
+        index = cls()
+        unique = []
+        duplicates = {}
+        for key, value in items:
+            if value is None:
+                unique.append(key)
+                continue
+            found = index.find(value, threshold)
+            if found:
+                duplicates[key] = min(found, key=lambda m: m[1])[0]
+                continue
+            index.add(key, value)
+            unique.append(key)
+        return unique, duplicates
+
+# ============================================================================
+# ИНДЕКС РЕФЕРЕНСНЫХ ИЗОБРАЖЕНИЙ
+# ============================================================================
+
+class ReferenceIndex:
+    """Инкрементальный индекс референсов: манифест с mtime/size/hash каждого файла"""
+    
+    VERSION = 1
+    
+    def __init__(self, images_dir=None, manifest_path=None):
+        self.images_dir = Path(images_dir or Config.INPUT_IMAGES_DIR)
+        self.manifest_path = Path(manifest_path or Config.REFERENCE_MANIFEST)
+        self.entries = {}
+        self.load_manifest()
+    
+    def load_manifest(self):
+        """Загрузка манифеста"""
+        if not self.manifest_path.exists():
+            return
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                self.entries = data.get("entries", {})
+        except Exception as e:
+            logger.error(f"Ошибка загрузки манифеста референсов: {e}")
+            self.entries = {}
+    
+    def save_manifest(self):
+        """Атомарное сохранение манифеста"""
+        try:
+            self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.manifest_path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"version": self.VERSION, "entries": self.entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.manifest_path)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения манифеста референсов: {e}")
+    
+    @staticmethod
+    def signature(image_stat, desc_stat):
+        """Признак изменения пары изображение + описание"""
+        return [image_stat.st_mtime_ns, image_stat.st_size, desc_stat.st_mtime_ns, desc_stat.st_size]
+    
+    def scan(self):
+        """Сканирование директории; перечитываются только измененные файлы
+        
+        Возвращает (added, removed): списки путей добавленных/измененных и
+        удаленных референсов.
+        """
+        if not self.images_dir.exists():
+            removed = list(self.entries)
+            self.entries = {}
+            if removed:
+                self.save_manifest()
+            return [], removed
+        
+        # Один проход scandir дает stat без отдельных системных вызовов на файл
+        files = {}
+        with os.scandir(self.images_dir) as it:
+            for entry in it:
+                if entry.is_file():
+                    files[entry.name] = entry
+        
+        added = []
+        seen = set()
+        for name, entry in files.items():
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in Config.REFERENCE_EXTENSIONS:
+                continue
+            desc_entry = files.get(f"{stem}.json")
+            if not desc_entry:
+                continue
+            
+            image_path = entry.path
+            seen.add(image_path)
+            signature = self.signature(entry.stat(), desc_entry.stat())
+            cached = self.entries.get(image_path)
+            if cached and cached["signature"] == signature:
+                continue
+            
+            try:
+                with open(desc_entry.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                content_hash = Utils.file_hash(image_path)
+            except Exception as e:
+                logger.error(f"Ошибка загрузки описания {desc_entry.path}: {e}")
+                continue
+            
+            self.entries[image_path] = {
+                "signature": signature,
+                "hash": content_hash,
+                "positive": data.get('positive', ''),
+                "negative": data.get('negative', ''),
+                "style": data.get('style', 'цифровое искусство')
+            }
+            added.append(image_path)
+        
+        removed = [path for path in self.entries if path not in seen]
+        for path in removed:
+            del self.entries[path]
+        
+        # Перцептивные хэши считаются пакетом только для новых записей
+        key = f"perceptual_{Config.DEDUP_METHOD}"
+        missing = [path for path, entry in self.entries.items() if key not in entry]
+        if missing:
+            for path, value in zip(missing, PerceptualHash.compute(missing)):
+                self.entries[path][key] = f"{value:016x}" if value is not None else None
+        
+        if added or removed or missing:
+            self.save_manifest()
+            logger.info(f"Индекс референсов обновлен: +{len(added)}, -{len(removed)}")
+        
+        return added, removed
+    
+    def description(self, image_path):
+        """ImageDescription для записи индекса"""
+        entry = self.entries[image_path]
+        return ImageDescription(
+            image_path=image_path,
+            positive=entry["positive"],
+            negative=entry["negative"],
+            style=entry["style"],
+            content_hash=entry["hash"]
+        )
+    
+    def descriptions(self):
+        """Все описания в порядке имен файлов"""
+        return [self.description(path) for path in sorted(self.entries)]
+    
+    def perceptual_hash(self, image_path):
+        """Перцептивный хэш референса (int или None)"""
+        value = self.entries[image_path].get(f"perceptual_{Config.DEDUP_METHOD}")
+        return int(value, 16) if value else None
+    
+    def deduplicated(self, threshold=None):
+        """Описания без почти одинаковых изображений"""
+        paths = sorted(self.entries)
+        unique, duplicates = HashIndex.deduplicate(
+            [(path, self.perceptual_hash(path)) for path in paths],
+            threshold
+        )
+        if duplicates:
+            logger.info(f"Пропущено дубликатов среди референсов: {len(duplicates)}")
+        return [self.description(path) for path in unique]
+
+# ============================================================================
+# АНАЛИЗ РЕФЕРЕНСОВ
+# ============================================================================
+
+class TermStats:
+    """Взвешенная статистика терминов с быстрым top-k (ленивая куча)"""
+    
+    def __init__(self):
+        self.scores = {}
+        self.heap = []
+    
+    def adjust(self, term, delta, push=True):
+        """Изменение веса термина (push=False - без обновления кучи, для пакетной загрузки)"""
+        score = self.scores.get(term, 0.0) + delta
+        if score <= 1e-9:
+            self.scores.pop(term, None)
+        else:
+            self.scores[term] = score
+            if push:
+                heapq.heappush(self.heap, (-score, term))
+        
+        # Устаревшие записи кучи периодически вычищаются
+        if push and len(self.heap) > 2 * len(self.scores) + 1024:
+            self.rebuild()
+    
+    def rebuild(self):
+        """Перестроение кучи по текущим весам за O(n)"""
+        self.heap = [(-score, term) for term, score in self.scores.items()]
+        heapq.heapify(self.heap)
+    
+    def top(self, k):
+        """k терминов с наибольшим весом: O(k log n) без полного обхода"""
+        result = []
+        popped = []
+        seen = set()
+        while self.heap and len(result) < k:
+            entry = heapq.heappop(self.heap)
+            neg_score, term = entry
+            if term in seen or self.scores.get(term) != -neg_score:
+                continue  # устаревшая запись
+            seen.add(term)
+            popped.append(entry)
+            result.append((term, -neg_score))
+        for entry in popped:
+            heapq.heappush(self.heap, entry)
+        return result
+
+class ReferenceAnalyzer:
+    """Инкрементальный анализ описаний референсов
+    
+    Для каждого поля (positive/negative) описание токенизируется, термины
+    получают нормированный вес tf/длина описания, веса суммируются по всем
+    референсам. Стили учитываются целиком. Добавление и удаление референса
+    обновляет только его термины.
+    """
+    
+    FIELDS = ("positive", "negative")
+    TOKEN_PATTERN = re.compile(r"[^\W\d_]{3,}")
+    STOPWORDS = {
+        "для", "без", "при", "над", "под", "или", "как", "что", "это", "все",
+        "the", "and", "with", "for", "without", "from", "this", "that"
+    }
+    
+    def __init__(self):
+        self.stats = {field: TermStats() for field in self.FIELDS}
+        self.styles = TermStats()
+        self.documents = {}  # image_path -> (веса терминов по полям, стиль)
+    
+    @classmethod
+    def tokenize(cls, text):
+        """Разбиение текста на термины"""
+        return [t for t in cls.TOKEN_PATTERN.findall(text.lower()) if t not in cls.STOPWORDS]
+    
+    @classmethod
+    def term_weights(cls, text):
+        """Нормированные частоты терминов описания"""
+        tokens = cls.tokenize(text)
+        if not tokens:
+            return {}
+        return {term: count / len(tokens) for term, count in Counter(tokens).items()}
+    
+    def add(self, desc, push=True):
+        """Добавление (или замена) референса"""
+        self.remove(desc.image_path)
+        weights = {field: self.term_weights(getattr(desc, field)) for field in self.FIELDS}
+        for field in self.FIELDS:
+            for term, weight in weights[field].items():
+                self.stats[field].adjust(term, weight, push)
+        self.styles.adjust(desc.style, 1.0, push)
+        self.documents[desc.image_path] = (weights, desc.style)
+    
+    def add_many(self, descs):
+        """Пакетное добавление: кучи строятся один раз в конце"""
+        for desc in descs:
+            self.add(desc, push=False)
+        for stats in list(self.stats.values()) + [self.styles]:
+            stats.rebuild()
+    
+    def remove(self, image_path):
+        """Удаление референса"""
+        document = self.documents.pop(image_path, None)
+        if not document:
+            return
+        weights, style = document
+        for field in self.FIELDS:
+            for term, weight in weights[field].items():
+                self.stats[field].adjust(term, -weight)
+        self.styles.adjust(style, -1.0)
+    
+    def top_terms(self, field, k=None):
+        """Самые значимые термины поля"""
+        return self.stats[field].top(k or Config.PROMPT_TOP_TERMS)
+    
+    def top_style(self):
+        """Самый частый стиль"""
+        top = self.styles.top(1)
+        return top[0][0] if top else None
+    
+    def __len__(self):
+        return len(self.documents)
+
+# ============================================================================
+# АПСКЕЙЛ ИЗОБРАЖЕНИЙ
+# ============================================================================
+
+class TiledUpscaler:
+    """Тайловый апскейл с плавной склейкой перекрытий
+    
+    Тайлы одной полосы обрабатываются в пуле потоков и смешиваются линейными
+    весами в зоне перекрытия. Готовые строки сразу пишутся в файл на диске
+    (memmap), поэтому в памяти находится только одна полоса тайлов, а не
+    все увеличенное изображение.
+    """
+    
+    def __init__(self, scale_factor=2, tile_size=None, overlap=None, sharpen=None, max_workers=None):
+        self.scale = int(scale_factor)
+        self.tile_size = tile_size or Config.UPSCALE_TILE_SIZE
+        overlap = Config.UPSCALE_TILE_OVERLAP if overlap is None else overlap
+        self.overlap = max(0, min(overlap, self.tile_size // 4))
+        self.sharpen = Config.UPSCALE_SHARPEN if sharpen is None else sharpen
+        self.max_workers = max_workers or Config.IMAGE_WORKERS
+    
+    def boundaries(self, length):
+        """Границы тайлов по одной оси (последний тайл не короче двух перекрытий)"""
+        starts = list(range(0, length, self.tile_size))
+        if len(starts) > 1 and length - starts[-1] <= 2 * self.overlap:
+            starts.pop()
+        return starts + [length]
+    
+    def ramp(self, length, left, right):
+        """Веса тайла по одной оси: линейный подъем/спад в зонах перекрытия"""
+        weights = np.ones(length, dtype=np.float32)
+        band = 2 * self.overlap * self.scale
+        if band:
+            rise = (np.arange(band, dtype=np.float32) + 0.5) / band
+            if left:
+                weights[:band] = rise
+            if right:
+                weights[-band:] = rise[::-1]
+        return weights
+    
+    def upscale_tile(self, source, x0, x1, y0, y1):
+        """Увеличение одного тайла с контекстом перекрытия"""
+        height, width = source.shape[:2]
+        ox0, ox1 = max(0, x0 - self.overlap), min(width, x1 + self.overlap)
+        oy0, oy1 = max(0, y0 - self.overlap), min(height, y1 + self.overlap)
+        
+        tile = cv2.resize(
+            source[oy0:oy1, ox0:ox1],
+            ((ox1 - ox0) * self.scale, (oy1 - oy0) * self.scale),
+            interpolation=cv2.INTER_LANCZOS4
+        )
+        if self.sharpen:
+            blurred = cv2.GaussianBlur(tile, (0, 0), sigmaX=self.scale)
+            tile = cv2.addWeighted(tile, 1 + Config.UPSCALE_SHARPEN_AMOUNT,
+                                   blurred, -Config.UPSCALE_SHARPEN_AMOUNT, 0)
+        
+        weights = np.outer(
+            self.ramp((oy1 - oy0) * self.scale, oy0 > 0, oy1 < height),
+            self.ramp((ox1 - ox0) * self.scale, ox0 > 0, ox1 < width)
+        )
+        return ox0, oy0, tile.astype(np.float32) * weights[:, :, None]
+    
+    def upscale(self, image_path, output_path):
+        """Апскейл файла; результат записывается атомарно"""
+        source = cv2.imread(str(image_path), cv2.IMREAD_COLOR)
+        if source is None:
+            source = cv2.cvtColor(np.asarray(Image.open(image_path).convert('RGB')), cv2.COLOR_RGB2BGR)
+        
+        height, width = source.shape[:2]
+        out_width, out_height = width * self.scale, height * self.scale
+        xs, ys = self.boundaries(width), self.boundaries(height)
+        s, ov = self.scale, self.overlap
+        
+        output_path = Path(output_path)
+        raw_path = Config.TEMP_DIR / f"upscale_{Utils.generate_id()}.raw"
+        tmp_path = output_path.with_name(f"{output_path.stem}.partial{output_path.suffix}")
+        raw_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        try:
+            output = np.memmap(raw_path, dtype=np.uint8, mode='w+', shape=(out_height, out_width, 3))
+            carry = None
+            
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for row in range(len(ys) - 1):
+                    y0, y1 = ys[row], ys[row + 1]
+                    last_row = row == len(ys) - 2
+                    strip_start = max(0, y0 - ov) * s
+                    strip_end = min(height, y1 + ov) * s
+                    strip = np.zeros((strip_end - strip_start, out_width, 3), dtype=np.float32)
+                    
+                    # Нижнее перекрытие предыдущей полосы
+                    if carry is not None:
+                        strip[:len(carry)] += carry
+                    
+                    futures = [
+                        executor.submit(self.upscale_tile, source, xs[col], xs[col + 1], y0, y1)
+                        for col in range(len(xs) - 1)
+                    ]
+                    for future in futures:
+                        ox0, oy0, tile = future.result()
+                        top = oy0 * s - strip_start
+                        left = ox0 * s
+                        strip[top:top + tile.shape[0], left:left + tile.shape[1]] += tile
+                    
+                    # Строки, в которые не попадет следующая полоса, готовы
+                    done_end = out_height if last_row else (y1 - ov) * s
+                    ready = done_end - strip_start
+                    output[strip_start:done_end] = np.clip(strip[:ready] + 0.5, 0, 255).astype(np.uint8)
+                    carry = strip[ready:] if not last_row else None
+            
+            output.flush()
+            if not cv2.imwrite(str(tmp_path), output):
+                raise IOError(f"Не удалось записать {tmp_path}")
+            del output
+            os.replace(tmp_path, output_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+            raw_path.unlink(missing_ok=True)
+        
+        return str(output_path)
+
+# ============================================================================
+# ГЕНЕРАЦИЯ ИЗОБРАЖЕНИЙ
+# ============================================================================
+
+class ImageGenerator:
+    """Генерация изображений с помощью ИИ"""
+    
+    # Версия локального рендера (render_test_image): увеличивается при каждом
+    # изменении картинки, чтобы кэш не отдавал варианты старого рендера
+    RENDER_VERSION = 2
+    
+    def __init__(self):
+        # Референсы загружаются лениво при первом обращении
+        self.reference_index = None
+        self.loaded_references = None
+        self.analyzer = ReferenceAnalyzer()
+        # Удаленный генератор: callable(image_path, prompt, variant_num, width, height)
+        self.remote_generator = None
+        self.api_client = None
+        self.image_cache = ImageCache()
+        if Config.IMAGE_API_PROVIDER:
+            self.set_api_client(API_CLIENTS[Config.IMAGE_API_PROVIDER]())
+    
+    def set_api_client(self, client):
+        """Подключение клиента API (None - локальный рендер)"""
+        if self.api_client and self.api_client is not client:
+            self.api_client.close()
+        self.api_client = client
+        self.remote_generator = client.generate_to_file if client else None
+    
+    @property
+    def reference_images(self):
+        """Список референсов (загружается при первом обращении)"""
+        if self.loaded_references is None:
+            self.load_reference_images()
+        return self.loaded_references
+    
+    def load_reference_images(self):
+        """Загрузка референсных изображений (повторно читаются только измененные)"""
+        first_load = self.reference_index is None
+        if first_load:
+            self.reference_index = ReferenceIndex()
+        added, removed = self.reference_index.scan()
+        if Config.DEDUP_ENABLED:
+            self.loaded_references = self.reference_index.deduplicated()
+        else:
+            self.loaded_references = self.reference_index.descriptions()
+        loaded_paths = {desc.image_path for desc in self.loaded_references}
+        
+        # Статистика анализа обновляется только по изменившимся референсам
+        if first_load:
+            self.analyzer.add_many(self.loaded_references)
+        else:
+            for path in removed:
+                self.analyzer.remove(path)
+            # Референсы, ставшие дубликатами, исключаются из анализа
+            for path in list(self.analyzer.documents):
+                if path not in loaded_paths:
+                    self.analyzer.remove(path)
+            changed = set(added)
+            for desc in self.loaded_references:
+                if desc.image_path in changed or desc.image_path not in self.analyzer.documents:
+                    self.analyzer.add(desc)
+        return self.loaded_references
+    
+    def analyze_references(self):
+        """Анализ референсных изображений для создания промпта"""
+        if not self.reference_images:
+            return {
+                'positive': 'красивое, детализированное изображение',
+                'negative': 'размытость, артефакты',
+                'style': 'цифровое искусство'
+            }
+        
+        positive = self.analyzer.top_terms("positive")
+        negative = self.analyzer.top_terms("negative")
+        
+        return {
+            'positive': ', '.join(term for term, _ in positive) or 'красивое, детализированное изображение',
+            'negative': ', '.join(term for term, _ in negative) or 'размытость, артефакты',
+            'style': self.analyzer.top_style() or 'цифровое искусство'
+        }
+    
+    def generate_prompt(self, analysis):
+        """Создание промпта на основе анализа"""
+        prompt = Config.IMAGE_GENERATION_PROMPT_TEMPLATE.format(
+            style=analysis['style'],
+            positive=analysis['positive'],
+            negative=analysis['negative']
+        )
+        return prompt
+    
+    def generate_images(self, task_id, num_variants=4, max_workers=None, on_variant=None):
+        """Генерация вариантов изображений (параллельно)
+        
+        Локальный рендер выполняется в пуле процессов, удаленная генерация
+        (если задан self.remote_generator) - в пуле потоков с ограничением
+        Config.API_MAX_CONCURRENCY. on_variant(index, path) вызывается по мере
+        готовности каждого варианта.
+        """
+        task_manager = TaskManager()
+        output_dir = Config.TEMP_DIR / task_id / "generated_images"
+        output_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Обновление статуса задачи
+        task_manager.update_task(task_id, status="processing", progress=10)
+        
+        # Анализ референсов
+        analysis = self.analyze_references()
+        prompt = self.generate_prompt(analysis)
+        
+        print(f"\nСгенерированный промпт: {Utils.color_text(prompt, 'cyan')}")
+        
+        results = {}
+        done = 0
+        
+        def report(i, image_path, source="Сгенерирован"):
+            results[i] = str(image_path)
+            print(f"{source} вариант {i+1}")
+            task_manager.update_task(task_id, progress=10 + (done * 80 / num_variants))
+            task_manager.add_step(task_id, f"Генерация варианта {i+1}", str(image_path))
+            if on_variant:
+                on_variant(i, str(image_path))
+        
+        # Варианты из кэша не генерируются повторно
+        keys = {
+            i: self.image_cache.make_key(
+                "generate",
+                prompt=prompt,
+                style=analysis['style'],
+                variant=i,
+                width=Config.IMAGE_WIDTH,
+                height=Config.IMAGE_HEIGHT,
+                provider=Config.IMAGE_API_PROVIDER or "local",
+                renderer=None if Config.IMAGE_API_PROVIDER else self.RENDER_VERSION
+            )
+            for i in range(num_variants)
+        }
+        pending = []
+        for i in range(num_variants):
+            image_path = output_dir / f"variant_{i+1}.jpg"
+            if self.image_cache.get(keys[i], image_path):
+                done += 1
+                report(i, image_path, "Из кэша взят")
+            else:
+                pending.append(i)
+        
+        if not pending:
+            Utils.print_success("Все варианты найдены в кэше, генерация пропущена")
+        
+        for i, image_path, error in self.iter_variants(prompt, output_dir, pending, max_workers):
+            done += 1
+            
+            if error:
+                task_manager.update_task(task_id, progress=10 + (done * 80 / num_variants))
+                logger.error(f"Ошибка генерации варианта {i+1}: {error}")
+                Utils.print_error(f"Вариант {i+1} не сгенерирован")
+                task_manager.add_step(task_id, f"Ошибка генерации варианта {i+1}", str(error))
+                continue
+            
+            self.image_cache.put(keys[i], image_path)
+            report(i, image_path)
+        
+        stats = self.image_cache.stats()
+        logger.info(f"Кэш изображений: попаданий {stats['hits']}, промахов {stats['misses']}")
+        
+        generated_images = [results[i] for i in sorted(results)]
+        
+        # Почти одинаковые варианты отбрасываются до апскейла и кодирования видео
+        if Config.DEDUP_ENABLED and len(generated_images) > 1:
+            hashes = PerceptualHash.compute(generated_images)
+            generated_images, duplicates = HashIndex.deduplicate(list(zip(generated_images, hashes)))
+            for duplicate, original in duplicates.items():
+                print(f"Вариант {Path(duplicate).name} почти совпадает с {Path(original).name}, пропущен")
+                task_manager.add_step(task_id, "Пропущен дубликат варианта", duplicate)
+        status = "completed" if generated_images else "failed"
+        task_manager.update_task(task_id, status=status, progress=100)
+        return generated_images
+    
+    def iter_variants(self, prompt, output_dir, indices, max_workers=None):
+        """Генерация вариантов с выдачей (index, path, error) по мере готовности"""
+        jobs = [(i, Path(output_dir) / f"variant_{i+1}.jpg") for i in indices]
+        if not jobs:
+            return
+        
+        if self.remote_generator:
+            workers = min(max_workers or Config.API_MAX_CONCURRENCY, Config.API_MAX_CONCURRENCY)
+            make_executor = concurrent.futures.ThreadPoolExecutor
+            func = self.remote_generator
+        else:
+            workers = max_workers or Config.IMAGE_WORKERS
+            make_executor = concurrent.futures.ProcessPoolExecutor
+            func = ImageGenerator.render_test_image
+        
+        workers = max(1, min(workers, len(jobs)))
+        args = lambda i, path: (path, prompt, i, Config.IMAGE_WIDTH, Config.IMAGE_HEIGHT)
+        
+        # Один вариант или один воркер - без накладных расходов на пул
+        if workers == 1:
+            for i, path in jobs:
+                try:
+                    func(*args(i, path))
+                    yield i, path, None
+                except Exception as e:
+                    yield i, path, e
+            return
+        
+        try:
+            executor = make_executor(max_workers=workers)
+        except (OSError, NotImplementedError) as e:
+            logger.warning(f"Пул процессов недоступен ({e}), используются потоки")
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        
+        with executor:
+            futures = {executor.submit(func, *args(i, path)): (i, path) for i, path in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                i, path = futures[future]
+                try:
+                    future.result()
+                    yield i, path, None
+                except Exception as e:
+                    yield i, path, e
+    
+    def create_test_image(self, image_path, prompt, variant_num):
+        """Создание тестового изображения (заглушка для демо)"""
+        return self.render_test_image(image_path, prompt, variant_num,
+                                      Config.IMAGE_WIDTH, Config.IMAGE_HEIGHT)
+    
+    @staticmethod
+    def render_test_image(image_path, prompt, variant_num, width, height):
+        """Рендер тестового изображения (выполняется в пуле процессов)"""
+        # В реальном проекте здесь вызов API для генерации
+        # Сейчас создаем просто цветной прямоугольник с текстом
+        
+        img = Image.new('RGB', (width, height), 
+                       color=((variant_num*50) % 256, (100 + variant_num*30) % 256, 150))
+        draw = ImageDraw.Draw(img)
+        
+        # Фигура в разных местах, чтобы варианты различались не только цветом
+        radius = height // 4
+        cx = width * (variant_num % 4 + 1) // 5
+        cy = height // 4 if (variant_num // 4) % 2 == 0 else height * 3 // 4
+        draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius),
+                     fill=(255 - (variant_num * 40) % 256, 200, (variant_num * 70) % 256))
+        
+        # Простой текст для демонстрации
+        try:
+            font = ImageFont.load_default()
+        except:
+            font = None
+        
+        # Центрируем текст
+        text = f"Вариант {variant_num+1}\n{prompt[:50]}..."
+        if font:
+            left, _, right, _ = draw.multiline_textbbox((0, 0), text, font=font)
+            text_width = right - left
+        else:
+            text_width = 200
+        
+        draw.text(
+            ((width - text_width) // 2, height // 2 - 50),
+            text,
+            fill=(255, 255, 255),
+            font=font
+        )
+        
+        img.save(image_path)
+        return image_path
+    
+    def upscale_image(self, image_path, scale_factor=2):
+        """Улучшение детализации изображения"""
+        task_id = Utils.generate_id()
+        output_path = Path(image_path).parent / f"upscaled_{Path(image_path).name}"
+        
+        # В реальности здесь был бы вызов API для апскейла (Real-ESRGAN и т.д.)
+        # Для демо просто увеличиваем размер
+        
+        try:
+            cache_key = self.image_cache.make_key(
+                "upscale",
+                source=Utils.file_hash(image_path),
+                scale=scale_factor,
+                sharpen=Config.UPSCALE_SHARPEN and Config.UPSCALE_SHARPEN_AMOUNT
+            )
+            if self.image_cache.get(cache_key, output_path):
+                print(f"Улучшенное изображение взято из кэша: {output_path}")
+                return str(output_path)
+            
+            TiledUpscaler(scale_factor).upscale(image_path, output_path)
+            self.image_cache.put(cache_key, output_path)
+            
+            print(f"Изображение улучшено: {output_path}")
+            return str(output_path)
+        except Exception as e:
+            logger.error(f"Ошибка апскейла: {e}")
+            return None
+
+# ============================================================================
+# МЕТАДАННЫЕ МЕДИАФАЙЛОВ
+# ============================================================================
+
+class MediaProbe:
+    """Кэш результатов ffprobe
+    
+    Ключ - (путь, размер, mtime_ns): перезаписанный файл автоматически
+    пробуется заново. Каждое поле файла (потоки/формат, ключевые кадры,
+    число кадров, хэш содержимого) - отдельная строка SQLite в
+    PROBE_CACHE_FILE, поэтому новый результат дописывается без перезаписи
+    всего кэша; пакетные запросы сохраняются одной транзакцией.
+    """
+    
+    LEGACY_CACHE_FILE = Config.BASE_DIR / "probe_cache.json"
+    
+    def __init__(self, cache_file=None, max_workers=None):
+        self.cache_file = Path(cache_file or Config.PROBE_CACHE_FILE)
+        self.max_workers = max_workers or Config.PROBE_WORKERS
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pending = []  # строки, ожидающие flush()
+    
+    def load(self):
+        """Открытие базы кэша (под lock, один раз)"""
+        if self.conn is not None:
+            return
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.cache_file), timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS probe (
+                    path TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (path, field)
+                )
+            """)
+        self.import_json(self.LEGACY_CACHE_FILE)
+    
+    def import_json(self, json_path):
+        """Однократный перенос кэша из старого probe_cache.json"""
+        if not json_path.exists():
+            return
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            rows = [
+                (path, field, entry["size"], entry["mtime_ns"], json.dumps(value))
+                for path, entry in entries.items() if os.path.exists(path)
+                for field, value in entry.items() if field not in ("size", "mtime_ns")
             ]
+            with self.conn:
+                self.conn.executemany("INSERT OR IGNORE INTO probe VALUES (?, ?, ?, ?, ?)", rows)
+            json_path.unlink()
+            logger.info(f"Кэш метаданных перенесен из {json_path}: {len(rows)} записей")
+        except Exception as e:
+            logger.error(f"Ошибка переноса кэша метаданных: {e}")
+    
+    def flush(self):
+        """Сохранение отложенных строк одной транзакцией"""
+        with self.lock:
+            if not self.pending:
+                return
+            rows, self.pending = self.pending, []
+            try:
+                with self.conn:
+                    self.conn.executemany("INSERT OR REPLACE INTO probe VALUES (?, ?, ?, ?, ?)", rows)
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка сохранения кэша метаданных: {e}")
+    
+    def cached(self, path, field, compute, persist=True):
+        """Значение поля из кэша или compute(path) с сохранением
+        
+        При persist=False строка сохраняется при следующем flush().
+        """
+        path = Path(path).resolve()
+        file_stat = path.stat()
+        name = str(path)
+        with self.lock:
+            self.load()
+            for row in reversed(self.pending):
+                if row[:4] == (name, field, file_stat.st_size, file_stat.st_mtime_ns):
+                    return json.loads(row[4])
+            row = self.conn.execute(
+                "SELECT value FROM probe WHERE path = ? AND field = ? AND size = ? AND mtime_ns = ?",
+                (name, field, file_stat.st_size, file_stat.st_mtime_ns)
+            ).fetchone()
+            if row:
+                return json.loads(row[0])
+        
+        value = compute(path)
+        with self.lock:
+            self.pending.append((name, field, file_stat.st_size, file_stat.st_mtime_ns, json.dumps(value)))
+        if persist:
+            self.flush()
+        return value
+    
+    @staticmethod
+    def run_ffprobe(args, path):
+        """Запуск ffprobe с выводом в JSON"""
+        cmd = ['ffprobe', '-v', 'error'] + args + ['-of', 'json', str(path)]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffprobe: {result.stderr.strip()}")
+        return json.loads(result.stdout)
+    
+    def info(self, path):
+        """Полные сведения о потоках и формате ({"streams": [...], "format": {...}})"""
+        return self.cached(path, "info", lambda p: self.run_ffprobe(['-show_format', '-show_streams'], p))
+    
+    def info_many(self, paths):
+        """Пакетное чтение метаданных: промахи кэша пробуются параллельно"""
+        paths = list(paths)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(
+                lambda p: self.cached(
+                    p, "info", lambda q: self.run_ffprobe(['-show_format', '-show_streams'], q),
+                    persist=False
+                ),
+                paths
+            ))
+        self.flush()
+        return dict(zip(paths, results))
+    
+    @staticmethod
+    def summarize(info):
+        """Основные параметры из сведений ffprobe"""
+        streams = info.get("streams", [])
+        video = next((s for s in streams if s.get("codec_type") == "video"), None)
+        audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+        if not video:
+            raise RuntimeError("Нет видеопотока")
+        num, _, den = video.get("r_frame_rate", "0/1").partition('/')
+        return {
+            "duration": float(info.get("format", {}).get("duration", 0) or 0),
+            "width": int(video["width"]),
+            "height": int(video["height"]),
+            "fps": float(num) / float(den or 1) if float(den or 1) else 0.0,
+            "has_audio": audio is not None,
+            "video": video,
+            "audio": audio
+        }
+    
+    def content_hash(self, path):
+        """SHA-256 содержимого (пересчитывается только при изменении файла)"""
+        return self.cached(path, "sha256", Utils.file_hash)
+    
+    def duration(self, path):
+        """Длительность любого медиафайла, в том числе только со звуком"""
+        return float(self.info(path).get("format", {}).get("duration", 0) or 0)
+    
+    def summary(self, path):
+        """Длительность, размер кадра, частота кадров, наличие звука и сами потоки"""
+        return self.summarize(self.info(path))
+    
+    def keyframes(self, path):
+        """Время ключевых кадров от начала файла (декодируются только ключевые кадры)
+        
+        pts_time отсчитывается от нуля временной шкалы, а -ss перед -i - от
+        format.start_time, который у MPEG-TS и mp4 без edit list не равен
+        нулю; поэтому start_time вычитается.
+        """
+        def compute(p):
+            try:
+                data = self.run_ffprobe(
+                    ['-select_streams', 'v:0', '-skip_frame', 'nokey', '-show_entries', 'frame=pts_time'], p
+                )
+            except RuntimeError:
+                return []
+            start_time = float(self.info(p).get("format", {}).get("start_time", 0) or 0)
+            return sorted(max(0.0, float(f["pts_time"]) - start_time)
+                          for f in data.get("frames", []) if "pts_time" in f)
+        # Новое имя поля: в кэше могли остаться абсолютные времена
+        return self.cached(path, "keyframe_offsets", compute)
+    
+    def frame_count(self, path):
+        """Число кадров и длительность видео (подсчет пакетов без декодирования)"""
+        packets = self.cached(path, "packets", lambda p: int(self.run_ffprobe(
+            ['-select_streams', 'v:0', '-count_packets', '-show_entries', 'stream=nb_read_packets'], p
+        )["streams"][0]["nb_read_packets"]))
+        return packets, self.summary(path)["duration"]
+
+# Общий кэш метаданных процесса
+media_probe = MediaProbe()
+
+# ============================================================================
+# ЗАПУСК FFMPEG
+# ============================================================================
+
+class FFmpegRunner:
+    """Общий запуск FFmpeg
+    
+    - прогресс читается из -progress через отдельный канал и передается
+      в TaskManager; у параллельных запусков одной группы (фрагменты
+      SegmentedEncoder) прогресс общий - доля суммарного выполненного
+      времени; stderr хранится только последними строками;
+    - все запуски делят бюджет ядер FFMPEG_CORE_BUDGET: -threads
+      ограничивается выделенными ядрами, лишние задания ждут в очереди
+      по порядку поступления;
+    - таймаут и отмена завершают процесс и удаляют недописанные файлы;
+    - для каждой команды записываются время, CPU и пиковая память.
+    """
+    
+    def __init__(self, core_budget=None):
+        self.core_budget = max(1, core_budget or Config.FFMPEG_CORE_BUDGET)
+        self.free_cores = self.core_budget
+        self.condition = threading.Condition()
+        self.next_ticket = 0
+        self.serving_ticket = 0
+        self.jobs = {}  # pid -> {"process", "cancelled"}
+        self.jobs_lock = threading.Lock()
+        self.history = deque(maxlen=Config.FFMPEG_HISTORY_SIZE)
+        self.local = threading.local()  # задача и группа прогресса текущего потока
+    
+    @contextmanager
+    def cores(self, count=None):
+        """Выделение ядер из общего бюджета (очередь по порядку поступления)"""
+        count = max(1, min(count or self.core_budget, self.core_budget))
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while ticket != self.serving_ticket or self.free_cores < count:
+                self.condition.wait()
+            self.serving_ticket += 1
+            self.free_cores -= count
+            self.condition.notify_all()
+        try:
+            yield count
+        finally:
+            with self.condition:
+                self.free_cores += count
+                self.condition.notify_all()
+    
+    @contextmanager
+    def report_to(self, task_manager, task_id):
+        """Передавать прогресс запусков текущего потока в задачу
+        
+        Привязка действует только в вызывающем потоке: запуски из других
+        потоков получают задачу через группу прогресса (progress_group).
+        """
+        previous = getattr(self.local, "target", None)
+        self.local.target = (task_manager, task_id) if task_manager and task_id else None
+        try:
+            yield
+        finally:
+            self.local.target = previous
+    
+    @contextmanager
+    def progress_group(self, total, progress_range=(0.0, 100.0)):
+        """Группа параллельных запусков с общим прогрессом
+        
+        total - суммарная длительность работы группы в секундах; запуски
+        выполняются в группе через in_group().
+        """
+        yield {
+            "total": total,
+            "range": progress_range,
+            "target": getattr(self.local, "target", None),
+            "done": {},
+            "lock": threading.Lock()
+        }
+    
+    def in_group(self, group, func, *args, **kwargs):
+        """Вызов func в потоке, запуски которого относятся к группе"""
+        previous = getattr(self.local, "group", None)
+        self.local.group = group
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.local.group = previous
+    
+    @staticmethod
+    def with_threads(cmd, threads):
+        """Ограничение -threads выделенными ядрами (0 - «все» - тоже ограничивается)"""
+        cmd = list(cmd)
+        indices = [i for i, arg in enumerate(cmd[:-1]) if arg == '-threads']
+        for i in indices:
+            value = int(cmd[i + 1])
+            if value == 0 or value > threads:
+                cmd[i + 1] = str(threads)
+        if not indices:
+            cmd[-1:-1] = ['-threads', str(threads)]
+        return cmd
+    
+    @contextmanager
+    def track(self, processes, timeout=None):
+        """Учет процессов, запущенных в обход run(); запись задания
+        
+        Процессы отменяются вместе с остальными (cancel_all), а при отмене
+        или по истечении timeout секунд завершаются сторожевым потоком, даже
+        если вызывающий поток ждет их вывода. Запись задания:
+        {"process", "cancelled", "timed_out"}.
+        """
+        job = {"process": processes[0], "cancelled": False, "timed_out": False}
+        start = time.monotonic()
+        finished = threading.Event()
+        
+        def watch():
+            while not finished.wait(0.05):
+                if job["cancelled"] or (timeout and time.monotonic() - start > timeout):
+                    job["timed_out"] = not job["cancelled"]
+                    for process in processes:
+                        if process.poll() is None:
+                            process.terminate()
+                    return
+        
+        with self.jobs_lock:
+            for process in processes:
+                self.jobs[process.pid] = job
+        watcher = threading.Thread(target=watch, name="ffmpeg-watch", daemon=True)
+        watcher.start()
+        try:
+            yield job
+        finally:
+            finished.set()
+            watcher.join()
+            with self.jobs_lock:
+                for process in processes:
+                    self.jobs.pop(process.pid, None)
+    
+    def cancel_all(self):
+        """Отмена всех выполняющихся команд"""
+        with self.jobs_lock:
+            for job in self.jobs.values():
+                job["cancelled"] = True
+    
+    def report_progress(self, seconds, duration, progress_range=(0.0, 100.0), slot=None, group=None,
+                        target=None):
+        """Передача доли выполненной работы в задачу
+        
+        target - (task_manager, task_id), по умолчанию задача текущего потока
+        (см. report_to). В группе (по умолчанию - группа текущего потока, см.
+        in_group) выполненное время запуска slot суммируется с остальными
+        запусками группы, а задача и progress_range группы заменяют свои.
+        """
+        if not duration:
+            return
+        seconds = min(max(seconds, 0.0), duration)
+        group = group or getattr(self.local, "group", None)
+        if group:
+            with group["lock"]:
+                group["done"][slot] = seconds
+                done = sum(group["done"].values())
+            target, progress_range = group["target"], group["range"]
+            fraction = done / group["total"] if group["total"] else 1.0
+        else:
+            target = target or getattr(self.local, "target", None)
+            fraction = seconds / duration
+        if not target:
+            return
+        task_manager, task_id = target
+        low, high = progress_range
+        task_manager.update_task(task_id, progress=round(low + (high - low) * min(1.0, fraction), 1))
+    
+    def run(self, cmd, duration=None, threads=None, timeout=None, outputs=None,
+            capture_stdout=False, progress_range=(0.0, 100.0)):
+        """Запуск команды FFmpeg; возвращает FFmpegResult
+        
+        duration - ожидаемая длительность результата в секундах (для
+        прогресса); threads - сколько ядер нужно (None - весь бюджет);
+        outputs - файлы, удаляемые при ошибке, отмене или таймауте
+        (по умолчанию последний аргумент команды).
+        """
+        if outputs is None:
+            outputs = [] if cmd[-1] == '-' or str(cmd[-1]).startswith('pipe:') else [cmd[-1]]
+        
+        with self.cores(threads) as granted:
+            cmd = self.with_threads(cmd, granted)
+            read_fd, write_fd = os.pipe()
+            cmd = [cmd[0], '-nostats', '-progress', f'pipe:{write_fd}'] + [str(arg) for arg in cmd[1:]]
+            
+            start = time.monotonic()
+            try:
+                process = subprocess.Popen(
+                    cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    pass_fds=(write_fd,)
+                )
+            finally:
+                os.close(write_fd)
+            
+            job = {"process": process, "cancelled": False}
+            with self.jobs_lock:
+                self.jobs[process.pid] = job
+            
+            stderr_tail = deque(maxlen=Config.FFMPEG_STDERR_LINES)
+            stdout_chunks = []
+            # Прогресс читает другой поток, поэтому задача и группа запоминаются здесь
+            group = getattr(self.local, "group", None)
+            target = getattr(self.local, "target", None)
+            slot = object()  # доля этого запуска в группе прогресса
+            state = {"speed": 0.0, "fps": 0.0}
+            
+            def read_stderr():
+                for line in iter(process.stderr.readline, b''):
+                    stderr_tail.append(line.decode(errors='replace').rstrip())
+            
+            def read_stdout():
+                for chunk in iter(lambda: process.stdout.read(1024 * 1024), b''):
+                    stdout_chunks.append(chunk)
+            
+            def read_progress():
+                with os.fdopen(read_fd, 'r', errors='replace') as progress:
+                    seconds = 0.0
+                    for line in progress:
+                        key, _, value = line.strip().partition('=')
+                        try:
+                            if key == 'out_time_us':
+                                seconds = int(value) / 1e6
+                            elif key == 'speed' and value.endswith('x'):
+                                state["speed"] = float(value[:-1])
+                            elif key == 'fps':
+                                state["fps"] = float(value)
+                            elif key == 'progress':
+                                if value == 'end' and duration:
+                                    seconds = duration
+                                self.report_progress(seconds, duration, progress_range, slot=slot, group=group,
+                                                     target=target)
+                        except ValueError:
+                            continue
+            
+            readers = [threading.Thread(target=read_stderr, daemon=True),
+                       threading.Thread(target=read_progress, daemon=True)]
+            if capture_stdout:
+                readers.append(threading.Thread(target=read_stdout, daemon=True))
+            for reader in readers:
+                reader.start()
+            
+            timed_out = False
+            try:
+                while True:
+                    pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+                    if pid:
+                        break
+                    if job["cancelled"] or (timeout and time.monotonic() - start > timeout):
+                        timed_out = not job["cancelled"]
+                        pid, status, usage = self.stop(process)
+                        break
+                    time.sleep(0.05)
+            except KeyboardInterrupt:
+                job["cancelled"] = True
+                self.stop(process)
+                process.returncode = -1
+                self.cleanup(outputs)
+                raise
+            finally:
+                with self.jobs_lock:
+                    self.jobs.pop(process.pid, None)
+            
+            process.returncode = os.waitstatus_to_exitcode(status)
+            for reader in readers:
+                reader.join()
+            elapsed = time.monotonic() - start
+        
+        result = FFmpegResult(
+            returncode=process.returncode,
+            stderr="\n".join(stderr_tail),
+            stdout=b"".join(stdout_chunks),
+            elapsed=elapsed,
+            cpu_user=usage.ru_utime,
+            cpu_system=usage.ru_stime,
+            max_rss_kb=usage.ru_maxrss,
+            threads=granted,
+            speed=state["speed"],
+            fps=state["fps"],
+            cancelled=job["cancelled"],
+            timed_out=timed_out
+        )
+        if result.returncode != 0:
+            self.cleanup(outputs)
+            if result.cancelled or result.timed_out:
+                result.stderr += "\nОтменено" if result.cancelled else f"\nПревышен таймаут {timeout} с"
+        
+        self.history.append({
+            "command": " ".join(cmd[:12]),
+            "returncode": result.returncode,
+            "elapsed": round(elapsed, 3),
+            "cpu_user": result.cpu_user,
+            "cpu_system": result.cpu_system,
+            "max_rss_kb": result.max_rss_kb,
+            "threads": granted,
+            "speed": result.speed
+        })
+        logger.info(f"FFmpeg: {elapsed:.2f} с, CPU {result.cpu_user + result.cpu_system:.2f} с, "
+                    f"память {result.max_rss_kb // 1024} МБ, потоков {granted}, код {result.returncode}")
+        return result
+    
+    @staticmethod
+    def stop(process):
+        """Мягкое завершение процесса, затем принудительное; (pid, status, rusage)"""
+        process.terminate()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                return pid, status, usage
+            time.sleep(0.05)
+        process.kill()
+        return os.wait4(process.pid, 0)
+    
+    @staticmethod
+    def cleanup(outputs):
+        """Удаление недописанных файлов"""
+        for path in outputs:
+            try:
+                Path(path).unlink(missing_ok=True)
+            except (OSError, ValueError):
+                continue
+
+# Общий запуск FFmpeg процесса
+ffmpeg_runner = FFmpegRunner()
+
+# ============================================================================
+# ПАРАЛЛЕЛЬНОЕ КОДИРОВАНИЕ ФРАГМЕНТАМИ
+# ============================================================================
+
+class SegmentedEncoder:
+    """Кодирование видео фрагментами на всех ядрах
+    
+    Временная шкала делится по ключевым кадрам источника, фрагменты
+    кодируются параллельно (у каждого FFmpeg свой лимит потоков), затем
+    склеиваются без перекодирования и проверяются по числу кадров и
+    длительности.
+    """
+    
+    def __init__(self, workers=None, segment_seconds=None):
+        self.workers = workers or Config.ENCODE_WORKERS
+        self.segment_seconds = segment_seconds or Config.SEGMENT_SECONDS
+        # Потоки делятся между кодерами, чтобы не перегружать процессор
+        self.threads = max(1, (os.cpu_count() or 1) // self.workers)
+    
+    def plan(self, total_frames, fps, keyframes=None):
+        """Разбиение на фрагменты; при наличии ключевых кадров - только по ним"""
+        step = self.segment_seconds
+        if keyframes:
+            starts = [0.0]
+            for t in keyframes:
+                if t - starts[-1] >= step:
+                    starts.append(t)
+        else:
+            starts = [i * step for i in range(int(np.ceil(total_frames / fps / step)) or 1)]
+        
+        segments = []
+        first_frames = [round(t * fps) for t in starts] + [total_frames]
+        for i, start in enumerate(starts):
+            frames = min(first_frames[i + 1], total_frames) - first_frames[i]
+            if frames > 0:
+                segments.append(VideoSegment(index=len(segments), start=start, frames=frames))
+        return segments
+    
+    def run(self, segments, output_path, encode_segment, fps):
+        """Кодирование фрагментов, склейка и проверка результата
+        
+        encode_segment(segment, segment_path, threads) -> bool
+        """
+        output_path = Path(output_path)
+        expected_frames = sum(seg.frames for seg in segments)
+        work_dir = Config.TEMP_DIR / f"segments_{Utils.generate_id()}"
+        work_dir.mkdir(parents=True, exist_ok=True)
+        paths = [work_dir / f"segment_{seg.index:05d}.mp4" for seg in segments]
+        
+        try:
+            # Одиночный фрагмент получает все потоки
+            threads = self.threads if len(segments) > 1 else 0
+            workers = max(1, min(self.workers, len(segments)))
+            # Общий прогресс фрагментов - доля закодированного времени; склейка - последние 10%
+            with ffmpeg_runner.progress_group(expected_frames / fps, (0.0, 90.0)) as group, \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(ffmpeg_runner.in_group, group, encode_segment, seg, path, threads)
+                           for seg, path in zip(segments, paths)]
+                results = [future.result() for future in futures]
+            
+            if not all(results):
+                print("Ошибка кодирования фрагментов")
+                return False
+            
+            if len(paths) == 1:
+                shutil.move(str(paths[0]), str(output_path))
+            else:
+                concat_file = work_dir / "segments.txt"
+                with open(concat_file, 'w') as f:
+                    for path in paths:
+                        f.write(f"file '{path}'\n")
+                cmd = [
+                    'ffmpeg', '-y', '-v', 'error',
+                    '-f', 'concat',
+                    '-safe', '0',
+                    '-i', str(concat_file),
+                    '-c', 'copy',
+                    str(output_path)
+                ]
+                result = ffmpeg_runner.run(cmd, duration=expected_frames / fps, threads=1,
+                                           progress_range=(90.0, 100.0))
+                if result.returncode != 0:
+                    print(f"Ошибка склейки фрагментов: {result.stderr}")
+                    return False
+            
+            return self.verify(output_path, expected_frames, fps)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    def verify(self, output_path, expected_frames, fps):
+        """Проверка числа кадров и длительности результата"""
+        frames, duration = media_probe.frame_count(output_path)
+        expected_duration = expected_frames / fps
+        if frames != expected_frames or abs(duration - expected_duration) > 2 / fps:
+            print(f"Проверка не пройдена: кадров {frames} из {expected_frames}, "
+                  f"длительность {duration:.3f} с вместо {expected_duration:.3f} с")
+            return False
+        return True
+
+# ============================================================================
+# АВТОПОДБОР ПАРАМЕТРОВ КОДИРОВАНИЯ
+# ============================================================================
+
+class EncoderTuner:
+    """Подбор самого быстрого preset/CRF, дающего нужное качество
+    
+    Пробный фрагмент кодируется без потерь как эталон, затем кодируется с
+    разными настройками; SSIM и PSNR считаются фильтрами FFmpeg. Результат
+    кэшируется по типу контента и разрешению.
+    """
+    
+    def __init__(self, profiles_file=None):
+        self.profiles_file = Path(profiles_file or Config.ENCODER_PROFILES_FILE)
+        self.lock = threading.Lock()
+        self.profiles = {}
+        if self.profiles_file.exists():
+            try:
+                with open(self.profiles_file, 'r', encoding='utf-8') as f:
+                    self.profiles = json.load(f)
+            except Exception as e:
+                logger.error(f"Ошибка загрузки профилей кодирования: {e}")
+    
+    def save_profiles(self):
+        """Атомарное сохранение профилей"""
+        try:
+            self.profiles_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.profiles_file.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.profiles, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.profiles_file)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения профилей кодирования: {e}")
+    
+    def settings(self, content_type, width, height, default, reference_args, extra_args=()):
+        """(preset, crf) для контента: из кэша, подбором или по умолчанию
+        
+        reference_args - входные аргументы FFmpeg для пробного фрагмента
+        (должны давать кадры в целевом разрешении).
+        """
+        key = f"{content_type}:{width}x{height}"
+        with self.lock:
+            profile = self.profiles.get(key)
+            if profile:
+                return profile["preset"], profile["crf"]
+            if not Config.ENCODER_TUNING:
+                return default
+            
+            print(f"Подбор параметров кодирования для {key}...")
+            profile = self.tune(reference_args, extra_args)
+            if not profile:
+                return default
+            profile["tuned_at"] = Utils.get_timestamp()
+            self.profiles[key] = profile
+            self.save_profiles()
+        
+        print(f"Выбрано: preset={profile['preset']}, crf={profile['crf']} "
+              f"(SSIM {profile['ssim']:.4f}, PSNR {profile['psnr']:.1f} дБ)")
+        return profile["preset"], profile["crf"]
+    
+    @staticmethod
+    def measure(encoded_path, reference_path):
+        """SSIM (All) и PSNR (average) закодированного фрагмента относительно эталона"""
+        cmd = [
+            'ffmpeg', '-v', 'info', '-nostats',
+            '-i', str(encoded_path),
+            '-i', str(reference_path),
+            '-lavfi', '[0:v]split[a][b];[1:v]split[c][d];[a][c]ssim;[b][d]psnr',
+            '-f', 'null', '-'
+        ]
+        result = ffmpeg_runner.run(cmd)
+        ssim = re.search(r"SSIM .*All:([\d.]+)", result.stderr)
+        psnr = re.search(r"PSNR .*average:([\d.]+|inf)", result.stderr)
+        if not ssim or not psnr:
+            raise RuntimeError(f"Не удалось измерить качество: {result.stderr[-500:]}")
+        return float(ssim.group(1)), float(psnr.group(1))
+    
+    def tune(self, reference_args, extra_args=()):
+        """Перебор от быстрых preset к медленным; первый preset, достигший цели, выигрывает"""
+        work_dir = Path(tempfile.mkdtemp(prefix="tune_", dir=Config.TEMP_DIR if Config.TEMP_DIR.exists() else None))
+        reference = work_dir / "reference.mkv"
+        try:
+            result = ffmpeg_runner.run(
+                ['ffmpeg', '-y', '-v', 'error'] + list(reference_args) + [
+                    '-pix_fmt', 'yuv420p', '-c:v', 'libx264', '-qp', '0', '-preset', 'ultrafast',
+                    str(reference)
+                ]
+            )
+            if result.returncode != 0:
+                logger.error(f"Ошибка создания эталонного фрагмента: {result.stderr}")
+                return None
+            
+            best = None
+            for preset in Config.TUNING_PRESETS:
+                # Больший CRF быстрее и меньше; берем первый проходящий порог
+                for crf in Config.TUNING_CRFS:
+                    candidate = work_dir / f"{preset}_{crf}.mp4"
+                    result = ffmpeg_runner.run(
+                        ['ffmpeg', '-y', '-v', 'error', '-i', str(reference),
+                         '-c:v', 'libx264', '-preset', preset, '-crf', str(crf),
+                         '-pix_fmt', 'yuv420p'] + list(extra_args) + [str(candidate)]
+                    )
+                    encode_time = result.elapsed
+                    if result.returncode != 0:
+                        continue
+                    
+                    ssim, psnr = self.measure(candidate, reference)
+                    profile = {
+                        "preset": preset,
+                        "crf": crf,
+                        "ssim": ssim,
+                        "psnr": psnr,
+                        "encode_time": round(encode_time, 3),
+                        "size_bytes": candidate.stat().st_size
+                    }
+                    logger.info(f"Пробное кодирование {preset}/crf {crf}: SSIM {ssim:.4f}, "
+                                f"PSNR {psnr:.1f}, {encode_time:.2f} с")
+                    if ssim >= Config.TUNING_TARGET_SSIM:
+                        return profile
+                    # Если цель недостижима, запоминаем лучший по качеству вариант
+                    if not best or ssim > best["ssim"]:
+                        best = profile
+            
+            return best
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+# ============================================================================
+# ПРОВЕРКА СКЛЕЕК
+# ============================================================================
+
+class SeamAnalyzer:
+    """Проверка стыков без декодирования всего файла
+    
+    Для каждого стыка FFmpeg переходит к нему поиском (-ss перед -i) и
+    декодирует несколько уменьшенных кадров в оттенках серого и 0.1 с звука.
+    Метрики считаются векторно через numpy.
+    """
+    
+    def __init__(self, window_frames=None, sample_width=None, max_workers=None):
+        self.window_frames = window_frames or Config.SEAM_WINDOW_FRAMES
+        self.sample_width = sample_width or Config.SEAM_SAMPLE_WIDTH
+        self.max_workers = max_workers or Config.ENCODE_WORKERS
+    
+    @staticmethod
+    def loop_seams(clip_duration, total_duration, max_checks=None):
+        """Стыки зацикленного ролика; при большом числе - равномерная выборка
+        
+        Все стыки копии одного ролика одинаковы, поэтому достаточно проверить
+        первый, последний и несколько между ними.
+        """
+        max_checks = max_checks or Config.SEAM_MAX_CHECKS
+        count = int((total_duration - 1e-6) // clip_duration)
+        if count <= 0:
+            return [], 0
+        indices = np.unique(np.linspace(1, count, min(count, max_checks)).round().astype(int))
+        return [float(i * clip_duration) for i in indices], count
+    
+    def read_frames(self, video_path, info, seam_time):
+        """Уменьшенные серые кадры вокруг стыка: массив (n, h, w)"""
+        width = self.sample_width
+        height = max(2, int(round(info["height"] * width / info["width"] / 2)) * 2)
+        fps = info["fps"] or 30.0
+        start = max(0.0, seam_time - self.window_frames / fps)
+        cmd = [
+            'ffmpeg', '-v', 'error',
+            '-ss', f"{start:.6f}",
+            '-i', str(video_path),
+            '-frames:v', str(self.window_frames * 2),
+            '-vf', f'scale={width}:{height}',
+            '-f', 'rawvideo', '-pix_fmt', 'gray',
+            '-'
+        ]
+        result = ffmpeg_runner.run(cmd, threads=1, capture_stdout=True)
+        frame_size = width * height
+        count = len(result.stdout) // frame_size
+        return np.frombuffer(result.stdout[:count * frame_size], dtype=np.uint8).reshape(count, height, width)
+    
+    @staticmethod
+    def read_audio(video_path, seam_time, span=0.05, rate=48000):
+        """Моно-сэмплы float32 в окне ±span секунд вокруг стыка"""
+        cmd = [
+            'ffmpeg', '-v', 'error',
+            '-ss', f"{max(0.0, seam_time - span):.6f}",
+            '-i', str(video_path),
+            '-t', f"{span * 2:.6f}",
+            '-map', '0:a:0',
+            '-ac', '1', '-ar', str(rate),
+            '-f', 'f32le',
+            '-'
+        ]
+        result = ffmpeg_runner.run(cmd, threads=1, capture_stdout=True)
+        return np.frombuffer(result.stdout, dtype=np.float32)
+    
+    @staticmethod
+    def video_metrics(frames):
+        """(скачок на стыке, отношение к медиане остальных разниц)"""
+        if len(frames) < 2:
+            return 0.0, 0.0
+        diffs = np.abs(np.diff(frames.astype(np.int16), axis=0)).mean(axis=(1, 2))
+        jump_index = int(diffs.argmax())
+        jump = float(diffs[jump_index])
+        rest = np.delete(diffs, jump_index)
+        baseline = float(np.median(rest)) if len(rest) else 0.0
+        return jump, jump / (baseline + 1.0)
+    
+    @staticmethod
+    def audio_metric(samples):
+        """Наибольший скачок между соседними сэмплами относительно среднего изменения"""
+        if len(samples) < 3:
+            return 0.0
+        steps = np.abs(np.diff(samples))
+        mean_step = float(steps.mean())
+        if mean_step < 1e-6:
+            # Тишина: любой заметный скачок - щелчок
+            return float(steps.max()) * 1e4
+        return float(steps.max()) / mean_step
+    
+    def check_seam(self, video_path, info, seam_time):
+        """Проверка одного стыка"""
+        jump, ratio = self.video_metrics(self.read_frames(video_path, info, seam_time))
+        audio_ratio = None
+        if info["has_audio"]:
+            audio_ratio = self.audio_metric(self.read_audio(video_path, seam_time))
+        
+        video_ok = jump <= Config.SEAM_VIDEO_THRESHOLD or ratio <= Config.SEAM_VIDEO_RATIO
+        audio_ok = audio_ratio is None or audio_ratio <= Config.SEAM_AUDIO_RATIO
+        return SeamCheck(
+            time=seam_time,
+            video_jump=round(jump, 2),
+            video_ratio=round(ratio, 2),
+            audio_ratio=None if audio_ratio is None else round(audio_ratio, 2),
+            passed=video_ok and audio_ok
+        )
+    
+    def analyze(self, video_path, seam_times, seams_total=None):
+        """Проверка списка стыков; возвращает отчет со списком SeamCheck"""
+        start = time.monotonic()
+        info = media_probe.summary(video_path)
+        seam_times = [t for t in seam_times if 0 < t < info["duration"]]
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            checks = list(executor.map(
+                lambda t: self.check_seam(video_path, info, t), seam_times
+            ))
+        
+        return {
+            "path": str(video_path),
+            "duration": info["duration"],
+            "seams_total": seams_total if seams_total is not None else len(seam_times),
+            "checks": checks,
+            "passed": all(check.passed for check in checks),
+            "elapsed": time.monotonic() - start
+        }
+    
+    @staticmethod
+    def print_report(report):
+        """Вывод отчета о проверке"""
+        checks = report["checks"]
+        print(f"\nПроверено стыков: {len(checks)} из {report['seams_total']} "
+              f"за {report['elapsed']:.1f} с")
+        for check in checks:
+            mark = Utils.color_text("✓", "green") if check.passed else Utils.color_text("✗", "red")
+            audio = "нет звука" if check.audio_ratio is None else f"звук x{check.audio_ratio}"
+            print(f"  {mark} {datetime.timedelta(seconds=round(check.time, 3))}: "
+                  f"кадр {check.video_jump} (x{check.video_ratio}), {audio}")
+        if not checks:
+            print("Стыков для проверки нет")
+        elif report["passed"]:
+            print(Utils.color_text("✓ Склейка незаметна", "green"))
+        else:
+            failed = sum(1 for check in checks if not check.passed)
+            print(Utils.color_text(f"✗ Заметных стыков: {failed}", "red"))
+
+# ============================================================================
+# ПОИСК ТОЧКИ ЗАЦИКЛИВАНИЯ
+# ============================================================================
+
+class LoopFinder:
+    """Поиск пары кадров, на которой короткий ролик зацикливается незаметно
+    
+    Ролик декодируется в уменьшенные серые кадры; RMS-разницы всех пар
+    «начало × конец» считаются одним матричным произведением. Стоимость
+    пары учитывает и предыдущие кадры, чтобы совпадало движение.
+    """
+    
+    def __init__(self, sample_width=None, search_fraction=None, min_seconds=None):
+        self.sample_width = sample_width or Config.LOOP_SAMPLE_WIDTH
+        self.search_fraction = search_fraction or Config.LOOP_SEARCH_FRACTION
+        self.min_seconds = min_seconds or Config.LOOP_MIN_SECONDS
+    
+    def read_frames(self, video_path, info):
+        """Все кадры ролика: массив float32 (n, h*w)"""
+        width = self.sample_width
+        height = max(2, int(round(info["height"] * width / info["width"] / 2)) * 2)
+        cmd = [
+            'ffmpeg', '-v', 'error',
+            '-i', str(video_path),
+            '-vsync', 'passthrough',
+            '-vf', f'scale={width}:{height}',
+            '-f', 'rawvideo', '-pix_fmt', 'gray',
+            '-'
+        ]
+        result = ffmpeg_runner.run(cmd, capture_stdout=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Ошибка декодирования: {result.stderr}")
+        frame_size = width * height
+        count = len(result.stdout) // frame_size
+        frames = np.frombuffer(result.stdout[:count * frame_size], dtype=np.uint8)
+        return frames.reshape(count, frame_size).astype(np.float32)
+    
+    @staticmethod
+    def pair_distances(a, b):
+        """RMS-разница каждой строки a с каждой строкой b"""
+        squared = (a * a).sum(axis=1)[:, None] + (b * b).sum(axis=1)[None, :] - 2.0 * (a @ b.T)
+        return np.sqrt(np.maximum(squared, 0.0) / a.shape[1])
+    
+    def find(self, video_path, info, fade_frames=0):
+        """LoopPoint для ролика или None, если он и так зацикливается чисто
+        
+        Фрагмент [i, j) замыкается, когда кадр i похож на кадр j (тот, что
+        шел бы после j-1), а кадр i-1 - на кадр j-1.
+        """
+        frames = self.read_frames(video_path, info)
+        n = len(frames)
+        fps = info["fps"] or 30.0
+        if n < 4:
+            return None
+        
+        steps = np.sqrt(((frames[1:] - frames[:-1]) ** 2).mean(axis=1))
+        baseline = float(np.median(steps))
+        tolerance = Config.LOOP_MATCH_RATIO * baseline + 1.0
+        
+        natural = float(np.sqrt(((frames[-1] - frames[0]) ** 2).mean()))
+        if natural <= tolerance:
+            return None
+        
+        window = max(2, int(n * self.search_fraction))
+        head = np.arange(0, window)
+        tail = np.arange(n - window - 1, n)
+        distances = self.pair_distances(frames[head], frames[tail])
+        # cost[i, j] для i = head[1:], j = tail[1:]
+        cost = distances[1:, 1:] + 0.5 * distances[:-1, :-1]
+        
+        starts = head[1:, None]
+        ends = tail[None, 1:]
+        min_length = max(2, int(self.min_seconds * fps))
+        invalid = (ends - starts < min_length) | (starts < fade_frames)
+        cost = np.where(invalid, np.inf, cost)
+        if not np.isfinite(cost).any():
+            return None
+        
+        i, j = np.unravel_index(int(cost.argmin()), cost.shape)
+        start_frame, end_frame = int(head[1 + i]), int(tail[1 + j])
+        score = float(distances[1 + i, 1 + j])
+        if score >= natural:
+            return None
+        
+        return LoopPoint(start_frame, end_frame, fps, round(score, 2), round(baseline, 2))
+
+# ============================================================================
+# НОРМАЛИЗАЦИЯ ГРОМКОСТИ
+# ============================================================================
+
+class LoudnessAnalyzer:
+    """Двухпроходная нормализация громкости по EBU R128 (фильтр loudnorm)
+    
+    Первый проход (измерение) дорогой и кэшируется по хэшу содержимого
+    файла, поэтому повторно используемая музыка анализируется один раз;
+    при рендере остается только второй проход с измеренными значениями.
+    """
+    
+    def __init__(self, cache_file=None, max_workers=None):
+        self.cache_file = Path(cache_file or Config.LOUDNESS_CACHE_FILE)
+        self.max_workers = max_workers or Config.ENCODE_WORKERS
+        self.lock = threading.Lock()
+        self.measurements = {}
+        if self.cache_file.exists():
+            try:
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    self.measurements = json.load(f)
+            except Exception as e:
+                logger.error(f"Ошибка загрузки кэша громкости: {e}")
+    
+    def save(self):
+        """Атомарное сохранение кэша измерений"""
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.cache_file.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.measurements, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.cache_file)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения кэша громкости: {e}")
+    
+    @staticmethod
+    def target_args():
+        """Целевые параметры loudnorm из настроек"""
+        return (f"I={Config.LOUDNORM_TARGET_I}:TP={Config.LOUDNORM_TARGET_TP}"
+                f":LRA={Config.LOUDNORM_TARGET_LRA}")
+    
+    def measure(self, audio_path):
+        """Первый проход loudnorm: input_i, input_tp, input_lra, input_thresh"""
+        content_hash = Utils.file_hash(audio_path)
+        with self.lock:
+            if content_hash in self.measurements:
+                return self.measurements[content_hash]
+        
+        cmd = [
+            'ffmpeg', '-hide_banner', '-nostats',
+            '-i', str(audio_path),
+            '-map', '0:a:0',
+            '-af', f"loudnorm={self.target_args()}:print_format=json",
+            '-f', 'null', '-'
+        ]
+        result = ffmpeg_runner.run(cmd, threads=1)
+        match = re.search(r'\{[^{}]*"input_i"[^{}]*\}', result.stderr)
+        if result.returncode != 0 or not match:
+            raise RuntimeError(f"Ошибка измерения громкости {audio_path}: {result.stderr[-500:]}")
+        
+        data = json.loads(match.group(0))
+        measurement = {key: float(data[key]) for key in ("input_i", "input_tp", "input_lra", "input_thresh")}
+        logger.info(f"Громкость {Path(audio_path).name}: {measurement['input_i']} LUFS")
+        with self.lock:
+            self.measurements[content_hash] = measurement
+            self.save()
+        return measurement
+    
+    def measure_many(self, paths):
+        """Параллельное измерение нескольких файлов"""
+        paths = list(paths)
+        workers = max(1, min(self.max_workers, len(paths)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.measure, paths))
+    
+    def filters(self, paths):
+        """Фильтры второго прохода loudnorm для каждого файла"""
+        filters = []
+        for m in self.measure_many(paths):
+            if not np.isfinite(m["input_i"]):
+                # Тишина: нормализовать нечего
+                filters.append(None)
+                continue
+            filters.append(
+                f"loudnorm={self.target_args()}"
+                f":measured_I={m['input_i']}:measured_TP={m['input_tp']}"
+                f":measured_LRA={m['input_lra']}:measured_thresh={m['input_thresh']}"
+                f":linear=true"
+            )
+        return filters
+
+# ============================================================================
+# ГЕНЕРАЦИЯ ВИДЕО
+# ============================================================================
+
+class VideoGenerator:
+    """Генерация и обработка видео"""
+    
+    def __init__(self, artifacts=None):
+        if not Utils.check_ffmpeg():
+            print(Utils.color_text("ВНИМАНИЕ: FFmpeg не установлен!", "red"))
+            print("Установите: sudo apt install ffmpeg")
+        self.encoder_tuner = EncoderTuner()
+        self.loudness = LoudnessAnalyzer()
+        self.artifacts = artifacts or ArtifactStore()
+    
+    @staticmethod
+    def encoding_params(encoding):
+        """Параметры кодирования, от которых зависит результат стадии
+        
+        encoding - (preset, crf), уже выбранные EncoderTuner до рендера:
+        ключ должен совпадать с настройками, с которыми кодируется результат.
+        """
+        preset, crf = encoding
+        return {"preset": preset, "crf": crf}
+    
+    def still_encoding(self, image_path, duration, width, height):
+        """(preset, crf) для видео из картинки (см. create_still_video)"""
+        fps = Config.FPS
+        unit_frames = max(1, round(min(float(duration), Config.STILL_UNIT_SECONDS) * fps))
+        return self.encoder_tuner.settings(
+            "still", width, height, default=("medium", 23),
+            reference_args=['-loop', '1', '-framerate', str(fps), '-i', str(image_path),
+                            '-frames:v', str(min(unit_frames, Config.TUNING_SAMPLE_SECONDS * fps)),
+                            '-vf', f'scale={width}:{height}'],
+            extra_args=['-tune', 'stillimage']
+        )
+    
+    def upscale_encoding(self, video_path):
+        """(preset, crf) для апскейла до 4K"""
+        return self.encoder_tuner.settings(
+            "upscale_4k", Config.UHD_WIDTH, Config.UHD_HEIGHT, default=("slow", 18),
+            reference_args=['-t', str(Config.TUNING_SAMPLE_SECONDS), '-i', str(video_path),
+                            '-vf', f'scale={Config.UHD_WIDTH}:{Config.UHD_HEIGHT}']
+        )
+    
+    def audio_params(self, audio_tracks):
+        """Параметры дорожек и обработки звука, от которых зависит результат стадии"""
+        return {
+            "tracks": [[track.volume, track.delay] for track in audio_tracks],
+            "bed": Config.AUDIO_BED_ENABLED and [Config.AUDIO_BED_MAX_SECONDS, Config.AUDIO_BED_CROSSFADE,
+                                                 Config.AUDIO_SAMPLE_RATE, "flac"],
+            "loudnorm": Config.LOUDNORM_ENABLED and self.loudness.target_args()
+        }
+    
+    def create_video_from_image(self, image_path, duration, output_path, prompt="",
+                                still_mode=None, size=None):
+        """Создание видео из изображения (результат берется из хранилища, если есть)"""
+        still_mode = Config.STILL_IMAGE_MODE if still_mode is None else still_mode
+        width, height = size or (Config.IMAGE_WIDTH, Config.IMAGE_HEIGHT)
+        encoding = self.still_encoding(image_path, duration, width, height) if still_mode else None
+        params = {
+            "duration": float(duration), "width": width, "height": height, "fps": Config.FPS,
+            "still": still_mode and Config.STILL_UNIT_SECONDS,
+            "encoding": self.encoding_params(encoding) if still_mode else None
+        }
+        return self.artifacts.run(
+            "create_video_from_image", output_path, [image_path], params,
+            lambda: self.render_video_from_image(image_path, duration, output_path, encoding, width, height)
+        )
+    
+    def render_video_from_image(self, image_path, duration, output_path, encoding, width, height):
+        """Кодирование видео из изображения; encoding - (preset, crf) режима картинки или None"""
+        try:
+            if encoding:
+                return self.create_still_video(image_path, duration, output_path, width, height, encoding)
+            
+            def encode_segment(segment, segment_path, threads):
+                # Команда FFmpeg для создания видео из изображения
+                cmd = [
+                    'ffmpeg', '-y',
+                    '-loop', '1',
+                    '-framerate', str(Config.FPS),
+                    '-i', str(image_path),
+                    '-frames:v', str(segment.frames),
+                    '-c:v', 'libx264',
+                    '-threads', str(threads),
+                    '-pix_fmt', 'yuv420p',
+                    '-vf', f'scale={width}:{height}',
+                    str(segment_path)
+                ]
+                result = ffmpeg_runner.run(cmd, duration=segment.frames / Config.FPS, threads=threads)
+                if result.returncode != 0:
+                    print(f"Ошибка FFmpeg: {result.stderr}")
+                return result.returncode == 0
             
             print(f"Создание видео: {output_path}")
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            engine = SegmentedEncoder()
+            segments = engine.plan(round(float(duration) * Config.FPS), Config.FPS)
             
-            if result.returncode == 0:
+            if engine.run(segments, output_path, encode_segment, Config.FPS):
                 print(f"Видео создано: {output_path}")
                 return True
             else:
-                print(f"Ошибка FFmpeg: {result.stderr}")
                 return False
                 
         except Exception as e:
             logger.error(f"Ошибка создания видео: {e}")
             return False
     
+    def create_still_video(self, image_path, duration, output_path, width, height, encoding):
+        """Видео из картинки: один короткий фрагмент кодируется и повторяется копированием
+        
+        Фрагмент длиной Config.STILL_UNIT_SECONDS кодируется с -tune stillimage
+        и одним ключевым кадром; все кадры после него одинаковые, поэтому
+        кодируются пропущенными макроблоками. Полная длительность собирается
+        повтором фрагмента без перекодирования (-stream_loop, -c copy).
+        encoding - (preset, crf), см. still_encoding().
+        """
+        fps = Config.FPS
+        unit_seconds = min(float(duration), Config.STILL_UNIT_SECONDS)
+        unit_frames = max(1, round(unit_seconds * fps))
+        output_path = Path(output_path)
+        unit_path = output_path.with_name(f"{output_path.stem}.unit.mp4")
+        
+        preset, crf = encoding
+        
+        encode_cmd = [
+            'ffmpeg', '-y',
+            '-loop', '1',
+            '-framerate', str(fps),
+            '-i', str(image_path),
+            '-frames:v', str(unit_frames),
+            '-vf', f'scale={width}:{height},format=yuv420p',
+            '-c:v', 'libx264',
+            '-preset', preset,
+            '-crf', str(crf),
+            '-tune', 'stillimage',
+            '-g', str(unit_frames),
+            '-x264-params', 'scenecut=0',
+            '-r', str(fps),
+            '-movflags', '+faststart',
+            str(unit_path)
+        ]
+        
+        print(f"Создание видео: {output_path}")
+        try:
+            result = ffmpeg_runner.run(encode_cmd, duration=unit_frames / fps, progress_range=(0.0, 50.0))
+            if result.returncode != 0:
+                print(f"Ошибка FFmpeg: {result.stderr}")
+                return False
+            
+            repeats = int(np.ceil(float(duration) * fps / unit_frames))
+            loop_cmd = [
+                'ffmpeg', '-y',
+                '-stream_loop', str(repeats - 1),
+                '-i', str(unit_path),
+                '-frames:v', str(round(float(duration) * fps)),
+                '-c', 'copy',
+                '-movflags', '+faststart',
+                str(output_path)
+            ]
+            result = ffmpeg_runner.run(loop_cmd, duration=float(duration), threads=1,
+                                       progress_range=(50.0, 100.0))
+            if result.returncode != 0:
+                print(f"Ошибка FFmpeg: {result.stderr}")
+                return False
+        finally:
+            unit_path.unlink(missing_ok=True)
+        
+        print(f"Видео создано: {output_path}")
+        return True
+    
+    def audio_mix_graph(self, audio_tracks, first_input, extra_labels=(), output_label="audio"):
+        """Граф микширования дорожек (громкость и задержка) в [output_label]
+        
+        Дорожки берутся со входов first_input, first_input+1, ...;
+        extra_labels - уже готовые метки, добавляемые в микс (например, [0:a]).
+        При LOUDNORM_ENABLED каждая дорожка сначала приводится к целевой
+        громкости, громкость дорожки задает ее долю в миксе, а пики
+        ограничиваются лимитером вместо усиления вслепую.
+        """
+        loudnorm = [None] * len(audio_tracks)
+        if Config.LOUDNORM_ENABLED and audio_tracks:
+            loudnorm = self.loudness.filters([track.path for track in audio_tracks])
+        
+        filters = []
+        labels = list(extra_labels)
+        for i, track in enumerate(audio_tracks):
+            chain = f"[{first_input + i}:a]"
+            if loudnorm[i]:
+                chain += f"{loudnorm[i]},"
+            chain += f"aresample={Config.AUDIO_SAMPLE_RATE}"
+            if track.delay > 0:
+                chain += f",adelay={int(track.delay * 1000)}:all=1"
+            chain += f",volume={track.volume / 100.0}[a{i}v]"
+            filters.append(chain)
+            labels.append(f"[a{i}v]")
+        
+        if Config.LOUDNORM_ENABLED:
+            limit = 10 ** (Config.LOUDNORM_TARGET_TP / 20)
+            mix = f"amix=inputs={len(labels)}:duration=longest:normalize=0,alimiter=limit={limit:.4f}:level=disabled"
+        else:
+            mix = f"amix=inputs={len(labels)}:duration=longest,volume=2.0"
+        filters.append(f"{''.join(labels)}{mix}[{output_label}]")
+        return ";".join(filters)
+    
+    @staticmethod
+    def clip_audio_loop(input_index, period, total, output_label):
+        """Граф повтора звука ролика с периодом period до длины total
+        
+        Звук декодируется один раз и повторяется фильтром aloop: при
+        -stream_loop каждый повтор AAC теряет кадр задержки кодера
+        (1024 сэмпла), что дает провал звука на стыке и растущий рассинхрон.
+        """
+        rate = Config.AUDIO_SAMPLE_RATE
+        return (
+            f"[{input_index}:a]aresample={rate},apad=whole_dur={period:.6f},atrim=end={period:.6f},"
+            f"aloop=loop=-1:size={int(round(period * rate))},atrim=end={total:.6f}[{output_label}]"
+        )
+    
+    def build_audio_bed(self, audio_tracks, clip_path=None):
+        """Короткая зацикливаемая подложка из дорожек; (путь, длительность)
+        
+        Дорожки микшируются один раз до длины самой длинной из них (не более
+        AUDIO_BED_MAX_SECONDS); последние AUDIO_BED_CROSSFADE секунд
+        накладываются на начало. Подложка хранится без потерь (FLAC): ее
+        сэмплы повторяются точно, а в AAC кодируется только итоговый звук.
+        Если у ролика clip_path есть свой звук, он входит в подложку, а ее
+        длина кратна длине ролика, чтобы звук ролика не смещался
+        относительно картинки. Готовые подложки кэшируются по содержимому
+        дорожек и параметрам.
+        """
+        crossfade = Config.AUDIO_BED_CROSSFADE
+        ends = [track.delay + media_probe.duration(track.path) for track in audio_tracks]
+        bed_duration = min(max(ends), Config.AUDIO_BED_MAX_SECONDS + crossfade) - crossfade
+        
+        clip_audio = bool(clip_path) and media_probe.summary(clip_path)["has_audio"]
+        if clip_audio:
+            period = media_probe.duration(clip_path)
+            bed_duration = max(1, int(np.ceil(bed_duration / period))) * period
+        crossfade = min(crossfade, bed_duration / 4)
+        if bed_duration <= 0:
+            raise RuntimeError("Дорожки слишком короткие для подложки")
+        
+        key_data = {
+            "tracks": [[Utils.file_hash(t.path), t.volume, t.delay] for t in audio_tracks],
+            "clip": Utils.file_hash(clip_path) if clip_audio else None,
+            "duration": round(bed_duration, 3),
+            "crossfade": round(crossfade, 3),
+            "sample_rate": Config.AUDIO_SAMPLE_RATE,
+            "loudnorm": LoudnessAnalyzer.target_args() if Config.LOUDNORM_ENABLED else None,
+            "format": "flac"
+        }
+        key = hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+        bed_path = Config.AUDIO_BED_DIR / f"bed_{key[:24]}.flac"
+        if bed_path.exists():
+            print(f"Аудиоподложка из кэша: {bed_path.name} ({bed_duration:.1f} с)")
+            return bed_path, bed_duration
+        
+        Config.AUDIO_BED_DIR.mkdir(parents=True, exist_ok=True)
+        inputs = []
+        extra_labels = []
+        if clip_audio:
+            inputs += ['-i', str(clip_path)]
+            extra_labels.append("[clip]")
+        first_input = 1 if clip_audio else 0
+        for track in audio_tracks:
+            inputs += ['-i', str(track.path)]
+        
+        total = bed_duration + crossfade
+        graph = self.audio_mix_graph(audio_tracks, first_input, extra_labels, "mix")
+        if clip_audio:
+            graph = self.clip_audio_loop(0, period, total, "clip") + ";" + graph
+        graph += (
+            f";[mix]apad=whole_dur={total:.6f},atrim=end={total:.6f},asplit[m0][m1];"
+            f"[m0]atrim=end={bed_duration:.6f},asetpts=PTS-STARTPTS,afade=t=in:d={crossfade:.6f}[head];"
+            f"[m1]atrim=start={bed_duration:.6f},asetpts=PTS-STARTPTS,afade=t=out:d={crossfade:.6f}[tail];"
+            f"[head][tail]amix=inputs=2:duration=first:normalize=0[bed]"
+        )
+        
+        partial_path = bed_path.with_name(f"{bed_path.stem}.partial.flac")
+        cmd = ['ffmpeg', '-y', '-v', 'error'] + inputs + [
+            '-filter_complex', graph,
+            '-map', '[bed]',
+            '-c:a', 'flac',
+            '-ar', str(Config.AUDIO_SAMPLE_RATE),
+            str(partial_path)
+        ]
+        print(f"Сведение аудиоподложки ({bed_duration:.1f} с)...")
+        result = ffmpeg_runner.run(cmd, duration=total, threads=1)
+        if result.returncode != 0:
+            partial_path.unlink(missing_ok=True)
+            raise RuntimeError(f"Ошибка сведения подложки: {result.stderr}")
+        os.replace(partial_path, bed_path)
+        return bed_path, bed_duration
+    
     def add_audio_tracks(self, video_path, audio_tracks, output_path):
-        """Добавление аудиодорожек к видео"""
+        """Добавление аудиодорожек к видео
+        
+        Беззвучное видео длиннее AUDIO_BED_MAX_SECONDS получает
+        зацикленную подложку (микшируется один раз, затем только кодируется
+        в AAC); иначе дорожки микшируются на всю длину видео (вместе с его
+        звуком, если он есть).
+        """
         if not audio_tracks:
-            # Без аудио - просто копируем видео
+            # Без аудио - просто копируем видео (путь мог быть ссылкой в хранилище)
+            Path(output_path).unlink(missing_ok=True)
             shutil.copy(video_path, output_path)
             return True
         
+        return self.artifacts.run(
+            "add_audio_tracks", output_path,
+            [video_path] + [track.path for track in audio_tracks], self.audio_params(audio_tracks),
+            lambda: self.render_audio_tracks(video_path, audio_tracks, output_path)
+        )
+    
+    def render_audio_tracks(self, video_path, audio_tracks, output_path):
+        """Микширование дорожек и мультиплексирование с видео"""
         try:
-            # Создаем сложный фильтр для микширования аудио
-            filter_complex = ""
-            audio_inputs = []
-            
-            for i, track in enumerate(audio_tracks):
-                audio_inputs.extend(['-i', track.path])
-                volume = track.volume / 100.0
-                delay = track.delay
-                
-                if delay > 0:
-                    filter_complex += f"[{i+1}:a]adelay={int(delay*1000)}|{int(delay*1000)}[a{i}];"
-                    filter_complex += f"[a{i}]volume={volume}[a{i}v];"
-                else:
-                    filter_complex += f"[{i+1}:a]volume={volume}[a{i}v];"
-            
-            # Объединяем все аудиодорожки
-            filter_complex += "[0:a]"
-            for i in range(len(audio_tracks)):
-                filter_complex += f"[a{i}v]"
+            info = media_probe.summary(video_path)
             
-            filter_complex += f"amix=inputs={len(audio_tracks)+1}:duration=longest,volume=2.0[audio]"
-            
-            cmd = [
-                'ffmpeg', '-y',
-                '-i', video_path
-            ] + audio_inputs + [
-                '-filter_complex', filter_complex,
-                '-map', '0:v',
-                '-map', '[audio]',
-                '-c:v', 'copy',
-                '-c:a', 'aac',
-                '-b:a', '192k',
-                str(output_path)
-            ]
+            if Config.AUDIO_BED_ENABLED and not info["has_audio"] \
+                    and info["duration"] > Config.AUDIO_BED_MAX_SECONDS:
+                bed_path, _ = self.build_audio_bed(audio_tracks)
+                cmd = [
+                    'ffmpeg', '-y',
+                    '-i', str(video_path),
+                    '-stream_loop', '-1',
+                    '-i', str(bed_path),
+                    '-map', '0:v',
+                    '-map', '1:a',
+                    '-t', f"{info['duration']:.6f}",
+                    '-c:v', 'copy',
+                    '-c:a', 'aac',
+                    '-b:a', '192k',
+                    str(output_path)
+                ]
+            else:
+                # У видео из изображения нет звуковой дорожки: [0:a] только при ее наличии
+                audio_inputs = []
+                for track in audio_tracks:
+                    audio_inputs.extend(['-i', track.path])
+                filter_complex = self.audio_mix_graph(
+                    audio_tracks, 1, ["[0:a]"] if info["has_audio"] else []
+                )
+                cmd = [
+                    'ffmpeg', '-y',
+                    '-i', str(video_path)
+                ] + audio_inputs + [
+                    '-filter_complex', filter_complex,
+                    '-map', '0:v',
+                    '-map', '[audio]',
+                    '-c:v', 'copy',
+                    '-c:a', 'aac',
+                    '-b:a', '192k',
+                    str(output_path)
+                ]
             
             print("Добавление аудиодорожек...")
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            result = ffmpeg_runner.run(cmd, duration=info["duration"], threads=1)
             
             if result.returncode == 0:
                 print(f"Аудио добавлено: {output_path}")
@@ -624,125 +3855,386 @@ class VideoGenerator:
             logger.error(f"Ошибка добавления аудио: {e}")
             return False
     
+    def upscale_frame(self, frame):
+        """Апскейл одного кадра до 4K (в реальности здесь был бы ИИ-апскейл)"""
+        return cv2.resize(frame, (Config.UHD_WIDTH, Config.UHD_HEIGHT), interpolation=cv2.INTER_CUBIC)
+    
     def upscale_video_frames(self, video_path, output_path):
-        """Апскейл видео через обработку кадров"""
+        """Апскейл видео через обработку кадров
+        
+        Видео делится на фрагменты по ключевым кадрам, которые обрабатываются
+        и кодируются параллельно (SegmentedEncoder).
+        """
+        encoding = self.upscale_encoding(video_path)
+        params = {
+            "width": Config.UHD_WIDTH, "height": Config.UHD_HEIGHT, "fps": Config.FINAL_FPS,
+            "encoding": self.encoding_params(encoding)
+        }
+        return self.artifacts.run(
+            "upscale_video_frames", output_path, [video_path], params,
+            lambda: self.render_upscale(video_path, output_path, encoding)
+        )
+    
+    def render_upscale(self, video_path, output_path, encoding):
+        """Покадровый апскейл и кодирование фрагментов с (preset, crf) encoding"""
         try:
-            # Создаем временную директорию для кадров
-            frames_dir = Config.TEMP_DIR / "frames"
-            frames_dir.mkdir(exist_ok=True)
-            
-            # Извлекаем кадры
-            frame_pattern = str(frames_dir / "frame_%04d.jpg")
-            
-            extract_cmd = [
-                'ffmpeg', '-i', video_path,
-                '-q:v', '2',
-                frame_pattern
-            ]
-            
-            print("Извлечение кадров...")
-            subprocess.run(extract_cmd, capture_output=True)
-            
-            # В реальности здесь был бы апскейл каждого кадра через ИИ
-            # Для демо просто увеличиваем разрешение
-            
-            frame_files = list(sorted(frames_dir.glob("*.jpg")))
-            if not frame_files:
+            info = media_probe.summary(video_path)
+            engine = SegmentedEncoder()
+            total_frames, _ = media_probe.frame_count(video_path)
+            if total_frames == 0:
                 print("Не удалось извлечь кадры")
                 return False
             
-            # Создаем видео из апскейленных кадров
-            input_pattern = str(frames_dir / "frame_%04d.jpg")
+            segments = engine.plan(total_frames, info["fps"] or Config.FINAL_FPS,
+                                   media_probe.keyframes(video_path))
+            print(f"Создание 4K видео... (фрагментов: {len(segments)})")
             
-            create_cmd = [
-                'ffmpeg', '-y',
+            stats = {}
+            encode_segment = lambda seg, path, threads: self.upscale_segment(
+                video_path, path, seg, info, threads, stats, encoding
+            )
+            if engine.run(segments, output_path, encode_segment, Config.FINAL_FPS):
+                unique = sum(u for _, u in stats.values())
+                ratio = 1 - unique / total_frames
+                print(f"4K видео создано: {output_path} (кадров: {total_frames})")
+                print(f"Уникальных кадров: {unique} из {total_frames} (дедупликация {ratio:.1%})")
+                logger.info(f"Апскейл {video_path}: уникальных кадров {unique}/{total_frames}")
+                return True
+            
+            print("Ошибка создания 4K видео")
+            return False
+                
+        except Exception as e:
+            logger.error(f"Ошибка апскейла видео: {e}")
+            return False
+    
+    def upscale_segment(self, video_path, output_path, segment, info, threads=0, stats=None,
+                        encoding=("slow", 18)):
+        """Апскейл фрагмента на ядрах из общего бюджета FFmpeg (0 - весь бюджет)"""
+        with ffmpeg_runner.cores(threads or None) as granted:
+            return self.upscale_segment_pipeline(video_path, output_path, segment, info,
+                                                 granted, stats, encoding)
+    
+    def upscale_segment_pipeline(self, video_path, output_path, segment, info, threads, stats,
+                                 encoding, timeout=None):
+        """Апскейл одного фрагмента видео
+        
+        Кадры идут без записи на диск: декодер FFmpeg отдает rawvideo в канал,
+        кадры обрабатываются как массивы NumPy и сразу передаются кодеру.
+        Память ограничена очередями по Config.FRAME_QUEUE_SIZE кадров.
+        Одинаковые кадры апскейлятся один раз: результат берется из кэша
+        последних Config.FRAME_DEDUP_CACHE уникальных кадров по их хэшу.
+        В stats[segment.index] записывается (кадров, уникальных).
+        encoding - (preset, crf) кодера. Декодер и кодер учитываются
+        ffmpeg_runner, поэтому к ним применяются отмена и timeout.
+        """
+        decoder = encoder = None
+        try:
+            width, height = info["width"], info["height"]
+            frame_size = width * height * 3
+            
+            decode_cmd = [
+                'ffmpeg', '-v', 'error',
+                '-ss', f"{segment.start:.6f}",
+                '-i', str(video_path),
+                '-map', '0:v:0',
+                '-frames:v', str(segment.frames),
+                '-vsync', 'passthrough',
+                '-f', 'rawvideo',
+                '-pix_fmt', 'bgr24',
+                '-'
+            ]
+            encode_cmd = [
+                'ffmpeg', '-y', '-v', 'error',
+                '-f', 'rawvideo',
+                '-pix_fmt', 'bgr24',
+                '-s', f'{Config.UHD_WIDTH}x{Config.UHD_HEIGHT}',
                 '-framerate', str(Config.FINAL_FPS),
-                '-i', input_pattern,
+                '-i', '-',
                 '-c:v', 'libx264',
+                '-threads', str(threads),
                 '-pix_fmt', 'yuv420p',
-                '-vf', f'scale={Config.UHD_WIDTH}:{Config.UHD_HEIGHT}',
-                '-preset', 'slow',
-                '-crf', '18',
+                '-preset', encoding[0],
+                '-crf', str(encoding[1]),
                 str(output_path)
             ]
             
-            print("Создание 4K видео...")
-            result = subprocess.run(create_cmd, capture_output=True, text=True)
-            
-            # Очистка временных файлов
-            shutil.rmtree(frames_dir, ignore_errors=True)
-            
-            if result.returncode == 0:
-                print(f"4K видео создано: {output_path}")
-                return True
-            else:
-                print(f"Ошибка создания 4K видео: {result.stderr}")
-                return False
+            decoder = subprocess.Popen(decode_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            encoder = subprocess.Popen(encode_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+            with ffmpeg_runner.track([decoder, encoder], timeout=timeout) as job:
+                # stderr читается постоянно: заполненный канал остановил бы FFmpeg
+                stderr_tails = [deque(maxlen=Config.FFMPEG_STDERR_LINES) for _ in range(2)]
+                
+                def read_stderr(process, tail):
+                    for line in iter(process.stderr.readline, b''):
+                        tail.append(line.decode(errors='replace').rstrip())
+                
+                drains = [threading.Thread(target=read_stderr, args=(process, tail), daemon=True)
+                          for process, tail in zip((decoder, encoder), stderr_tails)]
+                for drain in drains:
+                    drain.start()
+                
+                decoded = queue.Queue(maxsize=Config.FRAME_QUEUE_SIZE)
+                processed = queue.Queue(maxsize=Config.FRAME_QUEUE_SIZE)
+                errors = []
+                
+                def read_frames():
+                    try:
+                        while True:
+                            # Каждый кадр читается в собственный буфер без лишних копий
+                            buffer = bytearray(frame_size)
+                            view = memoryview(buffer)
+                            filled = 0
+                            while filled < frame_size:
+                                n = decoder.stdout.readinto(view[filled:])
+                                if not n:
+                                    break
+                                filled += n
+                            if filled < frame_size:
+                                break
+                            decoded.put(np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3))
+                    except Exception as e:
+                        errors.append(e)
+                    finally:
+                        decoded.put(None)
+                
+                def write_frames():
+                    try:
+                        while True:
+                            frame = processed.get()
+                            if frame is None:
+                                break
+                            encoder.stdin.write(memoryview(np.ascontiguousarray(frame)))
+                    except Exception as e:
+                        errors.append(e)
+                        # Освобождаем обработчик, если кодер упал
+                        while processed.get() is not None:
+                            pass
+                    finally:
+                        encoder.stdin.close()
+                
+                reader = threading.Thread(target=read_frames, name="frame-reader", daemon=True)
+                writer = threading.Thread(target=write_frames, name="frame-writer", daemon=True)
+                reader.start()
+                writer.start()
+                
+                frame_count = 0
+                unique_count = 0
+                progress_slot = object()
+                upscaled_cache = OrderedDict()
+                stopped = lambda: job["cancelled"] or job["timed_out"]
+                while not errors and not stopped():
+                    frame = decoded.get()
+                    if frame is None:
+                        break
+                
+                    digest = hashlib.blake2b(memoryview(frame), digest_size=16).digest()
+                    upscaled = upscaled_cache.get(digest)
+                    if upscaled is None:
+                        upscaled = self.upscale_frame(frame)
+                        upscaled_cache[digest] = upscaled
+                        if len(upscaled_cache) > Config.FRAME_DEDUP_CACHE:
+                            upscaled_cache.popitem(last=False)
+                        unique_count += 1
+                    else:
+                        upscaled_cache.move_to_end(digest)
+                
+                    # Кадр только читается кодером, поэтому один массив можно отдать несколько раз
+                    processed.put(upscaled)
+                    frame_count += 1
+                    if frame_count % Config.FINAL_FPS == 0:
+                        ffmpeg_runner.report_progress(frame_count / Config.FINAL_FPS,
+                                                      segment.frames / Config.FINAL_FPS, slot=progress_slot)
+                processed.put(None)
+                
+                if stats is not None:
+                    stats[segment.index] = (frame_count, unique_count)
+                
+                # При ошибке кодера или отмене декодирование прекращается сразу
+                if errors or stopped():
+                    decoder.kill()
+                    while decoded.get() is not None:
+                        pass
+                
+                reader.join()
+                writer.join()
+                decoder.wait()
+                encoder.wait()
+                for drain in drains:
+                    drain.join()
+                
+                if encoder.returncode == 0 and decoder.returncode == 0 and not errors \
+                        and frame_count == segment.frames:
+                    return True
+                else:
+                    stderr = "\n".join(list(stderr_tails[1]) + list(stderr_tails[0]))
+                    if job["cancelled"] or job["timed_out"]:
+                        stderr += "\nОтменено" if job["cancelled"] else f"\nПревышен таймаут {timeout} с"
+                    print(f"Ошибка фрагмента {segment.index}: {stderr or errors} "
+                          f"(кадров {frame_count} из {segment.frames})")
+                    return False
                 
         except Exception as e:
-            logger.error(f"Ошибка апскейла видео: {e}")
+            logger.error(f"Ошибка апскейла фрагмента {segment.index}: {e}")
             return False
+        finally:
+            for process in (decoder, encoder):
+                if process and process.poll() is None:
+                    process.kill()
+                    process.wait()
     
-    def create_long_video(self, short_video_path, duration_minutes):
-        """Создание длинного видео путем дублирования"""
+    def make_loop_unit(self, video_path, crossfade=None):
+        """Зацикливаемый фрагмент ролика: обрезка по лучшей паре кадров
+        
+        Если стык все равно заметен, последние кадры фрагмента плавно
+        переходят в кадры, предшествующие началу (xfade, afade + amix).
+        Перекодируется только короткий фрагмент; его повторы потом
+        копируются без перекодирования. Возвращает путь к временному файлу
+        (удаляет вызывающий) или None, если ролик и так зацикливается чисто.
+        """
+        crossfade = Config.LOOP_CROSSFADE_SECONDS if crossfade is None else crossfade
         try:
-            # Получаем длину исходного видео
-            probe_cmd = [
-                'ffprobe', '-v', 'error',
-                '-show_entries', 'format=duration',
-                '-of', 'default=noprint_wrappers=1:nokey=1',
-                short_video_path
-            ]
-            
-            result = subprocess.run(probe_cmd, capture_output=True, text=True)
-            short_duration = float(result.stdout.strip())
+            info = media_probe.summary(video_path)
+            fps = info["fps"] or 30.0
+            fade_frames = int(round(crossfade * fps))
             
-            # Рассчитываем сколько раз нужно повторить
-            target_duration = duration_minutes * 60  # в секундах
-            repeats = int(target_duration / short_duration) + 1
+            loop = LoopFinder().find(video_path, info, fade_frames)
+            if not loop:
+                print("Ролик зацикливается без заметного стыка")
+                return None
             
-            print(f"Создание видео длительностью {duration_minutes} минут")
-            print(f"Повторение {repeats} раз")
+            tolerance = Config.LOOP_MATCH_RATIO * loop.baseline + 1.0
+            use_fade = fade_frames > 0 and loop.score > tolerance
+            print(f"Точка зацикливания: {loop.start:.2f}-{loop.end:.2f} с "
+                  f"(разница {loop.score}, обычная {loop.baseline})"
+                  + (f", переход {crossfade} с" if use_fade else ""))
             
-            # Создаем список файлов для конкатенации
-            concat_file = Config.TEMP_DIR / "concat_list.txt"
-            with open(concat_file, 'w') as f:
-                for _ in range(repeats):
-                    f.write(f"file '{short_video_path}'\n")
+            i, j = loop.start_frame, loop.end_frame
+            if use_fade:
+                fade = fade_frames / fps
+                offset = (j - i - fade_frames) / fps
+                video_graph = (
+                    f"[0:v]split[v0][v1];"
+                    f"[v0]trim=start_frame={i}:end_frame={j},setpts=PTS-STARTPTS,fps={fps:g}[body];"
+                    f"[v1]trim=start_frame={i - fade_frames}:end_frame={i},setpts=PTS-STARTPTS,fps={fps:g}[lead];"
+                    f"[body][lead]xfade=transition=fade:duration={fade:.6f}:offset={offset:.6f}[v]"
+                )
+                # acrossfade удлиняет звук и плохо работает с asplit, поэтому
+                # переход собирается из afade и amix той же длины, что и видео
+                audio_graph = (
+                    f"[0:a]asplit[a0][a1];"
+                    f"[a0]atrim=start={loop.start:.6f}:end={loop.end:.6f},asetpts=PTS-STARTPTS,"
+                    f"afade=t=out:st={offset:.6f}:d={fade:.6f}[abody];"
+                    f"[a1]atrim=start={(i - fade_frames) / fps:.6f}:end={loop.start:.6f},asetpts=PTS-STARTPTS,"
+                    f"afade=t=in:d={fade:.6f},adelay={int(round(offset * 1000))}:all=1[alead];"
+                    f"[abody][alead]amix=inputs=2:duration=first:normalize=0[a]"
+                )
+            else:
+                video_graph = f"[0:v]trim=start_frame={i}:end_frame={j},setpts=PTS-STARTPTS[v]"
+                audio_graph = (
+                    f"[0:a]atrim=start={loop.start:.6f}:end={loop.end:.6f},asetpts=PTS-STARTPTS[a]"
+                )
             
-            # Конкатенация видео
-            output_path = Config.OUTPUT_DIR / f"long_video_{duration_minutes}min.mp4"
+            graph = video_graph
+            maps = ['-map', '[v]']
+            if info["has_audio"]:
+                graph += ";" + audio_graph
+                maps += ['-map', '[a]', '-c:a', 'aac', '-b:a', '192k']
             
-            concat_cmd = [
-                'ffmpeg', '-y',
-                '-f', 'concat',
-                '-safe', '0',
-                '-i', str(concat_file),
-                '-c', 'copy',
+            # Имя по содержимому ролика: разные ролики с одинаковым именем не перезаписывают друг друга
+            key = hashlib.sha256(f"{media_probe.content_hash(video_path)}|{crossfade}".encode()).hexdigest()
+            output_path = Config.TEMP_DIR / f"loop_{key[:24]}.mp4"
+            cmd = [
+                'ffmpeg', '-y', '-v', 'error',
+                '-i', str(video_path),
+                '-filter_complex', graph
+            ] + maps + [
+                '-c:v', 'libx264',
+                '-preset', 'medium',
+                '-crf', '18',
+                '-pix_fmt', 'yuv420p',
+                '-movflags', '+faststart',
                 str(output_path)
             ]
+            result = ffmpeg_runner.run(cmd, duration=loop.end - loop.start)
+            if result.returncode != 0:
+                print(f"Ошибка создания зацикленного фрагмента: {result.stderr}")
+                return None
+            return str(output_path)
+        
+        except Exception as e:
+            logger.error(f"Ошибка поиска точки зацикливания: {e}")
+            return None
+    
+    def create_long_video(self, short_video_path, duration_minutes, audio_tracks=None, output_path=None):
+        """Создание длинного видео путем дублирования
+        
+        Видео короткого ролика зацикливается демультиплексором (-stream_loop -1)
+        и копируется без перекодирования ровно до нужной длительности за один
+        проход, без промежуточного полноразмерного файла; перекодируется
+        только звук. Если переданы audio_tracks, в том же проходе
+        зацикливается аудиоподложка.
+        """
+        final_output = Path(output_path or Config.OUTPUT_DIR / f"final_long_{duration_minutes}min.mp4")
+        audio_tracks = audio_tracks or []
+        params = {"duration_minutes": duration_minutes, "audio": self.audio_params(audio_tracks),
+                  "audio_loop": "pcm"}
+        done = self.artifacts.run(
+            "create_long_video", final_output,
+            [short_video_path] + [track.path for track in audio_tracks], params,
+            lambda: self.render_long_video(short_video_path, duration_minutes, audio_tracks, final_output)
+        )
+        return str(final_output) if done else None
+    
+    def render_long_video(self, short_video_path, duration_minutes, audio_tracks, final_output):
+        """Повтор ролика копированием видеопотока
+        
+        Звук (подложка FLAC или декодированный один раз звук ролика)
+        повторяется без потерь и кодируется в AAC заново: копирование
+        зацикленного AAC теряет 1024 сэмпла на каждом повторе.
+        """
+        try:
+            target_duration = duration_minutes * 60  # в секундах
+            partial_output = final_output.with_name(f"{final_output.stem}.partial.mp4")
             
-            result = subprocess.run(concat_cmd, capture_output=True, text=True)
+            print(f"Создание видео длительностью {duration_minutes} минут")
             
-            # Удаляем временный файл
-            concat_file.unlink(missing_ok=True)
+            cmd = [
+                'ffmpeg', '-y',
+                '-stream_loop', '-1',
+                '-i', str(short_video_path)
+            ]
+            audio_codec = ['-c:a', 'aac', '-b:a', '192k']
+            if audio_tracks:
+                bed_path, _ = self.build_audio_bed(audio_tracks, clip_path=short_video_path)
+                cmd += ['-stream_loop', '-1', '-i', str(bed_path), '-map', '0:v', '-map', '1:a']
+            elif media_probe.summary(short_video_path)["has_audio"]:
+                period = media_probe.duration(short_video_path)
+                cmd += [
+                    '-i', str(short_video_path),
+                    '-filter_complex', self.clip_audio_loop(1, period, target_duration, "a"),
+                    '-map', '0:v', '-map', '[a]'
+                ]
+            else:
+                cmd += ['-map', '0']
+                audio_codec = []
+            cmd += [
+                '-t', str(target_duration),
+                '-c:v', 'copy'
+            ] + audio_codec + [
+                str(partial_output)
+            ]
+            
+            # Кодирование звука занимает одно ядро
+            result = ffmpeg_runner.run(cmd, duration=target_duration, threads=1)
+            elapsed = max(result.elapsed, 1e-6)
             
             if result.returncode == 0:
-                # Обрезаем до нужной длины
-                final_output = Config.OUTPUT_DIR / f"final_long_{duration_minutes}min.mp4"
-                
-                trim_cmd = [
-                    'ffmpeg', '-y',
-                    '-i', str(output_path),
-                    '-t', str(target_duration),
-                    '-c', 'copy',
-                    str(final_output)
-                ]
-                
-                subprocess.run(trim_cmd, capture_output=True)
-                output_path.unlink(missing_ok=True)
-                
+                os.replace(partial_output, final_output)
+                throughput = target_duration / 3600 / elapsed
                 print(f"Длинное видео создано: {final_output}")
+                print(f"Скорость: {throughput:.3f} ч видео в секунду ({elapsed:.1f} с)")
+                logger.info(f"Длинное видео {final_output}: {elapsed:.1f} с, {throughput:.3f} ч/с")
                 return str(final_output)
             else:
                 print(f"Ошибка создания длинного видео: {result.stderr}")
@@ -752,27 +4244,146 @@ class VideoGenerator:
             logger.error(f"Ошибка создания длинного видео: {e}")
             return None
     
-    def merge_videos(self, video1_path, video2_path, output_path):
-        """Склейка двух видео"""
+    # Кодировщики FFmpeg для кодеков, в которые приводятся несовместимые входы
+    VIDEO_ENCODERS = {"h264": "libx264", "hevc": "libx265", "vp9": "libvpx-vp9", "mpeg4": "mpeg4"}
+    AUDIO_ENCODERS = {"aac": "aac", "mp3": "libmp3lame", "opus": "libopus", "ac3": "ac3"}
+    # Профили H.264 из ffprobe -> имена libx264; для остальных -profile:v не задается
+    H264_PROFILES = {
+        "Baseline": "baseline", "Constrained Baseline": "baseline",
+        "Main": "main", "High": "high",
+        "High 10": "high10", "High 10 Intra": "high10",
+        "High 4:2:2": "high422", "High 4:2:2 Intra": "high422",
+        "High 4:4:4": "high444", "High 4:4:4 Predictive": "high444", "High 4:4:4 Intra": "high444"
+    }
+    
+    def probe_streams(self, video_path):
+        """Параметры первого видео- и аудиопотока, важные для склейки без перекодирования"""
+        info = media_probe.summary(video_path)
+        video, audio = info["video"], info["audio"]
+        return {
+            "video": (
+                video.get("codec_name"), video.get("profile"),
+                int(video["width"]), int(video["height"]),
+                video.get("pix_fmt"), video.get("r_frame_rate"), video.get("time_base")
+            ),
+            "audio": (
+                audio.get("codec_name"), int(audio.get("sample_rate", 0)), int(audio.get("channels", 0))
+            ) if audio else None,
+            "duration": info["duration"]
+        }
+    
+    def normalize_for_merge(self, video_path, target, output_path, threads=0):
+        """Перекодирование входа к общему профилю склейки"""
+        codec, profile, width, height, pix_fmt, frame_rate, time_base = target["video"]
+        vf = (
+            f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,"
+            f"fps={frame_rate},format={pix_fmt}"
+        )
+        cmd = ['ffmpeg', '-y', '-v', 'error', '-i', str(video_path)]
+        
+        audio = target["audio"]
+        source_audio = self.probe_streams(video_path)["audio"]
+        if audio and not source_audio:
+            # Тишина для входов без звука, чтобы у всех частей были одинаковые потоки
+            layout = "mono" if audio[2] == 1 else "stereo"
+            cmd += ['-f', 'lavfi', '-i', f"anullsrc=r={audio[1]}:cl={layout}", '-shortest']
+        cmd += ['-map', '0:v:0']
+        if audio:
+            cmd += ['-map', '0:a:0' if source_audio else '1:a:0',
+                    '-c:a', self.AUDIO_ENCODERS.get(audio[0], 'aac'),
+                    '-ar', str(audio[1]), '-ac', str(audio[2])]
+        
+        cmd += [
+            '-vf', vf,
+            '-c:v', self.VIDEO_ENCODERS.get(codec, 'libx264'),
+            '-preset', 'medium',
+            '-crf', '18',
+            '-threads', str(threads)
+        ]
+        if codec == "h264" and profile in self.H264_PROFILES:
+            cmd += ['-profile:v', self.H264_PROFILES[profile]]
+        if time_base and '/' in time_base:
+            cmd += ['-video_track_timescale', time_base.split('/')[1]]
+        cmd.append(str(output_path))
+        
+        result = ffmpeg_runner.run(cmd, threads=threads)
+        if result.returncode != 0:
+            raise RuntimeError(f"Ошибка нормализации {video_path}: {result.stderr}")
+        return output_path
+    
+    def merge_videos(self, video_paths, output_path):
+        """Склейка нескольких видео
+        
+        Параметры потоков всех входов сравниваются; общим профилем считается
+        самый частый. Совпадающие входы склеиваются без перекодирования,
+        перекодируются только отличающиеся.
+        """
+        if len(video_paths) < 2:
+            print("Для склейки нужно минимум два видео")
+            return False
+        return self.artifacts.run(
+            "merge_videos", output_path, list(video_paths), {"count": len(video_paths)},
+            lambda: self.render_merge(video_paths, output_path)
+        )
+    
+    def render_merge(self, video_paths, output_path):
+        """Приведение несовместимых входов и склейка копированием"""
+        work_dir = None
+        output_path = Path(output_path)
+        partial_output = output_path.with_name(f"{output_path.stem}.partial{output_path.suffix}")
         try:
-            concat_file = Config.TEMP_DIR / "merge_list.txt"
-            with open(concat_file, 'w') as f:
-                f.write(f"file '{video1_path}'\n")
-                f.write(f"file '{video2_path}'\n")
+            video_paths = [str(Path(p).resolve()) for p in video_paths]
+            media_probe.info_many(video_paths)
+            profiles = [self.probe_streams(p) for p in video_paths]
+            keys = [(p["video"], p["audio"]) for p in profiles]
+            target_key = Counter(keys).most_common(1)[0][0]
+            target = dict(zip(("video", "audio"), target_key))
+            mismatched = [i for i, key in enumerate(keys) if key != target_key]
+            
+            parts = list(video_paths)
+            if mismatched:
+                print(f"Перекодирование несовместимых входов: {len(mismatched)} из {len(video_paths)}")
+                work_dir = Config.TEMP_DIR / f"merge_{Utils.generate_id()}"
+                work_dir.mkdir(parents=True, exist_ok=True)
+                workers = min(Config.ENCODE_WORKERS, len(mismatched))
+                threads = max(1, (os.cpu_count() or 1) // workers)
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = {
+                        i: executor.submit(
+                            self.normalize_for_merge, video_paths[i], target,
+                            work_dir / f"part_{i:04d}{output_path.suffix}", threads
+                        )
+                        for i in mismatched
+                    }
+                    for i, future in futures.items():
+                        parts[i] = str(future.result())
+            else:
+                print("Входы совместимы, склейка без перекодирования")
+            
+            concat_file = (work_dir or Config.TEMP_DIR) / f"merge_list_{Utils.generate_id()}.txt"
+            with open(concat_file, 'w', encoding='utf-8') as f:
+                for part in parts:
+                    escaped = part.replace("'", "'\\''")
+                    f.write(f"file '{escaped}'\n")
             
             cmd = [
                 'ffmpeg', '-y',
                 '-f', 'concat',
                 '-safe', '0',
                 '-i', str(concat_file),
+                '-map', '0',
                 '-c', 'copy',
-                str(output_path)
+                '-movflags', '+faststart',
+                str(partial_output)
             ]
             
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            total_duration = sum(profile["duration"] for profile in profiles)
+            result = ffmpeg_runner.run(cmd, duration=total_duration, threads=1)
             concat_file.unlink(missing_ok=True)
             
             if result.returncode == 0:
+                os.replace(partial_output, output_path)
                 print(f"Видео склеены: {output_path}")
                 return True
             else:
@@ -780,8 +4391,476 @@ class VideoGenerator:
                 return False
                 
         except Exception as e:
+            partial_output.unlink(missing_ok=True)
             logger.error(f"Ошибка склейки видео: {e}")
             return False
+        finally:
+            if work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+# ============================================================================
+# КОНВЕЙЕР РЕНДЕРА
+# ============================================================================
+
+class PipelineStore:
+    """Состояние стадий конвейера в SQLite (та же база, что и задачи)"""
+    
+    COLUMNS = ("job_id", "name", "action", "params", "depends", "resource",
+               "status", "output", "error", "updated_at", "each", "template")
+    JSON_COLUMNS = ("params", "depends", "output")
+    
+    def __init__(self, db_path=None):
+        self.db_path = Path(db_path or Config.TASKS_DB)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.create_schema()
+    
+    def create_schema(self):
+        """Создание таблицы стадий"""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS pipeline_stages (
+                    job_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    action TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    depends TEXT NOT NULL,
+                    resource TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    output TEXT,
+                    error TEXT NOT NULL DEFAULT '',
+                    updated_at TEXT NOT NULL,
+                    each TEXT NOT NULL DEFAULT '',
+                    template TEXT NOT NULL DEFAULT '',
+                    PRIMARY KEY (job_id, name)
+                )
+            """)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_pipeline_status ON pipeline_stages(status, job_id)"
+            )
+            # Таблица из версии без шаблонов стадий
+            existing = {row[1] for row in self.conn.execute("PRAGMA table_info(pipeline_stages)")}
+            for column in ("each", "template"):
+                if column not in existing:
+                    self.conn.execute(
+                        f"ALTER TABLE pipeline_stages ADD COLUMN {column} TEXT NOT NULL DEFAULT ''"
+                    )
+    
+    def save(self, stage):
+        """Запись стадии целиком"""
+        data = asdict(stage)
+        for col in self.JSON_COLUMNS:
+            data[col] = json.dumps(data[col], ensure_ascii=False)
+        updates = ", ".join(f"{col} = excluded.{col}" for col in self.COLUMNS[2:])
+        with self.lock, self.conn:
+            # UPSERT сохраняет rowid, а с ним и порядок стадий
+            self.conn.execute(
+                f"INSERT INTO pipeline_stages ({', '.join(self.COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(self.COLUMNS))}) "
+                f"ON CONFLICT(job_id, name) DO UPDATE SET {updates}",
+                tuple(data[col] for col in self.COLUMNS)
+            )
+    
+    def load(self, job_id):
+        """Стадии задания в порядке добавления"""
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM pipeline_stages WHERE job_id = ? ORDER BY rowid",
+                (job_id,)
+            ).fetchall()
+        stages = []
+        for row in rows:
+            data = dict(zip(self.COLUMNS, row))
+            for col in self.JSON_COLUMNS:
+                data[col] = json.loads(data[col]) if data[col] is not None else None
+            stages.append(PipelineStage(**data))
+        return stages
+    
+    def delete(self, job_id, names):
+        """Удаление стадий задания"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM pipeline_stages WHERE job_id = ? AND name = ?",
+                [(job_id, name) for name in names]
+            )
+    
+    def unfinished_jobs(self):
+        """Задания, у которых есть невыполненные или упавшие стадии"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT job_id FROM pipeline_stages WHERE status NOT IN ('completed', 'expanded')"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+
+class PipelineScheduler:
+    """Планировщик конвейеров рендера
+    
+    Задание - ориентированный ациклический граф стадий (generate_images,
+    create_video_from_image, add_audio_tracks, upscale_video_frames,
+    create_long_video). Готовые к запуску стадии всех заданий выполняются
+    одновременно в пулах по классам ресурсов (Config.PIPELINE_LIMITS);
+    состояние каждой стадии сохраняется, поэтому прерванные задания можно
+    продолжить.
+    
+    Стадия-шаблон (each) разворачивается в экземпляры по числу элементов
+    результата стадии-источника, когда он готов: ветвей столько, сколько
+    изображений действительно получено, а не сколько запрошено.
+    """
+    
+    ACTIONS = {
+        "generate_images": "api",
+        "create_video_from_image": "cpu",
+        "add_audio_tracks": "io",
+        "upscale_video_frames": "cpu",
+        "create_long_video": "io"
+    }
+    
+    def __init__(self, image_gen, video_gen, task_manager, store=None, limits=None):
+        self.image_gen = image_gen
+        self.video_gen = video_gen
+        self.task_manager = task_manager
+        self.store = store or PipelineStore()
+        self.limits = dict(limits or Config.PIPELINE_LIMITS)
+    
+    def create_job(self, name, stages):
+        """Создание задания из списка стадий
+        
+        Стадия - словарь name, action, params и необязательные depends
+        (по умолчанию - стадии, на результаты которых ссылаются params),
+        resource и each (имя стадии-источника для шаблона).
+        """
+        names = [stage["name"] for stage in stages]
+        if len(set(names)) != len(names):
+            raise ValueError("Имена стадий должны быть уникальными")
+        
+        job_stages = []
+        for spec in stages:
+            if spec["action"] not in self.ACTIONS:
+                raise ValueError(f"Неизвестная стадия: {spec['action']}")
+            params = spec.get("params", {})
+            each = spec.get("each", "")
+            depends = list(spec.get("depends") or self.references(params))
+            if each and each not in depends:
+                depends.append(each)
+            missing = [dep for dep in depends if dep not in names]
+            if missing:
+                raise ValueError(f"Стадия {spec['name']} зависит от неизвестных: {missing}")
+            job_stages.append(PipelineStage(
+                job_id="",
+                name=spec["name"],
+                action=spec["action"],
+                params=params,
+                depends=depends,
+                resource=spec.get("resource") or self.ACTIONS[spec["action"]],
+                status="template" if each else "pending",
+                updated_at=Utils.get_timestamp(),
+                each=each
+            ))
+        
+        sources = {stage.name: stage.each for stage in job_stages if stage.each}
+        for stage in job_stages:
+            for dep in stage.depends:
+                if dep in sources and sources[dep] != stage.each:
+                    raise ValueError(f"Стадия {stage.name} может зависеть от шаблона {dep} "
+                                     f"только как шаблон того же источника")
+        job_stages = self.topological_order(job_stages)
+        
+        job_id = self.task_manager.create_task(name, "pipeline")
+        for stage in job_stages:
+            stage.job_id = job_id
+            self.store.save(stage)
+        return job_id
+    
+    def standard_job(self, name, variants=1, duration=10, audio_tracks=(), upscale=False,
+                     long_minutes=None):
+        """Типовое задание: изображения -> видео -> звук -> 4K -> длинное видео
+        
+        Каждое полученное изображение дает свою независимую ветвь стадий
+        (video_0, audio_0, ...); их число известно только после генерации,
+        так как неудачные варианты и дубликаты отбрасываются.
+        """
+        tracks = [asdict(track) for track in audio_tracks]
+        stages = [
+            {"name": "images", "action": "generate_images", "params": {"num_variants": variants}},
+            {"name": "video", "action": "create_video_from_image", "each": "images",
+             "params": {"image_path": "@images[*]", "duration": duration}}
+        ]
+        current = "video"
+        if tracks and not long_minutes:
+            stages.append({"name": "audio", "action": "add_audio_tracks", "each": "images",
+                           "params": {"video_path": f"@{current}[*]", "audio_tracks": tracks}})
+            current = "audio"
+        if upscale:
+            stages.append({"name": "uhd", "action": "upscale_video_frames", "each": "images",
+                           "params": {"video_path": f"@{current}[*]"}})
+            current = "uhd"
+        if long_minutes:
+            # Длинному видео звук добавляется подложкой в том же проходе
+            stages.append({"name": "long", "action": "create_long_video", "each": "images",
+                           "params": {"video_path": f"@{current}[*]", "duration_minutes": long_minutes,
+                                      "audio_tracks": tracks}})
+        return self.create_job(name, stages)
+    
+    @staticmethod
+    def references(value):
+        """Имена стадий, на которые ссылаются параметры"""
+        if isinstance(value, str) and value.startswith("@"):
+            return [value[1:].split("[", 1)[0]]
+        if isinstance(value, dict):
+            value = list(value.values())
+        if isinstance(value, list):
+            return list(dict.fromkeys(name for item in value for name in PipelineScheduler.references(item)))
+        return []
+    
+    @staticmethod
+    def resolve(value, outputs):
+        """Подстановка результатов стадий вместо ссылок на них"""
+        if isinstance(value, str) and value.startswith("@"):
+            match = re.fullmatch(r"@([\w-]+)(?:\[(\d+)\])?", value)
+            if not match:
+                raise ValueError(f"Некорректная ссылка: {value}")
+            output = outputs[match.group(1)]
+            return output[int(match.group(2))] if match.group(2) is not None else output
+        if isinstance(value, dict):
+            return {key: PipelineScheduler.resolve(item, outputs) for key, item in value.items()}
+        if isinstance(value, list):
+            return [PipelineScheduler.resolve(item, outputs) for item in value]
+        return value
+    
+    @staticmethod
+    def instantiate(value, source, templates, index):
+        """Параметры экземпляра шаблона: ссылки "[*]" заменяются на i-й элемент и i-й экземпляр"""
+        if isinstance(value, str) and value.startswith("@") and value.endswith("[*]"):
+            name = value[1:-3]
+            if name == source:
+                return f"@{source}[{index}]"
+            if name in templates:
+                return f"@{name}_{index}"
+            raise ValueError(f"Ссылка {value} не относится к источнику {source}")
+        if isinstance(value, dict):
+            return {key: PipelineScheduler.instantiate(item, source, templates, index)
+                    for key, item in value.items()}
+        if isinstance(value, list):
+            return [PipelineScheduler.instantiate(item, source, templates, index) for item in value]
+        return value
+    
+    def expand(self, stages, source):
+        """Развертывание шаблонов источника в экземпляры (по элементу его результата)"""
+        templates = [stage for stage in stages if stage.each == source.name and stage.status == "template"]
+        names = {stage.name for stage in templates}
+        instances = []
+        for index in range(len(source.output or [])):
+            for template in templates:
+                instances.append(PipelineStage(
+                    job_id=template.job_id,
+                    name=f"{template.name}_{index}",
+                    action=template.action,
+                    params=self.instantiate(template.params, source.name, names, index),
+                    depends=[f"{dep}_{index}" if dep in names else dep for dep in template.depends],
+                    resource=template.resource,
+                    updated_at=Utils.get_timestamp(),
+                    template=template.name
+                ))
+        for stage in instances:
+            self.store.save(stage)
+        for template in templates:
+            self.set_status(template, "expanded")
+        stages.extend(instances)
+    
+    @staticmethod
+    def topological_order(stages):
+        """Стадии в порядке зависимостей (алгоритм Кана); цикл - ValueError"""
+        indegree = {stage.name: len(stage.depends) for stage in stages}
+        dependents = {stage.name: [] for stage in stages}
+        for stage in stages:
+            for dep in stage.depends:
+                dependents[dep].append(stage.name)
+        by_name = {stage.name: stage for stage in stages}
+        ready = deque(name for name, degree in indegree.items() if degree == 0)
+        ordered = []
+        while ready:
+            name = ready.popleft()
+            ordered.append(by_name[name])
+            for child in dependents[name]:
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    ready.append(child)
+        if len(ordered) != len(stages):
+            raise ValueError("Стадии задания образуют цикл")
+        return ordered
+    
+    def output_path(self, stage, suffix=".mp4"):
+        """Путь результата стадии по умолчанию"""
+        output_dir = Config.OUTPUT_DIR / stage.job_id
+        output_dir.mkdir(parents=True, exist_ok=True)
+        return output_dir / f"{stage.name}{suffix}"
+    
+    def execute(self, stage, params):
+        """Выполнение стадии; возвращает ее результат или бросает исключение"""
+        if stage.action == "generate_images":
+            if not self.image_gen.load_reference_images():
+                raise RuntimeError(f"Референсные изображения не найдены в {Config.INPUT_IMAGES_DIR}")
+            variants = self.image_gen.generate_images(stage.job_id, num_variants=params.get("num_variants", 4))
+            if not variants:
+                raise RuntimeError("Изображения не сгенерированы")
+            return [str(path) for path in variants]
+        
+        output_path = Path(params.get("output_path") or self.output_path(stage))
+        tracks = [AudioTrack(**track) for track in params.get("audio_tracks", [])]
+        if stage.action == "create_video_from_image":
+            size = tuple(params["size"]) if params.get("size") else None
+            ok = self.video_gen.create_video_from_image(
+                params["image_path"], params.get("duration", 10), output_path, size=size
+            )
+        elif stage.action == "add_audio_tracks":
+            ok = self.video_gen.add_audio_tracks(params["video_path"], tracks, output_path)
+        elif stage.action == "upscale_video_frames":
+            ok = self.video_gen.upscale_video_frames(params["video_path"], output_path)
+        else:
+            ok = self.video_gen.create_long_video(
+                params["video_path"], params["duration_minutes"], tracks or None, output_path
+            )
+        if not ok:
+            raise RuntimeError(f"Стадия {stage.name} завершилась с ошибкой")
+        return str(output_path)
+    
+    @staticmethod
+    def output_exists(output):
+        """Результат стадии еще на диске"""
+        paths = output if isinstance(output, list) else [output]
+        return bool(paths) and all(path and os.path.exists(path) for path in paths)
+    
+    def set_status(self, stage, status, output=None, error=""):
+        stage.status = status
+        stage.output = output
+        stage.error = error
+        stage.updated_at = Utils.get_timestamp()
+        self.store.save(stage)
+    
+    def run(self, job_ids=None):
+        """Выполнение заданий (по умолчанию - всех незавершенных)
+        
+        Возвращает {job_id: [PipelineStage]}.
+        """
+        job_ids = list(job_ids or self.store.unfinished_jobs())
+        jobs = {job_id: self.store.load(job_id) for job_id in job_ids}
+        
+        # Прерванные стадии, стадии с удаленными результатами и все зависящие
+        # от них выполняются заново (стадии идут в порядке добавления, то есть
+        # зависимости раньше зависимых). Шаблоны перезапускаемого источника
+        # разворачиваются заново: число ветвей может измениться.
+        for job_id, stages in jobs.items():
+            reset = set()
+            dropped = set()
+            for stage in stages:
+                if stage.each:
+                    if stage.each in reset or stage.status == "skipped":
+                        reset.add(stage.name)
+                        if stage.status != "template":
+                            self.set_status(stage, "template")
+                    continue
+                if stage.template in reset:
+                    reset.add(stage.name)
+                    dropped.add(stage.name)
+                    continue
+                stale = stage.status in ("running", "failed", "skipped") or \
+                    (stage.status == "completed" and not self.output_exists(stage.output))
+                if stale or any(dep in reset for dep in stage.depends):
+                    reset.add(stage.name)
+                    if stage.status != "pending":
+                        self.set_status(stage, "pending")
+            if dropped:
+                self.store.delete(job_id, dropped)
+                stages[:] = [stage for stage in stages if stage.name not in dropped]
+        
+        executors = {
+            resource: concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, limit), thread_name_prefix=f"pipeline-{resource}"
+            )
+            for resource, limit in self.limits.items()
+        }
+        running = {}
+        
+        try:
+            # Прогресс FFmpeg отдельных стадий не смешивается с прогрессом заданий
+            with ffmpeg_runner.report_to(None, None):
+                for job_id in jobs:
+                    self.task_manager.update_task(job_id, status="processing")
+                
+                while True:
+                    for job_id, stages in jobs.items():
+                        by_name = {stage.name: stage for stage in stages}
+                        for stage in list(stages):
+                            if stage.status != "template":
+                                continue
+                            source = by_name[stage.each]
+                            if source.status == "completed":
+                                self.expand(stages, source)
+                            elif source.status in ("failed", "skipped"):
+                                self.set_status(stage, "skipped", error="Не выполнена зависимость")
+                        
+                        by_name = {stage.name: stage for stage in stages}
+                        outputs = {s.name: s.output for s in stages if s.status == "completed"}
+                        for stage in stages:
+                            if stage.status != "pending":
+                                continue
+                            deps = [by_name[dep].status for dep in stage.depends]
+                            if any(status in ("failed", "skipped") for status in deps):
+                                self.set_status(stage, "skipped", error="Не выполнена зависимость")
+                            elif all(status == "completed" for status in deps):
+                                try:
+                                    params = self.resolve(stage.params, outputs)
+                                except (KeyError, IndexError, TypeError, ValueError) as e:
+                                    logger.error(f"Ошибка параметров стадии {job_id}/{stage.name}: {e}")
+                                    self.set_status(stage, "failed", error=f"Некорректная ссылка: {e}")
+                                    continue
+                                executor = executors.get(stage.resource) or executors["cpu"]
+                                self.set_status(stage, "running")
+                                running[executor.submit(self.execute, stage, params)] = stage
+                    
+                    if not running:
+                        break
+                    
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        stage = running.pop(future)
+                        try:
+                            self.set_status(stage, "completed", output=future.result())
+                            self.task_manager.add_step(stage.job_id, f"Стадия {stage.name}", stage.output)
+                        except Exception as e:
+                            logger.error(f"Ошибка стадии {stage.job_id}/{stage.name}: {e}")
+                            self.set_status(stage, "failed", error=str(e))
+                        
+                        # Стадии сами меняют статус задачи (generate_images), возвращаем его
+                        stages = jobs[stage.job_id]
+                        finished = sum(1 for s in stages
+                                       if s.status in ("completed", "expanded", "failed", "skipped"))
+                        self.task_manager.update_task(stage.job_id, status="processing",
+                                                      progress=finished * 100 / len(stages))
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+        
+        for job_id, stages in jobs.items():
+            failed = any(stage.status not in ("completed", "expanded") for stage in stages)
+            self.task_manager.update_task(job_id, status="failed" if failed else "completed", progress=100)
+        return jobs
+    
+    @staticmethod
+    def print_job(job_id, stages):
+        """Вывод состояния стадий задания"""
+        colors = {"completed": "green", "expanded": "green", "running": "yellow", "pending": "yellow",
+                  "template": "yellow"}
+        print(f"\nЗадание {job_id}:")
+        for stage in stages:
+            status = Utils.color_text(stage.status, colors.get(stage.status, "red"))
+            result = stage.error or (stage.output if not isinstance(stage.output, list)
+                                     else f"{len(stage.output)} файлов")
+            print(f"  {stage.name:<12} {stage.action:<25} {status} {result or ''}")
 
 # ============================================================================
 # СИСТЕМА КАЛЕНДАРЯ
@@ -959,10 +5038,14 @@ class VideoGeneratorApp:
         # Настройка директорий
         self.utils.setup_directories()
         
+        # Журнал событий задач для внешнего мониторинга
+        self.event_sink = EventFileSink()
+        self.event_sink.start()
+        
         # Текущее состояние
-        self.current_task_id = None
         self.current_video_path = None
         self.audio_tracks = []
+        self.audio_video_path = None  # видео, в которое уже сведены self.audio_tracks
     
     def run(self):
         """Запуск главного меню"""
@@ -980,6 +5063,7 @@ class VideoGeneratorApp:
             "⬆️ Улучшение видео до 4K",
             "⏱️ Создание длинного видео (3-24 часа)",
             "🎞️ Склейка видео",
+            "🧩 Пакетный рендер (конвейер)",
             "📅 Планирование контента",
             "📊 Просмотр задач",
             "⚙️ Настройки",
@@ -996,6 +5080,7 @@ class VideoGeneratorApp:
             self.menu_upscale_video,
             self.menu_create_long_video,
             self.menu_merge_videos,
+            self.menu_pipeline,
             self.menu_schedule_content,
             self.menu_show_tasks,
             self.menu_settings,
@@ -1006,6 +5091,23 @@ class VideoGeneratorApp:
         if choice < len(actions):
             actions[choice]()
     
+    def run_task(self, name, task_type, func, *args):
+        """Действие меню в собственной задаче; (task_id, результат func)
+        
+        Прогресс команд FFmpeg, запущенных func, идет в эту задачу; по
+        результату func она помечается completed или failed.
+        """
+        task_id = self.task_manager.create_task(name, task_type)
+        self.task_manager.update_task(task_id, status="processing")
+        result = None
+        try:
+            with ffmpeg_runner.report_to(self.task_manager, task_id):
+                result = func(*args)
+        finally:
+            self.task_manager.update_task(task_id, status="completed" if result else "failed",
+                                          progress=100 if result else None)
+        return task_id, result
+    
     def menu_generate_images(self):
         """Меню генерации изображений"""
         self.utils.print_header("ГЕНЕРАЦИЯ ИЗОБРАЖЕНИЙ")
@@ -1013,12 +5115,11 @@ class VideoGeneratorApp:
         # Создаем задачу
         task_name = self.ui.input_with_default("Название задачи", "Генерация изображений")
         task_id = self.task_manager.create_task(task_name, "image_generation")
-        self.current_task_id = task_id
         
         print(f"Создана задача: {task_id}")
         
-        # Проверяем референсы
-        if not self.image_gen.reference_images:
+        # Проверяем референсы (повторно читаются только измененные файлы)
+        if not self.image_gen.load_reference_images():
             print("\nРеференсные изображения не найдены!")
             print("Поместите изображения в:", Config.INPUT_IMAGES_DIR)
             print("Создайте JSON файлы с описанием (имя.json)")
@@ -1078,21 +5179,20 @@ class VideoGeneratorApp:
         
         prompt = self.ui.input_with_default("Промпт для видео", "Расслабляющая визуализация")
         
-        if self.video_gen.create_video_from_image(
-            self.current_video_path, 
-            duration, 
+        task_id, created = self.run_task(
+            f"Создание видео ({duration}сек)", "video_creation",
+            self.video_gen.create_video_from_image,
+            self.current_video_path,
+            duration,
             output_path,
             prompt
-        ):
+        )
+        if created:
             self.current_video_path = str(output_path)
             print(f"\nВидео создано: {self.current_video_path}")
             
             # Добавляем в задачу
-            self.task_manager.add_step(
-                self.current_task_id if self.current_task_id else "manual",
-                f"Создание видео ({duration}сек)",
-                str(output_path)
-            )
+            self.task_manager.add_step(task_id, f"Создание видео ({duration}сек)", str(output_path))
         else:
             print("Ошибка создания видео")
     
@@ -1161,12 +5261,16 @@ class VideoGeneratorApp:
                 f"{Path(self.current_video_path).stem}_with_audio"
             )
             
-            if self.video_gen.add_audio_tracks(
+            _, added = self.run_task(
+                f"Добавление аудио ({len(self.audio_tracks)} дор.)", "audio",
+                self.video_gen.add_audio_tracks,
                 self.current_video_path,
                 self.audio_tracks,
                 output_path
-            ):
+            )
+            if added:
                 self.current_video_path = str(output_path)
+                self.audio_video_path = self.current_video_path
                 print(f"\nАудио добавлено: {self.current_video_path}")
             else:
                 print("Ошибка добавления аудио")
@@ -1187,7 +5291,9 @@ class VideoGeneratorApp:
         print(f"Выходное видео: {output_path}")
         print("\nПроцесс может занять некоторое время...")
         
-        if self.video_gen.upscale_video_frames(self.current_video_path, output_path):
+        _, upscaled = self.run_task("Улучшение до 4K", "upscale", self.video_gen.upscale_video_frames,
+                                    self.current_video_path, output_path)
+        if upscaled:
             self.current_video_path = str(output_path)
             print(f"\n4K видео создано: {self.current_video_path}")
         else:
@@ -1225,47 +5331,134 @@ class VideoGeneratorApp:
                 print("Некорректная длительность")
                 return
         
-        # Создание длинного видео
-        print(f"\nСоздание видео длительностью {duration_minutes} минут...")
-        long_video = self.video_gen.create_long_video(
-            self.current_video_path,
-            duration_minutes
-        )
+        # Дорожки уже сведены в ролик - повторно их не микшируем
+        tracks_in_clip = self.current_video_path == self.audio_video_path
+        loop_unit = None
+        if Config.LOOP_SEARCH_ENABLED:
+            print("\nПоиск точки зацикливания...")
+            loop_unit = self.video_gen.make_loop_unit(self.current_video_path)
+        source = loop_unit or self.current_video_path
         
-        if long_video:
-            self.current_video_path = long_video
-            print(f"Длинное видео создано: {long_video}")
+        try:
+            audio_tracks = None
+            if self.audio_tracks and not tracks_in_clip and self.ui.confirm_action(
+                f"Добавить аудиодорожки ({len(self.audio_tracks)}) как зацикленную подложку?"
+            ):
+                audio_tracks = self.audio_tracks
+            
+            # Создание длинного видео
+            print(f"\nСоздание видео длительностью {duration_minutes} минут...")
+            _, long_video = self.run_task(f"Длинное видео ({duration_minutes} мин)", "long_video",
+                                          self.video_gen.create_long_video,
+                                          source, duration_minutes, audio_tracks)
             
-            # Проверка бесшовности (имитация)
-            print("\nПроверка бесшовности склейки...")
-            time.sleep(2)
-            print("✓ Видео однородное, склейка незаметна")
+            if long_video:
+                print(f"Длинное видео создано: {long_video}")
+                
+                print("\nПроверка бесшовности склейки...")
+                try:
+                    analyzer = SeamAnalyzer()
+                    clip_duration = media_probe.summary(source)["duration"]
+                    seams, total = analyzer.loop_seams(clip_duration, duration_minutes * 60)
+                    analyzer.print_report(analyzer.analyze(long_video, seams, total))
+                except Exception as e:
+                    logger.error(f"Ошибка проверки склейки: {e}")
+                    print(f"Не удалось проверить склейку: {e}")
+                self.current_video_path = long_video
+        finally:
+            # Зацикленный фрагмент нужен только для этого рендера
+            if loop_unit:
+                Path(loop_unit).unlink(missing_ok=True)
     
     def menu_merge_videos(self):
         """Меню склейки видео"""
         self.utils.print_header("СКЛЕЙКА ВИДЕО")
         
-        video1 = input("Путь к первому видео: ").strip()
-        video2 = input("Путь ко второму видео: ").strip()
+        print("Введите пути к видео по порядку (пустая строка - закончить)")
+        videos = []
+        while True:
+            path = input(f"Видео {len(videos) + 1}: ").strip()
+            if not path:
+                break
+            if not os.path.exists(path):
+                print("Файл не найден!")
+                continue
+            videos.append(path)
         
-        if not (os.path.exists(video1) and os.path.exists(video2)):
-            print("Один из файлов не найден!")
+        if len(videos) < 2:
+            print("Нужно минимум два видео")
             return
         
         output_path = Config.OUTPUT_DIR / f"merged_{Utils.generate_id()}.mp4"
         
-        if self.video_gen.merge_videos(video1, video2, output_path):
+        _, merged = self.run_task(f"Склейка видео ({len(videos)})", "merge",
+                                  self.video_gen.merge_videos, videos, output_path)
+        if merged:
             self.current_video_path = str(output_path)
             print(f"Видео склеены: {self.current_video_path}")
             
             # Проверка склейки
             if self.ui.confirm_action("Проверить склейку на бесшовность?"):
                 print("Запуск проверки...")
-                time.sleep(3)
-                print("✓ Склейка качественная, переходы незаметны")
+                try:
+                    analyzer = SeamAnalyzer()
+                    durations = [media_probe.summary(path)["duration"] for path in videos[:-1]]
+                    seams = np.cumsum(durations).tolist()
+                    analyzer.print_report(analyzer.analyze(output_path, seams))
+                except Exception as e:
+                    logger.error(f"Ошибка проверки склейки: {e}")
+                    print(f"Не удалось проверить склейку: {e}")
         else:
             print("Ошибка склейки видео")
     
+    def menu_pipeline(self):
+        """Меню пакетного рендера"""
+        self.utils.print_header("ПАКЕТНЫЙ РЕНДЕР")
+        
+        scheduler = PipelineScheduler(self.image_gen, self.video_gen, self.task_manager)
+        options = [
+            "Новые задания",
+            "Продолжить незавершенные",
+            "Состояние задания"
+        ]
+        choice = self.ui.select_option(options)
+        
+        if choice == 0:
+            jobs = int(self.ui.input_with_default("Количество заданий", "2"))
+            variants = int(self.ui.input_with_default("Вариантов изображений в задании", "1"))
+            duration = int(self.ui.input_with_default("Длительность видео (сек)", "10"))
+            tracks = []
+            if self.audio_tracks and self.ui.confirm_action(
+                    f"Добавить загруженные аудиодорожки ({len(self.audio_tracks)})?"):
+                tracks = self.audio_tracks
+            upscale = self.ui.confirm_action("Улучшать до 4K?")
+            long_minutes = None
+            if self.ui.confirm_action("Создавать длинное видео?"):
+                long_minutes = int(self.ui.input_with_default("Длительность (минут)", "180"))
+            
+            job_ids = [
+                scheduler.standard_job(f"Конвейер {i + 1}", variants, duration, tracks, upscale, long_minutes)
+                for i in range(jobs)
+            ]
+            print(f"Создано заданий: {len(job_ids)}")
+        elif choice == 1:
+            job_ids = scheduler.store.unfinished_jobs()
+            if not job_ids:
+                print("Незавершенных заданий нет")
+                return
+        else:
+            job_id = input("ID задания: ").strip()
+            stages = scheduler.store.load(job_id)
+            if not stages:
+                print("Задание не найдено")
+                return
+            scheduler.print_job(job_id, stages)
+            return
+        
+        print("Выполнение конвейера...")
+        for job_id, stages in scheduler.run(job_ids).items():
+            scheduler.print_job(job_id, stages)
+    
     def menu_schedule_content(self):
         """Меню планирования контента"""
         self.utils.print_header("ПЛАНИРОВАНИЕ КОНТЕНТА")
@@ -1297,7 +5490,21 @@ class VideoGeneratorApp:
     
     def menu_show_tasks(self):
         """Меню просмотра задач"""
-        self.task_manager.show_tasks()
+        statuses = [None, "pending", "processing", "completed", "failed"]
+        choice = self.ui.select_option(
+            ["Все", "pending", "processing", "completed", "failed"],
+            "Фильтр по статусу:"
+        )
+        status = statuses[choice]
+        
+        page = 1
+        while True:
+            pages = self.task_manager.show_tasks(status=status, page=page)
+            if not pages or page >= pages:
+                break
+            if not self.ui.confirm_action("Показать следующую страницу?"):
+                break
+            page += 1
     
     def menu_settings(self):
         """Меню настроек"""
@@ -1308,6 +5515,7 @@ class VideoGeneratorApp:
             "Изменить FPS",
             "Настройки API",
             "Язык метаданных YouTube",
+            "Автоподбор параметров кодирования",
             "Сбросить настройки"
         ]
         
@@ -1331,7 +5539,20 @@ class VideoGeneratorApp:
                 "Google AI Studio API Key", 
                 Config.GOOGLE_AI_STUDIO_API_KEY
             )
+            Config.STABILITY_AI_API_KEY = self.ui.input_with_default(
+                "Stability AI API Key",
+                Config.STABILITY_AI_API_KEY
+            )
             print("API ключи обновлены")
+            
+            providers = [None, "google", "stability"]
+            provider_idx = self.ui.select_option(
+                ["Локальный рендер (демо)", "Google AI Studio", "Stability AI"],
+                "Генерация изображений через:"
+            )
+            Config.IMAGE_API_PROVIDER = providers[provider_idx]
+            client = API_CLIENTS[Config.IMAGE_API_PROVIDER]() if Config.IMAGE_API_PROVIDER else None
+            self.image_gen.set_api_client(client)
         
         elif choice == 3:
             lang = self.ui.input_with_default("Язык (ru/en)", "ru")
@@ -1339,6 +5560,15 @@ class VideoGeneratorApp:
             print("Язык метаданных изменен")
         
         elif choice == 4:
+            Config.ENCODER_TUNING = self.ui.confirm_action(
+                f"Подбирать preset/CRF автоматически (цель SSIM {Config.TUNING_TARGET_SSIM})?"
+            )
+            if self.ui.confirm_action("Сбросить сохраненные профили кодирования?"):
+                self.video_gen.encoder_tuner.profiles = {}
+                self.video_gen.encoder_tuner.save_profiles()
+            print("Настройки кодирования обновлены")
+        
+        elif choice == 5:
             if self.ui.confirm_action("Вы уверены? Все настройки будут сброшены"):
                 # Сброс настроек
                 print("Настройки сброшены")
@@ -1393,9 +5623,108 @@ class VideoGeneratorApp:
         print("\nСохранение данных...")
         self.task_manager.save_tasks()
         self.calendar.save_calendar()
+        ffmpeg_runner.cancel_all()
+        self.event_sink.stop()
         print("До свидания!")
         sys.exit(0)
 
+# ============================================================================
+# БЕНЧМАРКИ
+# ============================================================================
+
+class Benchmarks:
+    """Замеры производительности (python run.py --benchmark <имя>)"""
+    
+    @staticmethod
+    def reference_analysis(num_refs=100000, k=10):
+        """Анализ референсов на синтетическом наборе"""
+        rng = random.Random(42)
+        vocabulary = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10)))
+                      for _ in range(20000)]
+        styles = [f"style_{i}" for i in range(50)]
+        
+        # Распределение терминов по закону Ципфа, как в реальных описаниях
+        cum_weights = []
+        total = 0.0
+        for rank in range(len(vocabulary)):
+            total += 1 / (rank + 1)
+            cum_weights.append(total)
+        refs = [
+            ImageDescription(
+                image_path=f"ref_{i}.jpg",
+                positive=' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=12)),
+                negative=' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=6)),
+                style=rng.choice(styles)
+            )
+            for i in range(num_refs)
+        ]
+        
+        analyzer = ReferenceAnalyzer()
+        start = time.perf_counter()
+        analyzer.add_many(refs)
+        build_time = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        queries = 1000
+        for _ in range(queries):
+            analyzer.top_terms("positive", k)
+        query_time = (time.perf_counter() - start) / queries
+        
+        start = time.perf_counter()
+        updates = 1000
+        for desc in refs[:updates]:
+            analyzer.remove(desc.image_path)
+            analyzer.add(desc)
+        update_time = (time.perf_counter() - start) / updates
+        
+        print(f"Референсов: {num_refs}, терминов: {len(analyzer.stats['positive'].scores)}")
+        print(f"Построение индекса: {build_time:.2f} с")
+        print(f"Запрос top-{k}: {query_time * 1e6:.1f} мкс")
+        print(f"Замена одного референса: {update_time * 1e6:.1f} мкс")
+        print(f"Top-{k}: {', '.join(term for term, _ in analyzer.top_terms('positive', k))}")
+    
+    @staticmethod
+    def still_encode(durations=(10, 60), sizes=((1920, 1080), (3840, 2160))):
+        """Видео из картинки: обычное кодирование против режима still image"""
+        work_dir = Path(tempfile.mkdtemp(prefix="bench_still_"))
+        # Каждый замер - настоящее кодирование, а не ссылка из хранилища артефактов
+        video_gen = VideoGenerator(artifacts=ArtifactStore(work_dir / "artifacts", enabled=False))
+        try:
+            print(f"{'Размер':>10} {'Длит.':>6} {'Обычный':>10} {'Still':>10} {'Ускорение':>10} {'Размер файла':>22}")
+            for width, height in sizes:
+                image_path = work_dir / f"image_{width}x{height}.jpg"
+                ImageGenerator.render_test_image(image_path, "benchmark", 0, width, height)
+                for duration in durations:
+                    timings = {}
+                    file_sizes = {}
+                    for still_mode in (False, True):
+                        output_path = work_dir / f"out_{still_mode}.mp4"
+                        start = time.perf_counter()
+                        ok = video_gen.create_video_from_image(
+                            image_path, duration, output_path,
+                            still_mode=still_mode, size=(width, height)
+                        )
+                        timings[still_mode] = time.perf_counter() - start
+                        file_sizes[still_mode] = output_path.stat().st_size if ok else 0
+                    print(f"{width}x{height:<5} {duration:>5}с {timings[False]:>9.2f}с {timings[True]:>9.2f}с "
+                          f"{timings[False] / timings[True]:>9.1f}x "
+                          f"{file_sizes[False] / 1e6:>9.2f} / {file_sizes[True] / 1e6:.2f} МБ")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    @staticmethod
+    def run(args):
+        """Запуск бенчмарка по имени"""
+        benchmarks = {
+            "analysis": Benchmarks.reference_analysis,
+            "still": Benchmarks.still_encode
+        }
+        name = args[0] if args else ""
+        if name not in benchmarks:
+            print(f"Доступные бенчмарки: {', '.join(benchmarks)}")
+            return
+        benchmarks[name]()
+
 # ============================================================================
 # ТОЧКА ВХОДА
 # ============================================================================
@@ -1415,6 +5744,10 @@ def main():
         sys.exit(1)
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["--benchmark"]:
+        Benchmarks.run(sys.argv[2:])
+        sys.exit(0)
+    
     print("="*80)
     print(" " * 20 + "ВИДЕОГЕНЕРАТОР v1.0")
     print("="*80)
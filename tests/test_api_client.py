@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Проверки ApiClient против локального сервера: повторы, объединение, лимит частоты"""
+
+import sys
+import time
+import asyncio
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import run
+from run import ApiClient, StabilityAIClient
+
+
+class MockImageApiHandler(BaseHTTPRequestHandler):
+    """Локальный сервер API генерации: задержка, 429 и 5xx
+    
+    Параметры и счетчики хранятся в атрибутах сервера (MockImageApiHandler.serve).
+    """
+    
+    protocol_version = "HTTP/1.1"  # keep-alive, как у настоящих провайдеров
+    
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        with server.lock:
+            server.counts["total"] += 1
+            number = server.counts["total"]
+            server.connections.add(self.client_address)
+        
+        time.sleep(server.latency)
+        if server.throttle_every and number % server.throttle_every == 0:
+            status, body, headers = 429, b"rate limited", {'Retry-After': f"{server.retry_after:g}"}
+        elif server.fail_every and number % server.fail_every == 0:
+            status, body, headers = 503, b"unavailable", {}
+        else:
+            status, body, headers = 200, b"\xff\xd8mock-image\xff\xd9", {'Content-Type': 'image/jpeg'}
+        with server.lock:
+            server.counts[status] = server.counts.get(status, 0) + 1
+        
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+    
+    @classmethod
+    def serve(cls, latency=0.0, throttle_every=0, fail_every=0, retry_after=0.05):
+        """Запуск сервера на свободном порту в фоновом потоке"""
+        server = ThreadingHTTPServer(('127.0.0.1', 0), cls)
+        server.daemon_threads = True
+        server.lock = threading.Lock()
+        server.counts = {"total": 0}
+        server.connections = set()
+        server.latency = latency
+        server.throttle_every = throttle_every
+        server.fail_every = fail_every
+        server.retry_after = retry_after
+        threading.Thread(target=server.serve_forever, name="mock-api", daemon=True).start()
+        return server
+
+
+@pytest.fixture
+def fast_backoff(monkeypatch):
+    """Короткие паузы между повторами"""
+    monkeypatch.setattr(run.Config, "API_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(run.Config, "API_BACKOFF_MAX", 0.2)
+
+
+@pytest.fixture
+def make_client():
+    """Фабрика (сервер, клиент); все запущенные останавливаются после теста"""
+    started = []
+    
+    def make(rate=(1000.0, 1000), **server_options):
+        server = MockImageApiHandler.serve(**server_options)
+        client = StabilityAIClient(api_key="test", base_url=f"http://127.0.0.1:{server.server_address[1]}",
+                                   rate_limit=rate)
+        started.append((server, client))
+        return server, client
+    
+    yield make
+    for server, client in started:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+def generate_all(client, prompts):
+    """Параллельная генерация по списку промптов; результаты или исключения"""
+    async def gather():
+        tasks = [client.generate(prompt, 1024, 576) for prompt in prompts]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+    return client.run(gather())
+
+
+def test_api_client_is_abstract():
+    with pytest.raises(TypeError):
+        ApiClient("key", "http://127.0.0.1")
+
+
+def test_retries_throttled_and_failed_requests(make_client, fast_backoff):
+    server, client = make_client(throttle_every=3, fail_every=5)
+    
+    results = generate_all(client, [f"prompt {i}" for i in range(20)])
+    
+    assert all(result == b"\xff\xd8mock-image\xff\xd9" for result in results)
+    assert server.counts[200] == 20
+    assert server.counts.get(429, 0) > 0 and server.counts.get(503, 0) > 0
+    assert client.stats["retries"] == server.counts[429] + server.counts[503]
+    assert client.stats["requests"] == server.counts["total"]
+    assert client.stats["errors"] == 0
+
+
+def test_gives_up_after_max_retries(make_client, fast_backoff, monkeypatch):
+    monkeypatch.setattr(run.Config, "API_MAX_RETRIES", 2)
+    server, client = make_client(fail_every=1)
+    
+    [result] = generate_all(client, ["prompt"])
+    
+    assert isinstance(result, run.ApiError)
+    assert result.status == 503
+    assert server.counts["total"] == 3
+    assert client.stats["errors"] == 1
+
+
+def test_identical_requests_are_coalesced(make_client):
+    server, client = make_client(latency=0.2)
+    
+    results = generate_all(client, ["same prompt"] * 10 + ["other prompt"])
+    
+    assert all(isinstance(result, bytes) for result in results)
+    assert server.counts["total"] == 2
+    assert client.stats["coalesced"] == 9
+
+
+def test_rate_limit_spaces_requests(make_client):
+    server, client = make_client(rate=(20.0, 1))
+    
+    start = time.monotonic()
+    generate_all(client, [f"prompt {i}" for i in range(10)])
+    elapsed = time.monotonic() - start
+    
+    assert server.counts[200] == 10
+    # Первый запрос из запаса, остальные девять - по одному на 1/20 с
+    assert elapsed >= 9 / 20 * 0.9
+
+
+def test_connections_are_reused(make_client):
+    server, client = make_client(latency=0.01)
+    
+    generate_all(client, [f"prompt {i}" for i in range(40)])
+    
+    assert server.counts[200] == 40
+    assert len(server.connections) <= client.max_concurrency